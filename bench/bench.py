@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""Benchmarks for kgit.
+
+  bench.py generate PATH [options]   Create a synthetic repository.
+  bench.py run PATH [-o FILE]        Time kgit on it, print JSON.
+  bench.py compare OLD NEW           Compare two runs.
+  bench.py startup PATH [--budget MS] Time kgit's startup.
+
+The generator is deterministic: the same options always give the
+same repository, down to the SHAs, so that runs on different
+machines or versions of kgit can be compared.  Each benchmark runs in
+its own process, so that its peak RSS is its own.  Only the standard
+library is needed."""
+
+import argparse
+import compileall
+import io
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+KGIT_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, KGIT_SRC)
+
+import GitObject
+import GitPack
+import GitRepository
+import libkgit
+
+# Where the generator saves its options, for run to report them.
+BENCH_PARAMS = "kgit-bench.json"
+
+# Blob contents are made of these, so that they compress and delta
+# like source code rather than like noise.
+WORDS = [ b"the", b"return", b"self", b"if", b"else", b"for", b"in", b"def",
+          b"import", b"None", b"value", b"path", b"data", b"=", b"==", b"(",
+          b")", b":", b"0", b"1", b"repo", b"sha", b"object", b"tree", b"#" ]
+
+class SynthDir(object):
+    """A directory of the synthetic worktree.  entries maps names to
+    either a SynthDir or the SHA of a blob, and sha is the SHA of the
+    tree last written for it, or None if something changed since."""
+
+    def __init__(self):
+        self.entries = dict()
+        self.sha = None
+
+def synth_blob_data(rng, args):
+    """Return the contents of a new blob: lines of words, with a size
+    drawn from a log-normal distribution around args.blob_size."""
+    size = int(rng.lognormvariate(math.log(args.blob_size), args.blob_sigma))
+    size = max(1, min(size, args.max_blob))
+    lines = list()
+    total = 0
+    while total < size:
+        line = b" ".join(rng.choices(WORDS, k=rng.randint(1, 12))) + b"\n"
+        lines.append(line)
+        total += len(line)
+    return b"".join(lines)[:size]
+
+def synth_tree(repo, rng, args, level=0):
+    """Build a directory with args.width files and, above args.depth,
+    args.fanout subdirectories."""
+    d = SynthDir()
+    for i in range(args.width):
+        blob = GitObject.GitBlob(synth_blob_data(rng, args))
+        d.entries[f"file{i}.txt"] = GitObject.object_write(blob, repo)
+    if level < args.depth:
+        for i in range(args.fanout):
+            d.entries[f"dir{i}"] = synth_tree(repo, rng, args, level + 1)
+    return d
+
+def synth_modify(repo, rng, args, root):
+    """Give a random file of root new contents, invalidating the SHAs
+    of the directories above it."""
+    d = root
+    path = [ d ]
+    while True:
+        dirs = [ n for n, e in d.entries.items() if isinstance(e, SynthDir) ]
+        # Go down about as often as there are files to stop at.
+        if not dirs or rng.random() < args.width / (args.width + len(dirs) * args.width):
+            break
+        d = d.entries[rng.choice(dirs)]
+        path.append(d)
+
+    files = sorted(n for n, e in d.entries.items() if not isinstance(e, SynthDir))
+    # Now and then, add a file rather than change one.
+    name = rng.choice(files) if files and rng.random() > 0.1 else f"new{len(d.entries)}.txt"
+    d.entries[name] = GitObject.object_write(GitObject.GitBlob(synth_blob_data(rng, args)), repo)
+    for p in path:
+        p.sha = None
+
+def synth_write_tree(repo, d):
+    """Write the trees of d that changed, and return its SHA."""
+    if d.sha is None:
+        tree = GitObject.GitTree()
+        for name, e in d.entries.items():
+            if isinstance(e, SynthDir):
+                tree.items.append(GitObject.GitTreeLeaf(b"040000", name, synth_write_tree(repo, e)))
+            else:
+                tree.items.append(GitObject.GitTreeLeaf(b"100644", name, e))
+        d.sha = GitObject.object_write(tree, repo)
+    return d.sha
+
+def synth_commit(repo, tree, parents, n, message):
+    commit = GitObject.GitCommit()
+    # A fixed clock, one minute per commit, so that SHAs are stable.
+    who = f"Bench <bench@example.com> {1600000000 + 60 * n} +0000".encode("ascii")
+    commit.kvlm[b'tree'] = tree.encode("ascii")
+    if parents:
+        commit.kvlm[b'parent'] = [ p.encode("ascii") for p in parents ]
+    commit.kvlm[b'author'] = who
+    commit.kvlm[b'committer'] = who
+    commit.kvlm[None] = message.encode("utf8") + b"\n"
+    return GitObject.object_write(commit, repo)
+
+def synth_tag(repo, name, sha, n):
+    tag = GitObject.GitTag()
+    tag.kvlm[b'object'] = sha.encode("ascii")
+    tag.kvlm[b'type'] = b'commit'
+    tag.kvlm[b'tag'] = name.encode("ascii")
+    tag.kvlm[b'tagger'] = f"Bench <bench@example.com> {1600000000 + 60 * n} +0000".encode("ascii")
+    tag.kvlm[None] = f"Release {name}\n".encode("ascii")
+    return GitObject.object_write(tag, repo)
+
+def synth_ref(repo, name, sha):
+    with open(GitRepository.repo_file(repo, *name.split("/"), mkdir=True), "w") as f:
+        f.write(sha + "\n")
+
+def cmd_generate(args):
+    repo = GitRepository.repo_create(args.path)
+    rng = random.Random(args.seed)
+
+    root = synth_tree(repo, rng, args)
+    head = synth_commit(repo, synth_write_tree(repo, root), [], 0, "Initial commit")
+    commits = [ head ]
+    n = 1
+    while len(commits) < args.commits:
+        for _ in range(rng.randint(1, args.changes)):
+            synth_modify(repo, rng, args, root)
+
+        if len(commits) > 2 and rng.random() < args.merge_rate:
+            # A side branch forked a few commits ago, merged back.  Its
+            # tree is the new one: only the shape of history matters.
+            tree = synth_write_tree(repo, root)
+            fork = commits[-rng.randint(2, min(10, len(commits)))]
+            side = synth_commit(repo, tree, [ fork ], n, f"Side commit {n}")
+            head = synth_commit(repo, tree, [ head, side ], n, f"Merge commit {n}")
+            commits.append(side)
+        else:
+            head = synth_commit(repo, synth_write_tree(repo, root), [ head ], n, f"Commit {n}")
+        commits.append(head)
+        n += 1
+
+    synth_ref(repo, "refs/heads/master", head)
+    # Tags are spread evenly over history; every other one is
+    # annotated.
+    for i in range(args.tags):
+        target = commits[i * len(commits) // args.tags]
+        name = f"v{i}"
+        if i % 2 == 0:
+            target = synth_tag(repo, name, target, i)
+        synth_ref(repo, f"refs/tags/{name}", target)
+
+    if args.pack:
+        libkgit.repack(repo, prune=True)
+
+    with open(GitRepository.repo_file(repo, BENCH_PARAMS), "w") as f:
+        params = { k: v for k, v in vars(args).items() if k not in ("command", "path") }
+        json.dump(params, f, indent=2, sort_keys=True)
+
+    print(f"{len(commits)} commits, HEAD at {head}")
+
+class OutputCounter(io.TextIOBase):
+    """A stand-in for stdout that counts the lines written to it, or
+    only those that contain match."""
+
+    def __init__(self, match=None):
+        self.match = match
+        self.count = 0
+
+    def write(self, s):
+        if self.match is None:
+            self.count += s.count("\n")
+        else:
+            self.count += sum(1 for line in s.splitlines() if self.match in line)
+        return len(s)
+
+def bench_objects(repo):
+    """Return the SHA of every object in repo, loose or packed."""
+    shas = list(GitObject.object_loose_list(repo))
+    for pack in GitPack.pack_list(repo):
+        shas.extend(pack.sha(n).hex() for n in range(pack.count))
+    return shas
+
+def bench_objects_of_type(repo, fmts):
+    return [ sha for sha in bench_objects(repo) if GitObject.object_read_header(repo, sha)[0] in fmts ]
+
+def bench_command(argv, match=None):
+    """Return a function running kgit with argv, which returns how many
+    lines of output (containing match) it printed."""
+    def run():
+        out = OutputCounter(match)
+        stdout = sys.stdout
+        sys.stdout = out
+        try:
+            libkgit.main(argv)
+        finally:
+            sys.stdout = stdout
+        return out.count
+    return run
+
+# Each benchmark prepares what it needs, outside of the timings, and
+# returns a function doing the work to time, which returns how many
+# objects it went through.
+
+def bench_object_read(repo, tmp):
+    shas = bench_objects(repo)
+    def run():
+        # A fresh repository each time, so that the cache starts cold.
+        fresh = GitRepository.repo_find(repo.worktree)
+        for sha in shas:
+            GitObject.object_read(fresh, sha)
+        return len(shas)
+    return run
+
+def bench_tree_parse(repo, tmp):
+    raws = [ GitObject.object_read_raw(repo, sha)[1] for sha in bench_objects_of_type(repo, [ b'tree' ]) ]
+    def run():
+        for raw in raws:
+            GitObject.tree_parse(raw)
+        return len(raws)
+    return run
+
+def bench_kvlm_parse(repo, tmp):
+    raws = [ GitObject.object_read_raw(repo, sha)[1] for sha in bench_objects_of_type(repo, [ b'commit', b'tag' ]) ]
+    def run():
+        for raw in raws:
+            GitObject.kvlm_parse(raw)
+        return len(raws)
+    return run
+
+def bench_log(repo, tmp):
+    # One node per commit.
+    return bench_command([ "log", "HEAD" ], match="[label=")
+
+def bench_ls_tree(repo, tmp):
+    return bench_command([ "ls-tree", "-r", "HEAD" ])
+
+def bench_show_ref(repo, tmp):
+    return bench_command([ "show-ref" ])
+
+def bench_checkout(repo, tmp):
+    runs = iter(range(1000))
+    def run():
+        dest = os.path.join(tmp, f"checkout{next(runs)}")
+        bench_command([ "checkout", "HEAD", dest ])()
+        return sum(len(files) for _, _, files in os.walk(dest))
+    return run
+
+def bench_hash_object(repo, tmp):
+    src = os.path.join(tmp, "src")
+    bench_command([ "checkout", "HEAD", src ])()
+    paths = [ os.path.join(root, f) for root, _, files in os.walk(src) for f in files ]
+    runs = iter(range(1000))
+    def run():
+        # Write to an empty repository, so that nothing is skipped.
+        dest = GitRepository.repo_create(os.path.join(tmp, f"repo{next(runs)}"))
+        for _ in GitObject.object_write_paths(dest, paths):
+            pass
+        return len(paths)
+    return run
+
+BENCHMARKS = {
+    "object_read": bench_object_read,
+    "tree_parse": bench_tree_parse,
+    "kvlm_parse": bench_kvlm_parse,
+    "log": bench_log,
+    "ls-tree": bench_ls_tree,
+    "checkout": bench_checkout,
+    "show-ref": bench_show_ref,
+    "hash-object": bench_hash_object,
+}
+
+def cmd_run_one(args):
+    """Run a single benchmark, in this process, and print its results
+    as JSON."""
+    path = os.path.realpath(args.path)
+    os.chdir(path)
+    repo = GitRepository.repo_find(path)
+
+    tmp = tempfile.mkdtemp(prefix="kgit-bench-")
+    try:
+        run = BENCHMARKS[args.name](repo, tmp)
+        walls = list()
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            count = run()
+            walls.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(tmp)
+
+    best = min(walls)
+    print(json.dumps({
+        "wall": best,
+        "walls": walls,
+        "objects": count,
+        "objects_per_sec": count / best if best else None,
+        # Kilobytes, on Linux.  This includes the preparation.
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+def cmd_run(args):
+    names = args.only or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise Exception(f"Unknown benchmark {name}")
+
+    params = None
+    path = os.path.join(args.path, ".git", BENCH_PARAMS)
+    if os.path.exists(path):
+        with open(path) as f:
+            params = json.load(f)
+
+    results = dict()
+    for name in names:
+        out = subprocess.run([ sys.executable, os.path.abspath(__file__), "run-one",
+                               "--repeat", str(args.repeat), name, args.path ],
+                             check=True, stdout=subprocess.PIPE)
+        results[name] = json.loads(out.stdout)
+        print(f"{name:12} {results[name]['wall']:9.3f}s {results[name]['objects_per_sec']:12.0f} objects/s "
+              f"{results[name]['peak_rss_kb'] / 1024:8.1f} MiB", file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": int(time.time()),
+        "repository": params,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+def cmd_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old.get("repository") != new.get("repository"):
+        print("warning: the runs are on different repositories", file=sys.stderr)
+
+    print(f"{'benchmark':12} {'old':>9} {'new':>9} {'speedup':>8} {'old RSS':>9} {'new RSS':>9}")
+    for name, a in old["results"].items():
+        b = new["results"].get(name)
+        if not b:
+            continue
+        print(f"{name:12} {a['wall']:8.3f}s {b['wall']:8.3f}s {a['wall'] / b['wall']:7.2f}x "
+              f"{a['peak_rss_kb'] / 1024:6.1f}MiB {b['peak_rss_kb'] / 1024:6.1f}MiB")
+
+# Quick commands, whose time is mostly kgit starting up.
+STARTUP_COMMANDS = [
+    [ "rev-parse", "HEAD" ],
+    [ "cat-file", "commit", "HEAD" ],
+    [ "show-ref", "--heads" ],
+]
+
+def startup_time(argv, cwd, repeat):
+    """Return the best wall time of running argv, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=cwd, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        wall = time.perf_counter() - start
+        best = wall if best is None else min(best, wall)
+    return best
+
+def startup_imports(argv, cwd):
+    """Return the import times of running argv, from python -X
+    importtime, as { module: (self, cumulative) } in seconds, and the
+    total."""
+    out = subprocess.run([ sys.executable, "-X", "importtime" ] + argv[1:], cwd=cwd, check=True,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = dict()
+    total = 0
+    for line in out.stderr.decode().splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if not m:
+            continue
+        own, cumulative, indent, name = int(m[1]) / 1e6, int(m[2]) / 1e6, m[3], m[4]
+        imports[name] = (own, cumulative)
+        # Nested imports are part of the cumulative time of the top
+        # level one.
+        if len(indent) == 1:
+            total += cumulative
+    return imports, total
+
+def cmd_startup(args):
+    """Time how long kgit takes to run quick commands, over the time
+    python takes to start, and fail if that's over budget."""
+    path = os.path.realpath(args.path)
+    # Compiling isn't part of starting up: it only happens once, unless
+    # PYTHONDONTWRITEBYTECODE is set.
+    compileall.compile_dir(KGIT_SRC, quiet=1)
+
+    python = startup_time([ sys.executable, "-c", "pass" ], path, args.repeat)
+    print(f"{'python':24} {python * 1000:7.1f}ms", file=sys.stderr)
+
+    results = dict()
+    for command in STARTUP_COMMANDS:
+        argv = [ sys.executable, os.path.join(KGIT_SRC, "kgit") ] + command
+        wall = startup_time(argv, path, args.repeat)
+        imports, total = startup_imports(argv, path)
+        slowest = sorted(imports.items(), key=lambda i: -i[1][0])[:args.top]
+        name = " ".join(command)
+        results[name] = {
+            "wall": wall,
+            "overhead": wall - python,
+            "imports": total,
+            "slowest_imports": { module: own for module, (own, _) in slowest },
+        }
+        print(f"{name:24} {wall * 1000:7.1f}ms  overhead {(wall - python) * 1000:6.1f}ms  "
+              f"imports {total * 1000:6.1f}ms", file=sys.stderr)
+        for module, (own, _) in slowest:
+            print(f"    {module:32} {own * 1000:6.1f}ms", file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "python_startup": python,
+        "budget": args.budget / 1000,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+    over = [ name for name, r in results.items() if r["overhead"] * 1000 > args.budget ]
+    if over:
+        print(f"over the {args.budget:g}ms budget: {', '.join(over)}", file=sys.stderr)
+        sys.exit(1)
+
+argparser = argparse.ArgumentParser(description="Benchmark kgit on synthetic repositories.")
+argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+argsubparsers.required = True
+
+argsp = argsubparsers.add_parser("generate", help="Create a synthetic repository.")
+argsp.add_argument("path", help="Where to create it")
+argsp.add_argument("--commits", type=int, default=200, help="Number of commits (default: 200)")
+argsp.add_argument("--merge-rate", type=float, default=0.1,
+                   help="Probability for a commit to be a merge (default: 0.1)")
+argsp.add_argument("--width", type=int, default=8, help="Files per directory (default: 8)")
+argsp.add_argument("--fanout", type=int, default=3, help="Subdirectories per directory (default: 3)")
+argsp.add_argument("--depth", type=int, default=3, help="Depth of the directory tree (default: 3)")
+argsp.add_argument("--changes", type=int, default=4, help="Most files changed by a commit (default: 4)")
+argsp.add_argument("--blob-size", type=int, default=2048, help="Median blob size, in bytes (default: 2048)")
+argsp.add_argument("--blob-sigma", type=float, default=1.0,
+                   help="Spread of the log-normal blob size distribution (default: 1.0)")
+argsp.add_argument("--max-blob", type=int, default=1024 * 1024, help="Largest blob size (default: 1MiB)")
+argsp.add_argument("--tags", type=int, default=10, help="Number of tags, half of them annotated (default: 10)")
+argsp.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+argsp.add_argument("--pack", action="store_true", help="Pack the objects, rather than leave them loose")
+
+argsp = argsubparsers.add_parser("run", help="Run the benchmarks.")
+argsp.add_argument("path", help="The repository to run them on")
+argsp.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark; the best is kept (default: 3)")
+argsp.add_argument("--only", action="append", metavar="name",
+                   help=f"Only run this benchmark, among: {', '.join(BENCHMARKS)}")
+argsp.add_argument("-o", dest="output", help="Write the results to this file rather than stdout")
+
+argsp = argsubparsers.add_parser("run-one", help="Run one benchmark in this process.")
+argsp.add_argument("--repeat", type=int, default=3)
+argsp.add_argument("name", choices=list(BENCHMARKS))
+argsp.add_argument("path")
+
+argsp = argsubparsers.add_parser("compare", help="Compare the results of two runs.")
+argsp.add_argument("old")
+argsp.add_argument("new")
+
+argsp = argsubparsers.add_parser("startup", help="Time kgit's startup, and check it against a budget.")
+argsp.add_argument("path", help="The repository to run kgit in")
+argsp.add_argument("--repeat", type=int, default=20, help="Runs of each command; the best is kept (default: 20)")
+argsp.add_argument("--budget", type=float, default=50,
+                   help="Most milliseconds kgit may take over python's own startup (default: 50)")
+argsp.add_argument("--top", type=int, default=5, help="Number of slowest imports to show (default: 5)")
+argsp.add_argument("-o", dest="output", help="Also write the results to this file, as JSON")
+
+def main(argv=sys.argv[1:]):
+    args = argparser.parse_args(argv)
+
+    match args.command:
+        case "compare"  : cmd_compare(args)
+        case "generate" : cmd_generate(args)
+        case "run"      : cmd_run(args)
+        case "run-one"  : cmd_run_one(args)
+        case "startup"  : cmd_startup(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import struct
+import time
+
+import GitObject
+import GitTrace
+
+# Permissions of what we archive, as git archive gives them with its
+# default tar.umask of 002.
+ARCHIVE_DIR_MODE = 0o775
+ARCHIVE_FILE_MODE = 0o664
+ARCHIVE_EXEC_MODE = 0o775
+ARCHIVE_LINK_MODE = 0o777
+
+# Zip has no umask applied, so directories get the mode of directories
+# git checks out.
+ARCHIVE_ZIP_DIR_MODE = 0o755
+
+# A tar is made of 512-byte blocks, and padded to 10240-byte records.
+ARCHIVE_TAR_BLOCK = 512
+ARCHIVE_TAR_RECORD = 10240
+
+# A ustar header: name, mode, uid, gid, size, mtime, checksum, type,
+# link target, magic, version, user and group names, and device numbers
+# and a name prefix, which we leave empty.
+ARCHIVE_USTAR = struct.Struct("100s8s8s8s12s12s8sc100s6s2s32s32s8s8s155s12x")
+ARCHIVE_USTAR_ZERO = b'0000000\x00'
+# Offset of the checksum.
+ARCHIVE_USTAR_CHKSUM = 148
+# Sizes are 11 octal digits.
+ARCHIVE_USTAR_MAX_SIZE = 8**11 - 1
+
+# Like gzip's default, which git archive runs.
+ARCHIVE_GZIP_LEVEL = 6
+
+# Zip can't go before the DOS epoch.
+ARCHIVE_ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+# The formats, by the extension of the files they're guessed from.
+ARCHIVE_FORMATS = {
+    ".tar.gz" : "tar.gz",
+    ".tgz"    : "tgz",
+    ".tar"    : "tar",
+    ".zip"    : "zip",
+}
+
+def archive_format(path):
+    """Return the format of an archive called path, or None."""
+    for ext, fmt in ARCHIVE_FORMATS.items():
+        if path.endswith(ext):
+            return fmt
+    return None
+
+def archive_entries(repo, tree, prefix=b''):
+    """Yield a (path, mode, sha) tuple for every entry of tree, a SHA,
+    depth first, each directory before what it holds.  Paths are bytes
+    with prefix before them, and those of directories end with a
+    slash.  sha is None for directories."""
+    for leaf in GitObject.object_read(repo, tree):
+        path = prefix + leaf.name
+        if leaf.mode.startswith(b'04'):
+            yield path + b'/', leaf.mode, None
+            yield from archive_entries(repo, leaf.sha, path + b'/')
+        elif leaf.mode.startswith(b'16'):
+            # A submodule: like git, we only leave an empty directory.
+            yield path + b'/', b'40000', None
+        else:
+            yield path, leaf.mode, leaf.sha
+
+def archive_blob(repo, sha):
+    """Return the size of blob sha and its data, in chunks."""
+    fmt, size, chunks = GitObject.object_read_stream(repo, sha)
+    assert fmt == b'blob'
+    if GitTrace.enabled:
+        GitTrace.count("bytes archived", size)
+    return size, chunks
+
+def archive_tar_header(name, mode, size, mtime, kind, linkname=b''):
+    """Return the ustar header of an entry, or None if it doesn't fit
+    one.  It's what tarfile would write, but most entries of a tree
+    need none of what tarfile handles, and building its headers costs
+    more than reading the blobs."""
+    if len(name) > 100 or len(linkname) > 100 or size > ARCHIVE_USTAR_MAX_SIZE \
+       or not (name.isascii() and linkname.isascii()):
+        return None
+    header = ARCHIVE_USTAR.pack(name, b'%07o\x00' % mode, ARCHIVE_USTAR_ZERO, ARCHIVE_USTAR_ZERO,
+                                b'%011o\x00' % size, b'%011o\x00' % mtime, b' ' * 8, kind,
+                                linkname, b'ustar\x00', b'00', b'root', b'root',
+                                b'', b'', b'')
+    # The checksum is that of the header, with spaces in its place.
+    return header[:ARCHIVE_USTAR_CHKSUM] + b'%06o\x00 ' % sum(header) + header[ARCHIVE_USTAR_CHKSUM + 8:]
+
+def archive_tar(repo, entries, out, mtime, comment=None):
+    """Write entries, as archive_entries yields them, to out as a tar.
+    Blobs go out one chunk at a time, so that memory doesn't grow with
+    them.  comment, the SHA of the commit archived, goes in a pax
+    global header, where git get-tar-commit-id finds it."""
+    import tarfile
+
+    written = 0
+    def write(data):
+        nonlocal written
+        out.write(data)
+        written += len(data)
+
+    if comment:
+        write(tarfile.TarInfo.create_pax_global_header({ "comment" : comment }))
+
+    for path, mode, sha in entries:
+        size = 0
+        chunks = ()
+        linkname = b''
+        if sha is None:
+            kind = tarfile.DIRTYPE
+            perms = ARCHIVE_DIR_MODE
+        elif mode.startswith(b'12'):
+            # A symlink: the blob contents is the link target.
+            kind = tarfile.SYMTYPE
+            perms = ARCHIVE_LINK_MODE
+            linkname = b''.join(archive_blob(repo, sha)[1])
+        else:
+            kind = tarfile.REGTYPE
+            perms = ARCHIVE_EXEC_MODE if mode == b'100755' else ARCHIVE_FILE_MODE
+            size, chunks = archive_blob(repo, sha)
+
+        header = archive_tar_header(path, perms, size, mtime, kind, linkname)
+        if header is None:
+            # Names too long for the header, and non-ASCII ones, get a
+            # pax header of their own.
+            info = tarfile.TarInfo(path.decode("utf8", "surrogateescape"))
+            info.type = kind
+            info.mode = perms
+            info.size = size
+            info.mtime = mtime
+            info.linkname = linkname.decode("utf8", "surrogateescape")
+            info.uname = info.gname = "root"
+            header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+        write(header)
+        for chunk in chunks:
+            write(chunk)
+        if size % ARCHIVE_TAR_BLOCK:
+            write(b'\x00' * (ARCHIVE_TAR_BLOCK - size % ARCHIVE_TAR_BLOCK))
+
+    # Two empty blocks end the archive.
+    write(b'\x00' * 2 * ARCHIVE_TAR_BLOCK)
+    if written % ARCHIVE_TAR_RECORD:
+        write(b'\x00' * (ARCHIVE_TAR_RECORD - written % ARCHIVE_TAR_RECORD))
+
+def archive_zip(repo, entries, out, mtime):
+    """Write entries, as archive_entries yields them, to out as a zip.
+    out doesn't need to be seekable: sizes and checksums then follow
+    the data of each file."""
+    import zipfile
+
+    date_time = max(time.localtime(mtime)[0:6], ARCHIVE_ZIP_EPOCH)
+    with zipfile.ZipFile(out, "w") as z:
+        for path, mode, sha in entries:
+            info = zipfile.ZipInfo(path.decode("utf8", "replace"), date_time)
+            # Zip has no umask to apply: files keep the mode of their
+            # tree leaf.  The low byte holds the MS-DOS attributes, 0x10
+            # being a directory.
+            if sha is None:
+                info.external_attr = (0o040000 | ARCHIVE_ZIP_DIR_MODE) << 16 | 0x10
+                z.writestr(info, b'')
+                continue
+            if mode.startswith(b'12'):
+                info.external_attr = (0o120000 | ARCHIVE_LINK_MODE) << 16
+            else:
+                info.external_attr = int(mode, 8) << 16
+
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # Knowing the size first tells whether it needs zip64.
+            info.file_size, chunks = archive_blob(repo, sha)
+            with z.open(info, "w") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+
+def archive(repo, tree, out, fmt="tar", prefix="", mtime=None, comment=None):
+    """Write tree, a SHA, to the binary file out as an archive of
+    format fmt: tar, tar.gz (or tgz) or zip.  Every path starts with
+    prefix, and if it ends with a slash, the archive has that directory
+    too.  Files are dated mtime, by default now.  comment is the SHA of
+    the commit archived, if it is one."""
+    if mtime is None:
+        mtime = int(time.time())
+
+    prefix = prefix.encode("utf8")
+    def entries():
+        if prefix.endswith(b'/'):
+            yield prefix, b'40000', None
+        yield from archive_entries(repo, tree, prefix)
+
+    match fmt:
+        case "tar":
+            archive_tar(repo, entries(), out, mtime, comment)
+        case "tar.gz" | "tgz":
+            import gzip
+            # Like gzip -n: no name, and no date but that of the files.
+            with gzip.GzipFile(filename="", mode="wb", fileobj=out, compresslevel=ARCHIVE_GZIP_LEVEL, mtime=0) as gz:
+                archive_tar(repo, entries(), gz, mtime, comment)
+        case "zip":
+            archive_zip(repo, entries(), out, mtime)
+        case _:
+            raise Exception(f"Unknown archive format {fmt}.")
@@ -0,0 +1,519 @@
+import array
+import hashlib
+import os
+import struct
+import sys
+
+import GitDiff
+import GitObject
+import GitPack
+import GitTrace
+
+# Reachability bitmaps, in git's .bitmap format: for some commits of a
+# pack, the set of every object reachable from them, as a bitmap
+# whose bit N is the Nth object of the pack, in pack order.  Git only
+# reads them if they hold the whole history of their commits, which
+# the FULL_DAG flag says.
+BITMAP_MAGIC = b'BITM'
+BITMAP_VERSION = 1
+BITMAP_OPT_FULL_DAG = 0x1
+
+# After the header come a bitmap of the objects of each type, in this
+# order.
+BITMAP_TYPES = (b'commit', b'tree', b'blob', b'tag')
+
+# Bitmaps are written for the commits the refs point to, and then for
+# one commit every that many along first parents, so that a walk from
+# anywhere soon reaches one.
+BITMAP_COMMIT_INTERVAL = 100
+
+# Each bitmap may be stored XORed with one of the few written before
+# it, which is much smaller when they are about the same.
+BITMAP_XOR_WINDOW = 10
+
+# Bytes of objects the writer keeps, so that reading every tree of the
+# pack doesn't rebuild the same delta bases over and over.
+BITMAP_DELTA_CACHE = 64 * 1024 * 1024
+
+# An EWAH bitmap is a list of 64-bit words, made of running length
+# words each followed by literal words.  A running length word holds
+# the bit of a run of identical words in bit 0, its length in the next
+# 32 bits, and the number of literal words after it in the top 31.
+EWAH_ONES = 0xFFFFFFFFFFFFFFFF
+EWAH_RUN_MAX = 0xFFFFFFFF
+EWAH_LITERAL_MAX = 0x7FFFFFFF
+
+def ewah_decode(data, pos):
+    """Decode the EWAH bitmap at pos in data into an int whose bit N is
+    bit N of the bitmap.  Return it, and the position right after it."""
+    _, n = struct.unpack(">II", data[pos:pos + 8])
+    pos += 8
+    words = array.array("Q", data[pos:pos + 8*n])
+    if sys.byteorder == "little":
+        words.byteswap()
+    # The last word is the position of the last running length word,
+    # which only matters to append to the bitmap.
+    pos += 8*n + 4
+
+    out = array.array("Q")
+    i = 0
+    while i < n:
+        rlw = words[i]
+        run = (rlw >> 1) & EWAH_RUN_MAX
+        literals = rlw >> 33
+        if run:
+            out.frombytes((b'\xff' if rlw & 1 else b'\x00') * (8*run))
+        out.extend(words[i + 1:i + 1 + literals])
+        i += 1 + literals
+
+    if sys.byteorder == "big":
+        out.byteswap()
+    return int.from_bytes(out.tobytes(), "little"), pos
+
+def ewah_encode(bits):
+    """Encode bits, an int, as an EWAH bitmap."""
+    n = (bits.bit_length() + 63) // 64
+    words = array.array("Q", bits.to_bytes(8*n, "little"))
+    if sys.byteorder == "big":
+        words.byteswap()
+
+    out = array.array("Q", [0])
+    rlw = 0
+    for w in words:
+        head = out[rlw]
+        if w == 0 or w == EWAH_ONES:
+            # Words of all zeros or all ones extend the run of the
+            # current running length word, if no literal follows it
+            # yet and it's a run of the same bit.
+            bit = w & 1
+            run = (head >> 1) & EWAH_RUN_MAX
+            if head >> 33 == 0 and (run == 0 or head & 1 == bit) and run < EWAH_RUN_MAX:
+                out[rlw] = ((run + 1) << 1) | bit
+            else:
+                rlw = len(out)
+                out.append(2 | bit)
+        else:
+            if head >> 33 == EWAH_LITERAL_MAX:
+                rlw = len(out)
+                out.append(0)
+                head = 0
+            out[rlw] = head + (1 << 33)
+            out.append(w)
+
+    count = len(out)
+    if sys.byteorder == "little":
+        out.byteswap()
+    return struct.pack(">II", 64*n, count) + out.tobytes() + struct.pack(">I", rlw)
+
+def bitmap_positions(bits):
+    """Yield the positions of the bits set in bits, in order."""
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(data):
+        if byte:
+            for j in range(8):
+                if byte >> j & 1:
+                    yield 8*i + j
+
+def bitmap_mark(marks, pos):
+    """Set bit pos of marks, a bytearray, growing it if needed.  Return
+    whether it wasn't set yet."""
+    byte = pos >> 3
+    if byte >= len(marks):
+        marks.extend(bytes(byte + 1 - len(marks)))
+    bit = 1 << (pos & 7)
+    if marks[byte] & bit:
+        return False
+    marks[byte] |= bit
+    return True
+
+class GitBitmap(object):
+    """The reachability bitmaps of a pack, memory-mapped.  Bitmaps are
+    only decoded when asked for, and kept as Python ints, which OR and
+    AND at C speed.
+
+    Objects outside the pack can't be in its bitmaps, but walks meet
+    them: they are given the bits after those of the pack, as they
+    come."""
+
+    def __init__(self, pack):
+        self.pack = pack
+        path = pack.path + ".bitmap"
+        import mmap
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, flags, count = struct.unpack(">4sHHI", self.data[0:12])
+        if magic != BITMAP_MAGIC or version != BITMAP_VERSION or not flags & BITMAP_OPT_FULL_DAG:
+            raise Exception(f"Unsupported bitmap {path}")
+        if self.data[12:32] != pack.checksum():
+            raise Exception(f"Bitmap {path} doesn't match its pack")
+
+        pos = 32
+        self.types = dict()
+        for fmt in BITMAP_TYPES:
+            self.types[fmt], pos = ewah_decode(self.data, pos)
+
+        # Each entry is the position of its commit in the index, how
+        # many entries back is the bitmap it's XORed with (0 for none),
+        # flags, and the EWAH bitmap.  We only skip over the bitmaps
+        # for now.  Extensions may follow the entries: we don't need
+        # them.
+        self.commits = dict()
+        self.entries = list()
+        for i in range(count):
+            n, xor, _ = struct.unpack(">IBB", self.data[pos:pos + 6])
+            pos += 6
+            if xor > i:
+                raise Exception(f"Malformed bitmap {path}")
+            self.commits[pack.sha(n)] = i
+            self.entries.append((pos, xor))
+            words = struct.unpack(">I", self.data[pos + 4:pos + 8])[0]
+            pos += 12 + 8*words
+        self.decoded = dict()
+
+        self.positions = None
+        self.extended = list()
+        self.extended_positions = dict()
+
+    def bitmap(self, binsha):
+        """Return the bitmap of commit binsha, or None if it has none."""
+        i = self.commits.get(binsha)
+        if i is None:
+            return None
+
+        # Go back the chain of XORed bitmaps to a plain one, or one we
+        # already have, then decode them back up.
+        chain = list()
+        while i not in self.decoded:
+            chain.append(i)
+            xor = self.entries[i][1]
+            if not xor:
+                break
+            i -= xor
+        bits = self.decoded.get(i, 0)
+        for j in reversed(chain):
+            bits ^= ewah_decode(self.data, self.entries[j][0])[0]
+            self.decoded[j] = bits
+        if GitTrace.enabled:
+            GitTrace.count("bitmaps read")
+        return bits
+
+    def position(self, binsha, fmt=None):
+        """Return the bit of object binsha.  If it's not in the pack,
+        give it one after the pack's if fmt, its type, is known, or
+        return None."""
+        n = self.pack.index(binsha)
+        if n is not None:
+            if self.positions is None:
+                self.positions = [0] * self.pack.count
+                for p, n2 in enumerate(self.pack.order()):
+                    self.positions[n2] = p
+            return self.positions[n]
+
+        pos = self.extended_positions.get(binsha)
+        if pos is None and fmt is not None:
+            pos = self.pack.count + len(self.extended)
+            self.extended.append((binsha, fmt))
+            self.extended_positions[binsha] = pos
+        return pos
+
+    def objects(self, bits, fmt):
+        """Return the binary SHAs of the objects of type fmt in bits."""
+        order = self.pack.order()
+        ret = [ self.pack.sha(order[p]) for p in bitmap_positions(bits & self.types[fmt]) ]
+        for p in bitmap_positions(bits >> self.pack.count):
+            binsha, f = self.extended[p]
+            if f == fmt:
+                ret.append(binsha)
+        return ret
+
+def bitmap_open(repo):
+    """Return the GitBitmap of repo, or None if none of its packs has
+    one.  Like git, we only use the first we find."""
+    if repo.bitmap is None:
+        repo.bitmap = False
+        for pack in GitPack.pack_list(repo):
+            if os.path.isfile(pack.path + ".bitmap"):
+                repo.bitmap = GitBitmap(pack)
+                if GitTrace.enabled:
+                    GitTrace.count("files opened")
+                break
+    return repo.bitmap or None
+
+def tree_children(tree):
+    """Yield the (binsha, fmt) of what tree refers to.  Gitlinks are
+    commits of another repository, so they aren't ours to follow."""
+    for leaf in tree:
+        if leaf.mode == b'160000':
+            continue
+        yield leaf.binsha, b'tree' if GitDiff.diff_mode_is_tree(leaf.mode) else b'blob'
+
+def object_links(obj, objects):
+    """Return the (binsha, fmt) of what obj refers to, fmt being None if
+    we don't know it.  Unless objects, trees and blobs are left out."""
+    match obj.fmt:
+        case b'commit':
+            ret = [ (bytes.fromhex(p.decode("ascii")), b'commit') for p in obj.values(b'parent') ]
+            if objects:
+                ret.append((bytes.fromhex(obj.values(b'tree')[0].decode("ascii")), b'tree'))
+            return ret
+        case b'tag':
+            fmt = obj.values(b'type')[0]
+            if not objects and fmt not in (b'commit', b'tag'):
+                return []
+            return [ (bytes.fromhex(obj.values(b'object')[0].decode("ascii")), fmt) ]
+        case b'tree':
+            return list(tree_children(obj))
+    return []
+
+def reachable_walk(repo, roots, objects=True, stop=None):
+    """Walk every object reachable from roots, binary SHAs, without
+    going into those in stop.  Return a {binsha: fmt} dictionary.
+    Unless objects, trees and blobs are left out."""
+    found = dict()
+    todo = [ (sha, None) for sha in roots ]
+    while todo:
+        sha, fmt = todo.pop()
+        if sha in found or (stop and sha in stop):
+            continue
+        if fmt == b'blob':
+            # Blobs don't refer to anything, no need to read them.
+            found[sha] = fmt
+            continue
+        obj = GitObject.object_read(repo, sha.hex())
+        if obj is None:
+            raise Exception(f"Missing object {sha.hex()}")
+        found[sha] = obj.fmt
+        todo.extend(object_links(obj, objects))
+    return found
+
+def reachable_bitmap(repo, bitmap, roots, objects=True):
+    """Same as reachable_walk, but with the bitmaps of a pack: return
+    an int whose bits, as numbered by bitmap, are the objects
+    reachable from roots.
+
+    Everything reachable from a commit with a bitmap is in it, so we
+    only walk what's above such commits, and don't go into trees
+    already reachable from them."""
+
+    # First, walk commits down to those with bitmaps, which we OR
+    # together.  Roots with bitmaps come first: they may save walking
+    # the history of the others.
+    bits = 0
+    walk = list()
+    seen = set()
+    todo = sorted(((sha, None) for sha in roots), key=lambda r: r[0] in bitmap.commits)
+    while todo:
+        sha, fmt = todo.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        b = bitmap.bitmap(sha)
+        if b is not None:
+            bits |= b
+            continue
+        pos = bitmap.position(sha)
+        if pos is not None and bits >> pos & 1:
+            continue
+        if fmt in (b'tree', b'blob'):
+            walk.append((sha, fmt, None))
+            continue
+
+        obj = GitObject.object_read(repo, sha.hex())
+        if obj is None:
+            raise Exception(f"Missing object {sha.hex()}")
+        walk.append((sha, obj.fmt, obj))
+        if obj.fmt in (b'tree', b'blob'):
+            continue
+        for link in object_links(obj, objects):
+            if link[1] == b'commit' or link[1] == b'tag':
+                todo.append(link)
+            elif objects:
+                walk.append((link[0], link[1], None))
+
+    # Then mark what we walked, and the trees it refers to.
+    marks = bytearray(bits.to_bytes((bitmap.pack.count + 7) // 8, "little"))
+    for sha, fmt, obj in walk:
+        if not bitmap_mark(marks, bitmap.position(sha, fmt)) or fmt != b'tree':
+            continue
+        stack = [ obj or GitObject.object_read(repo, sha.hex()) ]
+        while stack:
+            for child, f in tree_children(stack.pop()):
+                if bitmap_mark(marks, bitmap.position(child, f)) and f == b'tree':
+                    stack.append(GitObject.object_read(repo, child.hex()))
+
+    return int.from_bytes(marks, "little")
+
+def reachable(repo, wants, haves=(), objects=True, use_bitmap=True):
+    """Find the objects reachable from wants but not from haves, both
+    lists of binary SHAs, with the bitmaps of repo if it has some and
+    use_bitmap, or by walking the objects otherwise.
+
+    Return a {fmt: [binsha]} dictionary, in BITMAP_TYPES order, with
+    only commits unless objects.  Objects are sorted by SHA, so that
+    the result is exactly the same whichever way it's found."""
+    fmts = BITMAP_TYPES if objects else (b'commit',)
+    bitmap = bitmap_open(repo) if use_bitmap else None
+
+    if bitmap:
+        with GitTrace.phase("reachability bitmaps"):
+            bits = reachable_bitmap(repo, bitmap, wants, objects)
+            if haves:
+                bits &= ~reachable_bitmap(repo, bitmap, haves, objects)
+            ret = { fmt: bitmap.objects(bits, fmt) for fmt in fmts }
+    else:
+        with GitTrace.phase("walk objects"):
+            stop = reachable_walk(repo, haves, objects) if haves else None
+            found = reachable_walk(repo, wants, objects, stop)
+            ret = { fmt: list() for fmt in fmts }
+            for sha, fmt in found.items():
+                if fmt in ret:
+                    ret[fmt].append(sha)
+
+    for shas in ret.values():
+        shas.sort()
+    return ret
+
+def bitmap_write(repo, pack, tips):
+    """Write the bitmaps of pack: for the commits tips, binary SHAs,
+    and for one every BITMAP_COMMIT_INTERVAL commits below them.  Only
+    commits whose whole history is in the pack can have one.  Return
+    the number of bitmaps written."""
+
+    order = pack.order()
+    positions = [0] * pack.count
+    for p, n in enumerate(order):
+        positions[n] = p
+
+    def position(binsha):
+        n = pack.index(binsha)
+        return None if n is None else positions[n]
+
+    cache = GitObject.GitObjectCache(BITMAP_DELTA_CACHE)
+    def read(binsha):
+        fmt, data = pack.read_at(repo, pack.offset(pack.index(binsha)), cache)
+        return GitObject.object_parse(binsha.hex(), fmt, data)
+
+    # The objects of each type.
+    types = { fmt: bytearray((pack.count + 7) // 8) for fmt in BITMAP_TYPES }
+    commits = dict()
+    with GitTrace.phase("read commits"):
+        for p, fmt in enumerate(pack.types(repo)):
+            types[fmt][p >> 3] |= 1 << (p & 7)
+            if fmt == b'commit':
+                sha = pack.sha(order[p])
+                commits[sha] = object_links(read(sha), True)
+
+    # Parents come before their children, so that each commit's bitmap
+    # is that of its parents plus what it adds.  Histories can be very
+    # deep, so we use an explicit stack rather than recursion.
+    topo = list()
+    done = set()
+    children = dict.fromkeys(commits, 0)
+    for sha in commits:
+        stack = [ sha ]
+        while stack:
+            cur = stack[-1]
+            if cur in done:
+                stack.pop()
+                continue
+            missing = [ p for p, f in commits[cur] if f == b'commit' and p in commits and p not in done ]
+            if missing:
+                stack.extend(missing)
+            else:
+                done.add(cur)
+                topo.append(cur)
+                stack.pop()
+                for p, f in commits[cur]:
+                    if f == b'commit' and p in children:
+                        children[p] += 1
+
+    # The bitmaps of commits whose children we haven't all seen yet,
+    # as bytearrays: None when a commit's history isn't all in the
+    # pack.  Bitmaps are mostly the same as that of the first parent,
+    # so the last child takes it over instead of copying it.
+    live = dict()
+    distance = dict()
+    entries = list()
+    recent = list()
+    with GitTrace.phase("compute bitmaps"):
+        for sha in topo:
+            parents = [ p for p, f in commits[sha] if f == b'commit' ]
+            marks = None
+            if all(live.get(p) is not None for p in parents):
+                if not parents:
+                    marks = bytearray((pack.count + 7) // 8)
+                elif children[parents[0]] == 1:
+                    marks = live[parents[0]]
+                else:
+                    marks = bytearray(live[parents[0]])
+                for p in parents[1:]:
+                    marks = bytearray((int.from_bytes(marks, "little") | int.from_bytes(live[p], "little"))
+                                      .to_bytes(len(marks), "little"))
+                if not bitmap_write_mark(read, marks, position, sha, commits[sha]):
+                    marks = None
+
+            for p in parents:
+                children[p] -= 1
+                if not children[p]:
+                    live.pop(p, None)
+            if children[sha]:
+                live[sha] = marks
+
+            d = distance[parents[0]] + 1 if parents and parents[0] in distance else 0
+            if marks is None or not (sha in tips or d >= BITMAP_COMMIT_INTERVAL):
+                distance[sha] = d
+                continue
+            distance[sha] = 0
+
+            # XOR with the recent bitmap closest to this one, if any is
+            # closer than nothing.
+            bits = int.from_bytes(marks, "little")
+            xor, base = 0, 0
+            best = bits.bit_count()
+            for i, other in enumerate(recent):
+                diff = (bits ^ other).bit_count()
+                if diff < best:
+                    xor, base, best = len(recent) - i, other, diff
+            entries.append(struct.pack(">IBB", pack.index(sha), xor, 0) + ewah_encode(bits ^ base))
+            recent.append(bits)
+            del recent[:-BITMAP_XOR_WINDOW]
+
+    out = bytearray(struct.pack(">4sHHI", BITMAP_MAGIC, BITMAP_VERSION, BITMAP_OPT_FULL_DAG, len(entries)))
+    out += pack.checksum()
+    for fmt in BITMAP_TYPES:
+        out += ewah_encode(int.from_bytes(types[fmt], "little"))
+    for entry in entries:
+        out += entry
+    out += hashlib.sha1(out).digest()
+
+    # Deferred, like mmap in GitBitmap: only bitmap writes need tempfile.
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix="tmp_bitmap_", dir=os.path.dirname(pack.path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(out)
+    os.replace(tmp, pack.path + ".bitmap")
+
+    repo.bitmap = None
+    return len(entries)
+
+def bitmap_write_mark(read, marks, position, sha, links):
+    """Mark commit sha, whose links are links, and the trees and blobs
+    it adds to the bitmap of its parents in marks.  Trees are read
+    with read.  Return False if one of them isn't in the pack."""
+    pos = position(sha)
+    marks[pos >> 3] |= 1 << (pos & 7)
+
+    stack = [ link for link in links if link[1] == b'tree' ]
+    while stack:
+        child, fmt = stack.pop()
+        pos = position(child)
+        if pos is None:
+            return False
+        if marks[pos >> 3] & (1 << (pos & 7)):
+            continue
+        marks[pos >> 3] |= 1 << (pos & 7)
+        if fmt == b'tree':
+            stack.extend(tree_children(read(child)))
+    return True
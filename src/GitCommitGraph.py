@@ -0,0 +1,349 @@
+import hashlib
+import mmap
+import os
+import struct
+
+import GitRepository
+import GitDiff
+import GitObject
+
+# Parent slot value for "no parent".
+GRAPH_PARENT_NONE = 0x70000000
+# In the second parent slot, this bit means the rest is an index into
+# the extra edges list, for merges of more than two parents.
+GRAPH_EXTRA_EDGES = 0x80000000
+# In the extra edges list, this bit marks the last parent.
+GRAPH_LAST_EDGE = 0x80000000
+
+# The generation number of commits we know nothing about, eg because
+# they were created after the graph was written.
+GENERATION_INFINITY = 0xFFFFFFFF
+
+class GitCommitGraph(object):
+    """A memory-mapped commit-graph file: the parents, root tree and
+    generation number of every commit, without having to inflate any
+    of them."""
+
+    count = 0
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, hash_version, chunks = struct.unpack(">4sBBBx", self.data[0:8])
+        if signature != b'CGPH' or version != 1 or hash_version != 1:
+            raise Exception(f"Unsupported commit-graph {path}")
+
+        # The table of contents lists (id, offset) pairs, followed by
+        # a terminating entry whose offset is the end of the last chunk.
+        self.chunks = dict()
+        for i in range(chunks):
+            cid, off = struct.unpack(">4sQ", self.data[8 + 12*i:20 + 12*i])
+            self.chunks[cid] = off
+
+        for cid in (b'OIDF', b'OIDL', b'CDAT'):
+            if cid not in self.chunks:
+                raise Exception(f"Commit-graph {path} has no {cid.decode('ascii')} chunk")
+
+        oidf = self.chunks[b'OIDF']
+        self.fanout = struct.unpack(">256I", self.data[oidf:oidf + 256*4])
+        self.count = self.fanout[255]
+        self.oidl = self.chunks[b'OIDL']
+        self.cdat = self.chunks[b'CDAT']
+        self.edge = self.chunks.get(b'EDGE')
+
+    def index(self, sha):
+        """Binary-search the graph for commit sha, return its position
+        or None."""
+        binsha = bytes.fromhex(sha)
+        lo = self.fanout[binsha[0] - 1] if binsha[0] else 0
+        hi = self.fanout[binsha[0]]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.oidl + 20*mid
+            cur = self.data[pos:pos + 20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def sha(self, n):
+        pos = self.oidl + 20*n
+        return self.data[pos:pos + 20].hex()
+
+    def tree(self, n):
+        pos = self.cdat + 36*n
+        return self.data[pos:pos + 20].hex()
+
+    def parents(self, n):
+        """Return the positions of the parents of the nth commit."""
+        pos = self.cdat + 36*n + 20
+        p1, p2 = struct.unpack(">II", self.data[pos:pos + 8])
+
+        ret = list()
+        if p1 == GRAPH_PARENT_NONE:
+            return ret
+        ret.append(p1)
+        if p2 == GRAPH_PARENT_NONE:
+            return ret
+        if not p2 & GRAPH_EXTRA_EDGES:
+            ret.append(p2)
+            return ret
+
+        # An octopus merge: the other parents are in the EDGE chunk.
+        pos = self.edge + 4*(p2 & ~GRAPH_EXTRA_EDGES)
+        while True:
+            p = struct.unpack(">I", self.data[pos:pos + 4])[0]
+            ret.append(p & ~GRAPH_LAST_EDGE)
+            if p & GRAPH_LAST_EDGE:
+                return ret
+            pos += 4
+
+    def generation(self, n):
+        pos = self.cdat + 36*n + 28
+        return struct.unpack(">I", self.data[pos:pos + 4])[0] >> 2
+
+    def commit_time(self, n):
+        pos = self.cdat + 36*n + 28
+        return struct.unpack(">Q", self.data[pos:pos + 8])[0] & 0x3FFFFFFFF
+
+def commit_graph(repo):
+    """Return the commit-graph of repo, or None if it has none."""
+    if repo.commit_graph is None:
+        path = GitRepository.repo_path(repo, "objects", "info", "commit-graph")
+        repo.commit_graph = GitCommitGraph(path) if os.path.isfile(path) else False
+    return repo.commit_graph or None
+
+def commit_parents(repo, sha):
+    """Return the parents of commit sha, from the commit-graph if it
+    has it, or from the commit itself."""
+    graph = commit_graph(repo)
+    if graph:
+        n = graph.index(sha)
+        if n is not None:
+            return [ graph.sha(p) for p in graph.parents(n) ]
+
+    commit = GitObject.object_read(repo, sha)
+    assert commit.fmt == b'commit'
+    return [ p.decode("ascii") for p in commit.values(b'parent') ]
+
+def commit_tree(repo, sha):
+    """Return the root tree of commit sha, from the commit-graph if it
+    has it, or from the commit itself."""
+    graph = commit_graph(repo)
+    if graph:
+        n = graph.index(sha)
+        if n is not None:
+            return graph.tree(n)
+
+    commit = GitObject.object_read(repo, sha)
+    assert commit.fmt == b'commit'
+    return commit.values(b'tree')[0].decode("ascii")
+
+def commit_generation(repo, sha):
+    """Return the generation number of commit sha, or
+    GENERATION_INFINITY if the commit-graph doesn't know it."""
+    graph = commit_graph(repo)
+    if graph:
+        n = graph.index(sha)
+        if n is not None:
+            return graph.generation(n)
+    return GENERATION_INFINITY
+
+def commit_is_ancestor(repo, ancestor, sha):
+    """Check whether commit ancestor is reachable from commit sha."""
+
+    # Every commit has a larger generation number than all of its
+    # ancestors, so there's no point walking down a commit whose
+    # generation is at most that of the one we're looking for.
+    target = commit_generation(repo, ancestor)
+    seen = set()
+    todo = [ sha ]
+    while todo:
+        cur = todo.pop()
+        if cur == ancestor:
+            return True
+        if cur in seen:
+            continue
+        seen.add(cur)
+        if target != GENERATION_INFINITY and commit_generation(repo, cur) <= target:
+            continue
+        todo.extend(commit_parents(repo, cur))
+    return False
+
+class GitPathHistory(object):
+    """The history of some paths, simplified the way git log -- paths
+    does by default.  A commit is TREESAME if the paths are the same
+    in one of its parents, or, for a root commit, if it doesn't have
+    them.  TREESAME commits are left out of the history, and a
+    TREESAME merge only leads to the first parent it is TREESAME to:
+    the others brought nothing to the paths, so their history isn't
+    even walked."""
+
+    def __init__(self, repo, paths):
+        self.repo = repo
+        self.diff = GitDiff.GitDiffPaths(repo, paths)
+        self.entries = dict()
+        # For each commit, whether it's TREESAME, and the parents its
+        # history goes on with.
+        self.simplified = dict()
+        # For each TREESAME commit, the first commit below it that
+        # isn't, or None.
+        self.rewritten = dict()
+
+    def commit_entries(self, sha):
+        ret = self.entries.get(sha)
+        if ret is None:
+            ret = self.entries[sha] = self.diff.entries(bytes.fromhex(commit_tree(self.repo, sha)))
+        return ret
+
+    def simplify(self, sha):
+        """Return whether commit sha is TREESAME, and the parents its
+        history goes on with."""
+        ret = self.simplified.get(sha)
+        if ret is not None:
+            return ret
+
+        parents = commit_parents(self.repo, sha)
+        entries = self.commit_entries(sha)
+        if not parents:
+            ret = (all(e is None for e in entries), parents)
+        else:
+            ret = (False, parents)
+            for p in parents:
+                if self.commit_entries(p) == entries:
+                    ret = (True, [ p ])
+                    break
+        self.simplified[sha] = ret
+        return ret
+
+    def rewrite(self, sha):
+        """Return the first commit from sha down its simplified history
+        that isn't TREESAME, or None."""
+        chain = list()
+        while sha is not None:
+            if sha in self.rewritten:
+                sha = self.rewritten[sha]
+                break
+            treesame, parents = self.simplify(sha)
+            if not treesame:
+                break
+            chain.append(sha)
+            sha = parents[0] if parents else None
+        # Long runs of TREESAME commits are often reached from several
+        # children: only go down each once.
+        for c in chain:
+            self.rewritten[c] = sha
+        return sha
+
+    def parents(self, sha):
+        """Return the parents of commit sha in the simplified history:
+        the first commits below each of its parents that aren't
+        TREESAME."""
+        ret = list()
+        for p in self.simplify(sha)[1]:
+            p = self.rewrite(p)
+            if p is not None and p not in ret:
+                ret.append(p)
+        return ret
+
+def commit_graph_write(repo, heads):
+    """Write a commit-graph holding every commit reachable from heads.
+    Return the number of commits it holds."""
+
+    # Read every reachable commit, once.
+    commits = dict()
+    todo = list(heads)
+    while todo:
+        sha = todo.pop()
+        if sha in commits:
+            continue
+        commit = GitObject.object_read(repo, sha)
+        assert commit.fmt == b'commit'
+
+        parents = [ p.decode("ascii") for p in commit.values(b'parent') ]
+
+        # The commit time is the next to last field of the committer
+        # line: "Name <email> 1700000000 +0100".
+        time = int(commit.values(b'committer')[0].split(b' ')[-2])
+
+        commits[sha] = (commit.values(b'tree')[0].decode("ascii"), parents, time)
+        todo.extend(parents)
+
+    # Generation numbers: 1 for roots, and one more than the largest
+    # of the parents otherwise.  Histories can be very deep, so we
+    # use an explicit stack rather than recursion.
+    generations = dict()
+    for sha in commits:
+        stack = [ sha ]
+        while stack:
+            cur = stack[-1]
+            if cur in generations:
+                stack.pop()
+                continue
+            missing = [ p for p in commits[cur][1] if p not in generations ]
+            if missing:
+                stack.extend(missing)
+            else:
+                generations[cur] = 1 + max((generations[p] for p in commits[cur][1]), default=0)
+                stack.pop()
+
+    order = sorted(commits)
+    positions = { sha: n for n, sha in enumerate(order) }
+
+    fanout = [0] * 256
+    for sha in order:
+        fanout[int(sha[0:2], 16)] += 1
+    oidf = bytearray()
+    total = 0
+    for n in fanout:
+        total += n
+        oidf += struct.pack(">I", total)
+
+    oidl = b''.join(bytes.fromhex(sha) for sha in order)
+
+    cdat = bytearray()
+    edge = bytearray()
+    for sha in order:
+        tree, parents, time = commits[sha]
+        parents = [ positions[p] for p in parents ]
+        p1 = parents[0] if len(parents) > 0 else GRAPH_PARENT_NONE
+        if len(parents) <= 2:
+            p2 = parents[1] if len(parents) == 2 else GRAPH_PARENT_NONE
+        else:
+            p2 = GRAPH_EXTRA_EDGES | (len(edge) // 4)
+            for p in parents[1:-1]:
+                edge += struct.pack(">I", p)
+            edge += struct.pack(">I", GRAPH_LAST_EDGE | parents[-1])
+        gen = min(generations[sha], 0x3FFFFFFF)
+        cdat += bytes.fromhex(tree)
+        cdat += struct.pack(">IIQ", p1, p2, (gen << 34) | (time & 0x3FFFFFFFF))
+
+    chunks = [ (b'OIDF', oidf), (b'OIDL', oidl), (b'CDAT', cdat) ]
+    if edge:
+        chunks.append((b'EDGE', edge))
+
+    out = bytearray(struct.pack(">4sBBBB", b'CGPH', 1, 1, len(chunks), 0))
+    off = 8 + 12 * (len(chunks) + 1)
+    for cid, data in chunks:
+        out += struct.pack(">4sQ", cid, off)
+        off += len(data)
+    out += struct.pack(">4sQ", b'\x00\x00\x00\x00', off)
+    for _, data in chunks:
+        out += data
+    out += hashlib.sha1(out).digest()
+
+    path = GitRepository.repo_dir(repo, "objects", "info", mkdir=True)
+    # Only writes need tempfile, which pulls in shutil and random.
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix="tmp_graph_", dir=path)
+    with os.fdopen(fd, "wb") as f:
+        f.write(out)
+    os.replace(tmp, os.path.join(path, "commit-graph"))
+
+    repo.commit_graph = None
+    return len(order)
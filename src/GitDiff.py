@@ -0,0 +1,216 @@
+import stat
+
+import GitObject
+import GitPack
+
+# The SHA and mode of the missing side of an addition or a deletion.
+DIFF_NULL_SHA = b'\x00' * 20
+DIFF_NULL_MODE = b'000000'
+
+# Bytes of delta bases kept, per pack, by GitDiffPaths: the root trees
+# of successive commits are usually deltas of each other, and rebuilding
+# each from the start of its chain would dwarf everything else.
+DIFF_DELTA_CACHE = 16 * 1024 * 1024
+
+class GitDiffEntry(object):
+    """One path that differs between two trees.  status is one of
+    A (added), D (deleted), M (modified), T (type changed, eg a file
+    became a symlink) or R (renamed, from old_path)."""
+
+    __slots__ = ("status", "old_mode", "new_mode", "old_sha", "new_sha",
+                 "old_path", "path")
+
+    def __init__(self, status, old_mode, new_mode, old_sha, new_sha, path, old_path=None):
+        self.status = status
+        self.old_mode = old_mode
+        self.new_mode = new_mode
+        # Binary SHAs, like tree leaves.
+        self.old_sha = old_sha
+        self.new_sha = new_sha
+        # Full paths, as bytes.
+        self.path = path
+        self.old_path = old_path if old_path is not None else path
+
+    def __repr__(self):
+        return f"<GitDiffEntry {self.status} {self.path}>"
+
+def diff_mode_is_tree(mode):
+    return mode.startswith(b'04')
+
+def diff_mode_type(mode):
+    """Return the S_IFMT part of a tree leaf mode, to tell files,
+    symlinks, gitlinks and trees apart."""
+    return stat.S_IFMT(int(mode, 8))
+
+class GitDiffPaths(object):
+    """Tell what some paths are in trees, to compare trees only there.
+    Lookups only descend along the paths, and are remembered by tree
+    SHA: the trees most commits share with their parents are only read
+    once, and comparing a commit that didn't touch the paths with its
+    parent takes a few dictionary lookups."""
+
+    def __init__(self, repo, paths):
+        self.repo = repo
+        # Each path as a tuple of its components, () being the whole
+        # tree.
+        self.paths = [ tuple(p.encode("utf8").split(b'/')) if p else () for p in paths ]
+        self.memo = dict()
+        self.caches = dict()
+
+    def tree(self, binsha):
+        for pack in GitPack.pack_list(self.repo):
+            n = pack.index(binsha)
+            if n is not None:
+                cache = self.caches.get(pack.path)
+                if cache is None:
+                    cache = self.caches[pack.path] = GitObject.GitObjectCache(DIFF_DELTA_CACHE)
+                fmt, data = pack.read_at(self.repo, pack.offset(n), cache)
+                assert fmt == b'tree'
+                return GitObject.GitTree(data)
+        return GitObject.object_read(self.repo, binsha.hex())
+
+    def entries(self, tree):
+        """Return the (mode, binsha) of each path in tree, a binary SHA,
+        or None for those it doesn't have."""
+        return tuple(self.entry(tree, path) for path in self.paths)
+
+    def entry(self, tree, path):
+        if not path:
+            return (b'040000', tree)
+        key = (tree, path)
+        if key in self.memo:
+            return self.memo[key]
+
+        leaf = self.tree(tree).find(path[0])
+        if leaf is None:
+            ret = None
+        elif len(path) == 1:
+            ret = (leaf.mode, leaf.binsha)
+        elif diff_mode_is_tree(leaf.mode):
+            ret = self.entry(leaf.binsha, path[1:])
+        else:
+            ret = None
+        self.memo[key] = ret
+        return ret
+
+def diff_tree_leaves(repo, sha):
+    """Return the leaves of tree sha, a binary SHA, each with its sort
+    key.  A missing side (sha None) is an empty tree."""
+    if sha is None:
+        return []
+    tree = GitObject.object_read(repo, sha.hex())
+    assert tree.fmt == b'tree'
+    return [ (GitObject.tree_leaf_sort_key(leaf), leaf) for leaf in tree ]
+
+def diff_tree(repo, old, new, recursive=True, prefix=b""):
+    """Yield a GitDiffEntry for every path that differs between trees
+    old and new, binary SHAs (either may be None), in tree order.
+
+    Both trees are walked side by side, in their common sort order,
+    and subtrees with the same SHA on both sides are skipped without
+    being read: the work done is proportional to the size of the
+    change, not to the size of the trees.  If recursive is False,
+    changed subtrees are reported as such instead of descended."""
+
+    a = diff_tree_leaves(repo, old)
+    b = diff_tree_leaves(repo, new)
+    i = j = 0
+    while i < len(a) or j < len(b):
+        # Pick whichever side has the smallest name; a name that is
+        # a file on one side and a tree on the other sorts differently
+        # on each (the tree has a trailing slash), so that's a deletion
+        # and an addition, like git does.
+        if j >= len(b) or (i < len(a) and a[i][0] < b[j][0]):
+            leaf = a[i][1]
+            i += 1
+            yield from diff_tree_one(repo, leaf, None, prefix + leaf.name, recursive)
+        elif i >= len(a) or b[j][0] < a[i][0]:
+            leaf = b[j][1]
+            j += 1
+            yield from diff_tree_one(repo, None, leaf, prefix + leaf.name, recursive)
+        else:
+            old_leaf = a[i][1]
+            new_leaf = b[j][1]
+            i += 1
+            j += 1
+            # Same entry on both sides: nothing below it can differ.
+            if old_leaf.binsha == new_leaf.binsha and old_leaf.mode == new_leaf.mode:
+                continue
+            yield from diff_tree_one(repo, old_leaf, new_leaf, prefix + old_leaf.name, recursive)
+
+def diff_tree_one(repo, old, new, path, recursive):
+    """Report the differences between leaves old and new, either of
+    which may be None, at path."""
+    old_tree = old is not None and diff_mode_is_tree(old.mode)
+    new_tree = new is not None and diff_mode_is_tree(new.mode)
+
+    if recursive and (old_tree or new_tree):
+        yield from diff_tree(repo,
+                             old.binsha if old_tree else None,
+                             new.binsha if new_tree else None,
+                             recursive, path + b'/')
+        return
+
+    if old is None:
+        yield GitDiffEntry("A", DIFF_NULL_MODE, new.mode, DIFF_NULL_SHA, new.binsha, path)
+    elif new is None:
+        yield GitDiffEntry("D", old.mode, DIFF_NULL_MODE, old.binsha, DIFF_NULL_SHA, path)
+    else:
+        status = "M" if diff_mode_type(old.mode) == diff_mode_type(new.mode) else "T"
+        yield GitDiffEntry(status, old.mode, new.mode, old.binsha, new.binsha, path)
+
+def diff_basename(path):
+    return path[path.rfind(b'/') + 1:]
+
+def diff_renames(changes):
+    """Pair deleted and added paths whose contents are identical into
+    renames, and return the new list of changes.
+
+    Only exact renames are found: blobs are matched by SHA, so no blob
+    is ever read.  Like git, a deleted path is only used once, a source
+    with the same file name is preferred, and symlinks and gitlinks
+    must keep their mode."""
+
+    sources = dict()
+    for n, change in enumerate(changes):
+        if change.status == "D":
+            sources.setdefault(change.old_sha, []).append(n)
+    if not sources:
+        return changes
+
+    renamed = dict() # Index of the addition => index of its source
+    used = set()
+    for n, change in enumerate(changes):
+        if change.status != "A" or change.new_sha not in sources:
+            continue
+        best = None
+        for s in sources[change.new_sha]:
+            if s in used:
+                continue
+            src = changes[s]
+            if not (stat.S_ISREG(diff_mode_type(src.old_mode))
+                    and stat.S_ISREG(diff_mode_type(change.new_mode))) \
+               and src.old_mode != change.new_mode:
+                continue
+            if best is None:
+                best = s
+            if diff_basename(src.path) == diff_basename(change.path):
+                best = s
+                break
+        if best is not None:
+            renamed[n] = best
+            used.add(best)
+
+    # Renames take the place of their addition, and their deletion
+    # goes away.
+    ret = list()
+    for n, change in enumerate(changes):
+        if n in used:
+            continue
+        if n in renamed:
+            src = changes[renamed[n]]
+            change = GitDiffEntry("R", src.old_mode, change.new_mode,
+                                  src.old_sha, change.new_sha,
+                                  change.path, src.path)
+        ret.append(change)
+    return ret
@@ -0,0 +1,264 @@
+import collections
+import hashlib
+import os
+
+import GitIndex
+import GitObject
+import GitPack
+import GitRefs
+import GitRepository
+import GitTrace
+
+# Workers send back the links of each object as bytes: for each object
+# it refers to, the index of its type in FSCK_TYPES, then its binary
+# SHA.  That's much cheaper to pickle than tuples.
+FSCK_TYPES = (b'blob', b'tree', b'commit', b'tag')
+FSCK_TYPE_INDEX = { fmt: i for i, fmt in enumerate(FSCK_TYPES) }
+
+# Objects checked by each task sent to the pool.
+FSCK_CHUNK = 256
+
+# Bytes of delta bases each worker keeps, per pack, so that packed
+# objects don't rebuild their whole delta chain each.
+FSCK_DELTA_CACHE = 64 * 1024 * 1024
+
+# In each worker process, the repository and delta caches, opened by
+# the first task that needs them.
+FSCK_REPOS = dict()
+FSCK_CACHES = dict()
+
+def fsck_repo(worktree):
+    repo = FSCK_REPOS.get(worktree)
+    if repo is None:
+        repo = FSCK_REPOS[worktree] = GitRepository.GitRepository(worktree)
+    return repo
+
+def fsck_link(links, fmt, sha):
+    """Add the link to object sha (a binary SHA) of type fmt."""
+    links.append(FSCK_TYPE_INDEX[fmt])
+    links += sha
+
+def fsck_check(sha, fmt, data):
+    """Check object sha (a binary SHA) of type fmt, whose data is data.
+    Return an error message, or None, and the links of the object."""
+
+    h = hashlib.sha1(fmt + b' ' + str(len(data)).encode() + b'\x00')
+    h.update(data)
+    if h.digest() != sha:
+        return f"hash mismatch, the data hashes to {h.hexdigest()}", b''
+
+    links = bytearray()
+    match fmt:
+        case b'blob':
+            pass
+        case b'commit':
+            commit = GitObject.GitCommit(data)
+            trees = commit.values(b'tree')
+            if len(trees) != 1:
+                return "commit without exactly one tree", b''
+            fsck_link(links, b'tree', bytes.fromhex(trees[0].decode("ascii")))
+            for p in commit.values(b'parent'):
+                fsck_link(links, b'commit', bytes.fromhex(p.decode("ascii")))
+        case b'tag':
+            tag = GitObject.GitTag(data)
+            objects = tag.values(b'object')
+            types = tag.values(b'type')
+            if len(objects) != 1 or len(types) != 1 or types[0] not in FSCK_TYPE_INDEX:
+                return "tag without exactly one object and type", b''
+            fsck_link(links, types[0], bytes.fromhex(objects[0].decode("ascii")))
+        case b'tree':
+            fsck_tree_links(data, links)
+        case _:
+            return f"unknown type {fmt.decode('ascii', 'replace')}", b''
+
+    return None, bytes(links)
+
+def fsck_tree_links(raw, links):
+    """Add the links of the tree whose data is raw to links.  Trees are
+    most of the links of a repository, so this reads raw directly
+    rather than building leaves we'd throw away."""
+    blob = FSCK_TYPE_INDEX[b'blob']
+    tree = FSCK_TYPE_INDEX[b'tree']
+    pos = 0
+    end = len(raw)
+    while pos < end:
+        x = raw.find(b' ', pos)
+        y = raw.find(b'\x00', x + 1)
+        if not (5 <= x - pos <= 6) or y < 0 or y + 21 > end:
+            raise Exception(f"malformed tree entry at offset {pos}")
+        mode = raw[pos:x]
+        # Gitlinks are commits of another repository.
+        if mode != b'160000':
+            links.append(tree if mode == b'40000' or mode == b'040000' else blob)
+            links += raw[y + 1:y + 21]
+        pos = y + 21
+
+# The tasks below run in the pool.  Each returns a list of (what,
+# error, links): what is the binary SHA of an object, and links the
+# bytes of its links, or what is the name of a file and links None.
+
+def fsck_loose(worktree, shas):
+    """Check the loose objects shas."""
+    repo = fsck_repo(worktree)
+    results = list()
+    for sha in shas:
+        binsha = bytes.fromhex(sha)
+        try:
+            path = os.path.join(repo.gitdir, "objects", sha[0:2], sha[2:])
+            fmt, data = GitObject.object_loose_read(path)
+            error, links = fsck_check(binsha, fmt, data)
+        except Exception as e:
+            error, links = str(e) or type(e).__name__, b''
+        results.append((binsha, error, links))
+    return results
+
+def fsck_packed(worktree, path, ns):
+    """Check objects ns, by their position in the index, of the pack
+    at path."""
+    repo = fsck_repo(worktree)
+    pack = next(p for p in GitPack.pack_list(repo) if p.path == path)
+    cache = FSCK_CACHES.get(path)
+    if cache is None:
+        cache = FSCK_CACHES[path] = GitObject.GitObjectCache(FSCK_DELTA_CACHE)
+
+    results = list()
+    for n in ns:
+        binsha = pack.sha(n)
+        try:
+            fmt, data = pack.read_at(repo, pack.offset(n), cache)
+            error, links = fsck_check(binsha, fmt, data)
+        except Exception as e:
+            error, links = str(e) or type(e).__name__, b''
+        results.append((binsha, error, links))
+    return results
+
+def fsck_file_checksum(path):
+    """Return whether the SHA-1 at the end of file path is that of the
+    rest of it, as for packs and their indexes, and that SHA-1."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        left = os.fstat(f.fileno()).st_size - 20
+        while left > 0:
+            data = f.read(min(left, GitObject.OBJECT_CHUNK_SIZE))
+            if not data:
+                break
+            h.update(data)
+            left -= len(data)
+        checksum = f.read(20)
+    return h.digest() == checksum, checksum
+
+def fsck_pack_files(path):
+    """Check the checksums of the pack at path, and of its index."""
+    results = list()
+    ok, checksum = fsck_file_checksum(path + ".pack")
+    if not ok:
+        results.append((path + ".pack", "pack checksum mismatch", None))
+    ok, _ = fsck_file_checksum(path + ".idx")
+    if not ok:
+        results.append((path + ".idx", "index checksum mismatch", None))
+    with open(path + ".idx", "rb") as f:
+        f.seek(-40, os.SEEK_END)
+        if f.read(20) != checksum:
+            results.append((path + ".idx", "index doesn't match its pack", None))
+    return results
+
+def fsck_tasks(repo):
+    """Yield the tasks checking every object of repo, as (function,
+    *args) tuples."""
+    worktree = repo.worktree
+    packs = GitPack.pack_list(repo)
+
+    for pack in packs:
+        yield fsck_pack_files, pack.path
+
+    chunk = list()
+    for sha in GitObject.object_loose_list(repo):
+        chunk.append(sha)
+        if len(chunk) == FSCK_CHUNK:
+            yield fsck_loose, worktree, chunk
+            chunk = list()
+    if chunk:
+        yield fsck_loose, worktree, chunk
+
+    # In pack order, so that bases are usually still in the delta
+    # cache when their deltas come.
+    for pack in packs:
+        ns = pack.order()
+        for i in range(0, len(ns), FSCK_CHUNK):
+            yield fsck_packed, worktree, pack.path, ns[i:i + FSCK_CHUNK]
+
+def fsck_run(tasks, jobs):
+    """Run tasks in a pool of jobs processes, yielding their results in
+    order.  Only a bounded number of them is in flight, so that results
+    stream out of huge repositories without queueing all of them."""
+    if jobs <= 1:
+        for f, *args in tasks:
+            yield f(*args)
+        return
+
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque()
+        for f, *args in tasks:
+            pending.append(pool.submit(f, *args))
+            if len(pending) >= 4 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def fsck_roots(repo):
+    """Return the (name, sha) of what refers to objects from outside
+    them: HEAD, the refs and the index."""
+    roots = list()
+    head = GitRefs.ref_resolve(repo, "HEAD")
+    if head:
+        roots.append(("HEAD", head))
+    roots.extend(GitRefs.ref_list(repo))
+    index = GitIndex.index_read(repo)
+    for e in index.entries:
+        if e.mode_type != 0b1110:
+            roots.append((f"index entry {e.name}", e.sha))
+    return roots
+
+def fsck(repo, jobs=None, dangling=True):
+    """Check the integrity of every object of repo: that it hashes to
+    its SHA, and that what it refers to exists.  Yield (kind, message)
+    pairs, as soon as they are found: kind is "error" for broken
+    objects and files, "missing" for objects referred to but nowhere to
+    be found, and "dangling" for objects nothing refers to."""
+
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    # Binary SHAs of the objects we have, and of those they refer to,
+    # with the index of their type.
+    present = set()
+    referenced = dict()
+
+    with GitTrace.phase("check objects"):
+        for results in fsck_run(fsck_tasks(repo), jobs):
+            for what, error, links in results:
+                if links is None:
+                    yield "error", f"{what}: {error}"
+                    continue
+                present.add(what)
+                if error:
+                    yield "error", f"{what.hex()}: {error}"
+                for i in range(0, len(links), 21):
+                    referenced.setdefault(links[i + 1:i + 21], links[i])
+
+    with GitTrace.phase("check connectivity"):
+        roots = set()
+        for name, sha in fsck_roots(repo):
+            binsha = bytes.fromhex(sha)
+            roots.add(binsha)
+            if binsha not in present:
+                yield "error", f"{name}: invalid sha1 pointer {sha}"
+
+        for sha in sorted(referenced.keys() - present):
+            yield "missing", f"missing {FSCK_TYPES[referenced[sha]].decode('ascii')} {sha.hex()}"
+
+        if dangling:
+            for sha in sorted(present - referenced.keys() - roots):
+                fmt, _ = GitObject.object_read_header(repo, sha.hex())
+                yield "dangling", f"dangling {fmt.decode('ascii')} {sha.hex()}"
@@ -0,0 +1,183 @@
+import os
+import re
+
+import GitRepository
+
+class GitIgnoreRule(object):
+    """A line of a .gitignore or info/exclude file."""
+    __slots__ = ("source", "line", "pattern", "negated", "dir_only", "regex")
+
+    def __init__(self, source, line, pattern, negated, dir_only, regex):
+        # Where the rule comes from, for check-ignore -v.
+        self.source = source
+        self.line = line
+        self.pattern = pattern
+        # A rule starting with ! re-includes what it matches.
+        self.negated = negated
+        # A rule ending with / only matches directories.
+        self.dir_only = dir_only
+        # What it matches, as a regular expression on paths relative
+        # to the worktree.
+        self.regex = regex
+
+def ignore_glob(glob):
+    """Translate glob, a gitignore pattern without its leading ! and
+    leading and trailing slashes, into a regular expression.  Wildcards
+    don't match slashes, except for ** as a whole path component."""
+    out = list()
+    i = 0
+    n = len(glob)
+    while i < n:
+        c = glob[i]
+        if c == "*":
+            if glob.startswith("**", i) and (i == 0 or glob[i - 1] == "/") and (i + 2 == n or glob[i + 2] == "/"):
+                if i + 2 == n:
+                    # A trailing /** matches everything inside.
+                    out.append(".*")
+                    i += 2
+                else:
+                    # **/ matches zero or more directories.
+                    out.append("(?:.*/)?")
+                    i += 3
+                continue
+            while i < n and glob[i] == "*":
+                i += 1
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = i + 1
+            if j < n and glob[j] in "!^":
+                j += 1
+            if j < n and glob[j] == "]":
+                j += 1
+            while j < n and glob[j] != "]":
+                j += 1
+            if j == n:
+                # No closing bracket: it's a plain [.
+                out.append(re.escape(c))
+                i += 1
+                continue
+            chars = glob[i + 1:j]
+            negated = chars[0] in "!^"
+            if negated:
+                chars = chars[1:]
+            chars = "".join("\\" + x if x in "\\[]^&~|" else x for x in chars)
+            out.append(f"[^/{chars}]" if negated else f"[{chars}]")
+            i = j + 1
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(glob[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+def ignore_parse(lines, source, base=""):
+    """Parse the lines of a gitignore file source, which lives in
+    directory base of the worktree ("" for its top, or "dir/").
+    Return a list of GitIgnoreRule."""
+    rules = list()
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\n").rstrip("\r")
+        # Trailing spaces don't count, unless escaped.
+        while line.endswith(" ") and not line.endswith("\\ "):
+            line = line[:-1]
+        if not line or line.startswith("#"):
+            continue
+
+        pattern = line
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        if dir_only:
+            line = line[:-1]
+        if not line:
+            continue
+
+        # A pattern with a slash but at its end is relative to the
+        # directory of its file.  Otherwise, it matches names at any
+        # depth below it.
+        if "/" in line:
+            regex = re.escape(base) + ignore_glob(line.lstrip("/"))
+        else:
+            regex = re.escape(base) + "(?:.*/)?" + ignore_glob(line)
+        rules.append(GitIgnoreRule(source, number, pattern, negated, dir_only, regex))
+    return rules
+
+class GitIgnore(object):
+    """The ignore rules applying to the entries of a directory: those of
+    info/exclude, then those of the .gitignore of each directory from
+    the top of the worktree down to it.  The last rule that matches a
+    path decides.
+
+    All of them are compiled into a single regular expression, with
+    the rules in reverse order: the first alternative that matches is
+    the last rule that does, and its group tells which it is.  There
+    is a second one, without the rules that only match directories,
+    for files."""
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self.files = self.compile([ r for r in self.rules if not r.dir_only ])
+        self.dirs = self.compile(self.rules)
+
+    @staticmethod
+    def compile(rules):
+        if not rules:
+            return None
+        rules = rules[::-1]
+        return rules, re.compile("|".join(f"({r.regex})" for r in rules), re.DOTALL)
+
+    def child(self, rules):
+        """Return the rules of a subdirectory, which adds rules."""
+        return GitIgnore(self.rules + rules) if rules else self
+
+    def match(self, path, is_dir):
+        """Return the rule deciding whether path, relative to the
+        worktree, is ignored, or None if no rule matches it."""
+        compiled = self.dirs if is_dir else self.files
+        if compiled is None:
+            return None
+        m = compiled[1].fullmatch(path)
+        return compiled[0][m.lastindex - 1] if m else None
+
+    def ignored(self, path, is_dir):
+        rule = self.match(path, is_dir)
+        return rule is not None and not rule.negated
+
+def ignore_read(repo, base):
+    """Return the rules of the .gitignore of directory base of the
+    worktree ("" or "dir/"), if it has one."""
+    source = base + ".gitignore"
+    try:
+        with open(os.path.join(repo.worktree, source), "r", encoding="utf8", errors="surrogateescape") as f:
+            return ignore_parse(f, source, base)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return []
+
+def ignore_root(repo):
+    """Return the rules applying everywhere in the worktree: those of
+    info/exclude."""
+    path = GitRepository.repo_path(repo, "info", "exclude")
+    if not os.path.isfile(path):
+        return GitIgnore()
+    with open(path, "r", encoding="utf8", errors="surrogateescape") as f:
+        return GitIgnore(ignore_parse(f, os.path.relpath(path, repo.worktree)))
+
+def ignore_path(repo, path, is_dir):
+    """Return the rule deciding whether path, relative to the worktree,
+    is ignored, or None.  Everything inside an ignored directory is
+    ignored, whatever the rules below it say."""
+    ignore = ignore_root(repo)
+    base = ""
+    parts = path.split("/")
+    for part in parts[:-1]:
+        ignore = ignore.child(ignore_read(repo, base))
+        rule = ignore.match(base + part, True)
+        if rule is not None and not rule.negated:
+            return rule
+        base += part + "/"
+    return ignore.child(ignore_read(repo, base)).match(path, is_dir)
@@ -0,0 +1,313 @@
+import hashlib
+import os
+import stat
+import struct
+
+import GitRepository
+import GitTrace
+
+class GitIndexEntry(object):
+    def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
+                 mode_type=None, mode_perms=None, uid=None, gid=None,
+                 fsize=None, sha=None, flag_assume_valid=None,
+                 flag_stage=None, flag_skip_worktree=False,
+                 flag_intent_to_add=False, name=None):
+        # The last time a file's metadata changed.  This is a pair
+        # (timestamp in seconds, nanoseconds)
+        self.ctime = ctime
+        # The last time a file's data changed.  This is a pair
+        # (timestamp in seconds, nanoseconds)
+        self.mtime = mtime
+        # The ID of device containing this file
+        self.dev = dev
+        # The file's inode number
+        self.ino = ino
+        # The object type, either b1000 (regular), b1010 (symlink),
+        # b1110 (gitlink).
+        self.mode_type = mode_type
+        # The object permissions, an integer.
+        self.mode_perms = mode_perms
+        # User ID of owner
+        self.uid = uid
+        # Group ID of owner
+        self.gid = gid
+        # Size of this object, in bytes
+        self.fsize = fsize
+        # The object's SHA
+        self.sha = sha
+        self.flag_assume_valid = flag_assume_valid
+        self.flag_stage = flag_stage
+        # Extended flags, only found in version 3 indexes.
+        self.flag_skip_worktree = flag_skip_worktree
+        self.flag_intent_to_add = flag_intent_to_add
+        # Name of the object (full path this time!)
+        self.name = name
+
+class GitIndex(object):
+    version = None
+    entries = []
+    # The modification time of the index file when we read it, in
+    # nanoseconds.  Entries whose file changed at or after that time
+    # are "racily clean": their stat data can't be trusted.
+    mtime = None
+
+    def __init__(self, version=2, entries=None, mtime=None):
+        if not entries:
+            entries = list()
+
+        self.version = version
+        self.entries = entries
+        self.mtime = mtime
+
+def index_read(repo):
+    index_file = GitRepository.repo_file(repo, "index")
+
+    # New repositories have no index!
+    if not (index_file and os.path.exists(index_file)):
+        return GitIndex()
+
+    with open(index_file, 'rb') as f:
+        raw = f.read()
+        mtime = os.fstat(f.fileno()).st_mtime_ns
+    if GitTrace.enabled:
+        GitTrace.count("files opened")
+        GitTrace.count("bytes read", len(raw))
+
+    if hashlib.sha1(raw[:-20]).digest() != raw[-20:]:
+        raise Exception("Bad index file checksum")
+
+    header = raw[:12]
+    signature = header[:4]
+    assert signature == b"DIRC" # Stands for "DirCache"
+    version = int.from_bytes(header[4:8], "big")
+    if version not in (2, 3):
+        raise Exception(f"Unsupported index version {version}")
+    count = int.from_bytes(header[8:12], "big")
+
+    entries = list()
+
+    content = memoryview(raw)
+    idx = 12
+    # Walk over entries
+    for i in range(0, count):
+        entry_start = idx
+
+        # All the fixed-size fields, in one go: ctime and mtime (as
+        # seconds and nanoseconds), dev, ino, mode, uid, gid, size,
+        # the SHA and the flags.
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid,
+         fsize, sha, flags) = struct.unpack_from(">10I20sH", content, idx)
+        idx += 62
+
+        # The mode is 16 bits of padding, then the type and the
+        # permissions.
+        mode_type = (mode >> 12) & 0b1111
+        assert mode_type in [0b1000, 0b1010, 0b1110]
+        mode_perms = mode & 0b0000000111111111
+
+        # Read flags
+        flag_assume_valid = (flags & 0b1000000000000000) != 0
+        flag_extended = (flags & 0b0100000000000000) != 0
+        flag_stage = (flags & 0b0011000000000000) >> 12
+        # Length of the name.  This is stored on 12 bits, so max
+        # value is 0xFFF, 4095.  Since names can occasionally go
+        # beyond that length, git treats 0xFFF as meaning at least
+        # 0xFFF, and looks for the final 0x00 to find the end of the
+        # name --- at a small, and probably very rare, performance
+        # cost.
+        name_length = flags & 0b0000111111111111
+
+        # Version 3 adds a second word of flags to extended entries.
+        flag_skip_worktree = False
+        flag_intent_to_add = False
+        if flag_extended:
+            if version < 3:
+                raise Exception("Extended index entry in a version 2 index")
+            extra = int.from_bytes(content[idx:idx+2], "big")
+            flag_skip_worktree = (extra & 0b0100000000000000) != 0
+            flag_intent_to_add = (extra & 0b0010000000000000) != 0
+            idx += 2
+
+        # We've read 62 bytes so far (64 with extended flags).
+        if name_length < 0xFFF:
+            assert content[idx + name_length] == 0x00
+            raw_name = bytes(content[idx:idx+name_length])
+            idx += name_length
+        else:
+            null_idx = raw.find(b'\x00', idx + 0xFFF)
+            raw_name = raw[idx:null_idx]
+            idx = null_idx
+
+        # Just parse the name as utf8.
+        name = raw_name.decode("utf8")
+
+        # The name is followed by one to eight NUL bytes, so that
+        # every entry is a multiple of eight bytes long.
+        idx = entry_start + ((idx - entry_start + 8) & ~7)
+
+        # And we add this entry to our list.
+        entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
+                                     mtime=(mtime_s,  mtime_ns),
+                                     dev=dev,
+                                     ino=ino,
+                                     mode_type=mode_type,
+                                     mode_perms=mode_perms,
+                                     uid=uid,
+                                     gid=gid,
+                                     fsize=fsize,
+                                     sha=sha.hex(),
+                                     flag_assume_valid=flag_assume_valid,
+                                     flag_stage=flag_stage,
+                                     flag_skip_worktree=flag_skip_worktree,
+                                     flag_intent_to_add=flag_intent_to_add,
+                                     name=name))
+
+    # What follows is a list of extensions.  We don't use any of them,
+    # but an extension with a lowercase signature must be understood
+    # to read the index correctly, so we refuse those.
+    end = len(raw) - 20
+    while idx < end:
+        ext = bytes(content[idx:idx+4])
+        if not (b'A' <= ext[0:1] <= b'Z'):
+            raise Exception(f"Unsupported index extension {ext.decode('ascii', 'replace')}")
+        idx += 8 + int.from_bytes(content[idx+4:idx+8], "big")
+
+    return GitIndex(version=version, entries=entries, mtime=mtime)
+
+def index_write(repo, index):
+    # Git keeps entries sorted by name, as bytes.
+    index.entries.sort(key=lambda e: (e.name.encode("utf8"), e.flag_stage or 0))
+
+    # Version 3 is only needed if some entry has extended flags; like
+    # git, we write version 2 otherwise.
+    extended = any(e.flag_skip_worktree or e.flag_intent_to_add for e in index.entries)
+    index.version = 3 if extended else 2
+
+    out = bytearray()
+
+    # HEADER
+    out += b"DIRC"
+    out += struct.pack(">II", index.version, len(index.entries))
+
+    # ENTRIES
+    for e in index.entries:
+        entry_start = len(out)
+
+        mode = (e.mode_type << 12) | e.mode_perms
+
+        name_bytes = e.name.encode("utf8")
+        # If the name is 0xFFF bytes or longer, we store 0xFFF and let
+        # readers look for the NUL terminator.
+        name_length = min(len(name_bytes), 0xFFF)
+
+        flag_extended = e.flag_skip_worktree or e.flag_intent_to_add
+        flags = (0x8000 if e.flag_assume_valid else 0) \
+              | (0x4000 if flag_extended else 0) \
+              | ((e.flag_stage or 0) << 12) \
+              | name_length
+
+        # Stat fields are stored on 32 bits, and simply truncated.
+        out += struct.pack(">10I20sH",
+                           e.ctime[0] & 0xFFFFFFFF, e.ctime[1],
+                           e.mtime[0] & 0xFFFFFFFF, e.mtime[1],
+                           e.dev & 0xFFFFFFFF, e.ino & 0xFFFFFFFF,
+                           mode,
+                           e.uid & 0xFFFFFFFF, e.gid & 0xFFFFFFFF,
+                           e.fsize & 0xFFFFFFFF,
+                           bytes.fromhex(e.sha),
+                           flags)
+
+        if flag_extended:
+            out += struct.pack(">H", (0x4000 if e.flag_skip_worktree else 0)
+                                   | (0x2000 if e.flag_intent_to_add else 0))
+
+        # Write the name, then pad with NULs to a multiple of eight
+        # bytes.  There's always at least one NUL, the terminator.
+        out += name_bytes
+        out += b'\x00' * (8 - (len(out) - entry_start) % 8)
+
+    out += hashlib.sha1(out).digest()
+
+    # Write through a lock file, which also makes the update atomic:
+    # readers see either the old index or the new one.
+    index_file = GitRepository.repo_file(repo, "index")
+    lock = index_file + ".lock"
+    fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(out)
+    except:
+        os.remove(lock)
+        raise
+    os.replace(lock, index_file)
+    index.mtime = os.stat(index_file).st_mtime_ns
+    if GitTrace.enabled:
+        GitTrace.count("bytes written", len(out))
+
+def index_entry_mode(st):
+    """Return the (mode_type, mode_perms) of a file from its stat."""
+    if stat.S_ISLNK(st.st_mode):
+        return 0b1010, 0
+    if st.st_mode & stat.S_IXUSR:
+        return 0b1000, 0o755
+    return 0b1000, 0o644
+
+def index_entry_from_stat(name, sha, st):
+    """Build an index entry for the file name, of blob sha, from its
+    stat data."""
+    mode_type, mode_perms = index_entry_mode(st)
+    return GitIndexEntry(ctime=(int(st.st_ctime_ns // 10**9), st.st_ctime_ns % 10**9),
+                         mtime=(int(st.st_mtime_ns // 10**9), st.st_mtime_ns % 10**9),
+                         dev=st.st_dev,
+                         ino=st.st_ino,
+                         mode_type=mode_type,
+                         mode_perms=mode_perms,
+                         uid=st.st_uid,
+                         gid=st.st_gid,
+                         fsize=st.st_size,
+                         sha=sha,
+                         flag_assume_valid=False,
+                         flag_stage=0,
+                         name=name)
+
+def index_entry_refresh(entry, st):
+    """Update the stat data of entry, once we know its contents didn't
+    change."""
+    fresh = index_entry_from_stat(entry.name, entry.sha, st)
+    entry.ctime = fresh.ctime
+    entry.mtime = fresh.mtime
+    entry.dev = fresh.dev
+    entry.ino = fresh.ino
+    entry.uid = fresh.uid
+    entry.gid = fresh.gid
+    entry.fsize = fresh.fsize
+
+def index_entry_stat_matches(index, entry, st, filemode=True):
+    """Check whether entry's stat data proves that the file hasn't
+    changed since it was added, without reading it.  A False answer
+    only means the file must be rehashed to know."""
+
+    m = st.st_mtime_ns
+    c = st.st_ctime_ns
+    if entry.mtime != ((m // 10**9) & 0xFFFFFFFF, m % 10**9) \
+       or entry.ctime != ((c // 10**9) & 0xFFFFFFFF, c % 10**9) \
+       or entry.fsize != st.st_size & 0xFFFFFFFF \
+       or entry.ino != st.st_ino & 0xFFFFFFFF \
+       or entry.dev != st.st_dev & 0xFFFFFFFF \
+       or entry.uid != st.st_uid & 0xFFFFFFFF \
+       or entry.gid != st.st_gid & 0xFFFFFFFF:
+        return False
+
+    mode_type, mode_perms = index_entry_mode(st)
+    if entry.mode_type != mode_type or (filemode and entry.mode_perms != mode_perms):
+        return False
+
+    # Racy clean: if the file was last modified no earlier than the
+    # index was written, it may have changed again within the same
+    # timestamp tick without its stat data showing it.
+    if index.mtime is not None:
+        entry_mtime = entry.mtime[0] * 10**9 + entry.mtime[1]
+        if entry_mtime >= index.mtime:
+            return False
+
+    return True
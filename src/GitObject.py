@@ -1,8 +1,19 @@
+import bisect
+import collections
 import hashlib
 import os
+import re
+import stat
+import threading
 import zlib
 
 import GitRepository
+import GitPack
+import GitRefs
+import GitTrace
+
+# Size of the chunks we read, hash and compress when streaming objects.
+OBJECT_CHUNK_SIZE = 1024 * 1024
 
 class GitObject(object):
     def __init__(self, data=None):
@@ -25,63 +36,565 @@ class GitObject(object):
     def init(self):
         pass # Just do nothing. This is a reasonable default!
     
+def object_read_raw(repo, sha):
+    """Read object sha from Git repository repo, either from its loose
+    file or from a packfile.  Return a (fmt, data) pair, or None."""
+
+    path = GitRepository.repo_file(repo, "objects", sha[0:2], sha[2:])
+
+    # Objects that went through a gc or a clone live in packs.
+    if not (path and os.path.isfile(path)):
+        return GitPack.pack_read(repo, sha)
+    return object_loose_read(path)
+
+def object_loose_read(path):
+    """Read the loose object at path.  Return a (fmt, data) pair."""
+
+    with open(path, "rb") as f:
+        data = f.read()
+    raw = zlib.decompress(data)
+    if GitTrace.enabled:
+        GitTrace.count("files opened")
+        GitTrace.count("object reads, loose")
+        GitTrace.count("bytes read", len(data))
+        GitTrace.count("bytes inflated", len(raw))
+
+    # Read object type
+    x = raw.find(b' ')
+    fmt = raw[0:x]
+
+    # Read and validate object size
+    y = raw.find(b'\x00', x)
+    size = int(raw[x:y].decode("ascii"))
+    if size != len(raw)-y-1:
+        raise Exception(f"Malformed object {path}: bad length")
+
+    return fmt, raw[y+1:]
+
+def object_loose_header(path):
+    """Read the (fmt, size) header of the loose object at path,
+    inflating only its first bytes."""
+
+    d = zlib.decompressobj()
+    with open(path, "rb") as f:
+        # The header is at most a type, a space, a decimal size and a
+        # NUL, which always fits in the first few dozen bytes.
+        data = f.read(256)
+        head = d.decompress(data, 64)
+    if GitTrace.enabled:
+        GitTrace.count("files opened")
+        GitTrace.count("bytes read", len(data))
+
+    x = head.find(b' ')
+    y = head.find(b'\x00', x)
+    if x < 0 or y < 0:
+        raise Exception(f"Malformed object {path}: bad header")
+    return head[0:x], int(head[x:y].decode("ascii"))
+
+def object_loose_list(repo):
+    """Yield the SHA of every loose object in repo."""
+
+    path = GitRepository.repo_dir(repo, "objects")
+    if not path:
+        return
+
+    for d in sorted(os.listdir(path)):
+        # Only the two hex digits fan-out directories hold objects;
+        # skip pack/ and info/.
+        if len(d) != 2 or not os.path.isdir(os.path.join(path, d)):
+            continue
+        for f in sorted(os.listdir(os.path.join(path, d))):
+            if len(f) == 38:
+                yield d + f
+
+class GitObjectCache(object):
+    """A least-recently-used cache of parsed objects, bounded by the
+    total size of their data.  GitObjectPrefetcher threads fill it
+    while the walk reads from it, hence the lock."""
+
+    limit = 0
+    size = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sha):
+        with self.lock:
+            entry = self.entries.get(sha)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(sha)
+            return entry[0]
+
+    def peek(self, sha):
+        """Same as get, but without counting or refreshing the entry."""
+        with self.lock:
+            entry = self.entries.get(sha)
+        return entry[0] if entry else None
+
+    def put(self, sha, obj, size):
+        with self.lock:
+            if size > self.limit or sha in self.entries:
+                return
+            self.entries[sha] = (obj, size)
+            self.size += size
+            # Evict the oldest entries until we fit again.
+            while self.size > self.limit:
+                _, (_, old) = self.entries.popitem(last=False)
+                self.size -= old
+
+# Default size of the object cache, in bytes of object data.
+OBJECT_CACHE_SIZE = 32 * 1024 * 1024
+
+def object_cache(repo):
+    """Return the object cache of repo, creating it the first time.
+    Its size comes from kgit.objectcachesize in .git/config, with an
+    optional k, m or g suffix; 0 disables it."""
+
+    if repo.cache is None:
+        value = repo.conf.get("kgit", "objectcachesize", fallback=None)
+        if value is None:
+            limit = OBJECT_CACHE_SIZE
+        else:
+            value = value.strip().lower()
+            unit = { "k": 1024, "m": 1024**2, "g": 1024**3 }.get(value[-1:], 1)
+            if unit != 1:
+                value = value[:-1]
+            limit = int(value) * unit
+        repo.cache = GitObjectCache(limit)
+    return repo.cache
+
+def object_read_header(repo, sha):
+    """Return the (fmt, size) of object sha without reading all of it,
+    or None if it doesn't exist."""
+    path = GitRepository.repo_file(repo, "objects", sha[0:2], sha[2:])
+    if not (path and os.path.isfile(path)):
+        return GitPack.pack_read_header(repo, sha)
+    return object_loose_header(path)
+
 def object_read(repo, sha):
     """Read object sha from Git repository repo.  Return a
-    GitObject whose exact type depends on the object."""
+    GitObject whose exact type depends on the object.
 
-    path = GitRepository.repo_file(repo, "objects", sha[0:2], sha[2:])
+    Commits, trees and tags are kept in the repository's object cache,
+    so the same instance may be returned to several callers: they must
+    not modify it."""
 
-    if not os.path.isfile(path):
+    cache = object_cache(repo)
+    obj = cache.get(sha)
+    if GitTrace.enabled:
+        GitTrace.count("object_read")
+        GitTrace.count("object cache hits" if obj is not None else "object cache misses")
+    if obj is not None:
+        return obj
+
+    ret = object_read_raw(repo, sha)
+    if ret is None:
         return None
+    fmt, data = ret
+
+    # Blobs aren't cached: they are rarely read twice, and can be big
+    # enough to flush everything else out.
+    obj = object_parse(sha, fmt, data)
+    if fmt != b'blob':
+        cache.put(sha, obj, len(data))
+    return obj
+
+def object_parse(sha, fmt, data):
+    """Return the GitObject for the data of object sha, of type fmt."""
+
+    # Pick constructor
+    match fmt:
+        case b'commit' : c=GitCommit
+        case b'tree'   : c=GitTree
+        case b'tag'    : c=GitTag
+        case b'blob'   : c=GitBlob
+        case _:
+            raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
+
+    # Call constructor and return object.
+    return c(data)
+
+# Threads reading objects ahead of a walk, by default: none.  Reads
+# ahead wait on the disk and in zlib, which both release the GIL, but
+# when objects are in the page cache the threads cost more than they
+# save.
+OBJECT_PREFETCH_JOBS = 0
+# Most objects being read ahead at once.
+OBJECT_PREFETCH_LIMIT = 64
+# How many levels below the objects asked for are read ahead.
+OBJECT_PREFETCH_DEPTH = 16
+
+def object_prefetch_jobs(repo):
+    """Return how many threads should read objects ahead of walks in
+    repo.  This comes from kgit.prefetchjobs in .git/config: it is
+    worth setting when the repository is on a network filesystem, or
+    anything else where reads wait."""
+    return repo.conf.getint("kgit", "prefetchjobs", fallback=OBJECT_PREFETCH_JOBS)
+
+class GitObjectPrefetcher(object):
+    """Read the objects a walk is about to need ahead of it, in a thread
+    pool.  Each object read (by read() or ahead) has its children, the
+    list of SHAs the children function returns for it, read ahead too,
+    up to depth levels below the last object read().  The walk itself
+    doesn't change: it only gets its objects from read() rather than
+    object_read(), and whatever wasn't read ahead is read on the spot.
+    With no jobs, nothing is read ahead.
+
+    Objects read ahead go to the object cache, so that they take no
+    more memory than it allows."""
+
+    def __init__(self, repo, children, jobs=OBJECT_PREFETCH_JOBS,
+                 depth=OBJECT_PREFETCH_DEPTH, limit=OBJECT_PREFETCH_LIMIT):
+        self.repo = repo
+        self.children = children
+        self.depth = depth
+        self.limit = limit
+        self.cache = object_cache(repo)
+        # SHA: future of the objects being read ahead.
+        self.reading = dict()
+        # SHA: depth below it to read ahead, of the objects read ahead
+        # (or being read) that read() didn't return yet.
+        self.ahead = dict()
+        # What read() returned, which never needs to be read again.
+        self.done = set()
+        self.lock = threading.Lock()
+        self.pool = None
+        if jobs > 0:
+            import concurrent.futures
+            # Packs are opened first so that threads don't race to do it.
+            GitPack.pack_list(repo)
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if self.pool:
+            # Stop threads from reading more ahead while we wait for them.
+            with self.lock:
+                self.limit = 0
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
 
+    def read(self, sha):
+        """Same as object_read(repo, sha)."""
+        if not self.pool:
+            return object_read(self.repo, sha)
+
+        with self.lock:
+            self.done.add(sha)
+            self.ahead.pop(sha, None)
+            future = self.reading.get(sha)
+
+        obj = future.result() if future else None
+        if obj is not None:
+            if GitTrace.enabled:
+                GitTrace.count("object reads, ahead")
+        else:
+            obj = object_read(self.repo, sha)
+
+        if obj is not None and self.depth > 0:
+            children = self.children(obj)
+            with self.lock:
+                for child in children:
+                    self.want(child, self.depth - 1)
+        return obj
+
+    def want(self, sha, depth):
+        """Read sha ahead, and its children up to depth levels below
+        it.  The lock must be held."""
+        if sha in self.done:
+            return
+
+        ahead = self.ahead.get(sha)
+        if ahead is None:
+            if len(self.reading) < self.limit and self.cache.peek(sha) is None:
+                self.ahead[sha] = depth
+                self.reading[sha] = self.pool.submit(self.fetch, sha)
+        elif ahead < depth:
+            # The walk is getting closer to an object read ahead: look
+            # further below it, if it's been read already.
+            self.ahead[sha] = depth
+            obj = self.cache.peek(sha) if sha not in self.reading else None
+            if obj is not None and depth > 0:
+                for child in self.children(obj):
+                    self.want(child, depth - 1)
+
+    def fetch(self, sha):
+        """Read sha into the cache, in a thread of the pool, and return
+        it."""
+        try:
+            ret = object_read_raw(self.repo, sha)
+            if ret is None:
+                return None
+            obj = object_parse(sha, *ret)
+            if ret[0] != b'blob':
+                self.cache.put(sha, obj, len(ret[1]))
+            children = self.children(obj)
+        finally:
+            with self.lock:
+                del self.reading[sha]
+
+        with self.lock:
+            # If read() already asked for it, it reads the children
+            # ahead itself.
+            depth = self.ahead.get(sha, 0)
+            if depth > 0:
+                for child in children:
+                    self.want(child, depth - 1)
+        return obj
+
+def object_inflate_stream(read):
+    """Inflate a zlib stream, pulling compressed data from the read
+    function.  Yield chunks of at most OBJECT_CHUNK_SIZE bytes."""
+
+    d = zlib.decompressobj()
+    while not d.eof:
+        # Whatever didn't fit in the last chunk goes in first.
+        data = d.unconsumed_tail
+        if not data:
+            data = read(OBJECT_CHUNK_SIZE)
+            if not data:
+                raise Exception("Truncated zlib stream")
+            if GitTrace.enabled:
+                GitTrace.count("bytes read", len(data))
+        out = d.decompress(data, OBJECT_CHUNK_SIZE)
+        if GitTrace.enabled:
+            GitTrace.count("bytes inflated", len(out))
+        if out:
+            yield out
+
+    # We may have read past the end of the stream.
+    if GitTrace.enabled:
+        GitTrace.count("bytes read", -len(d.unused_data))
+
+def object_loose_stream(path):
+    """Stream the loose object at path.  The first item yielded is the
+    (fmt, size) header, and the rest is the object data in chunks."""
+
+    if GitTrace.enabled:
+        GitTrace.count("files opened")
+        GitTrace.count("object reads, loose")
     with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
-
-        # Read object type
-        x = raw.find(b' ')
-        fmt = raw[0:x]
-
-        # Read and validate object size
-        y = raw.find(b'\x00', x)
-        size = int(raw[x:y].decode("ascii"))
-        if size != len(raw)-y-1:
-            raise Exception(f"Malformed object {sha}: bad length")
-
-        # Pick constructor
-        match fmt:
-            case b'commit' : c=GitCommit
-            case b'tree'   : c=GitTree
-            case b'tag'    : c=GitTag
-            case b'blob'   : c=GitBlob
-            case _:
-                raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
-
-        # Call constructor and return object
-        return c(raw[y+1:])
+        chunks = object_inflate_stream(f.read)
 
-def object_write(obj, repo=None):
-    # Serialize object data
-    data = obj.serialize()
-    # Add header
-    result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
-    # Compute hash
-    sha = hashlib.sha1(result).hexdigest()
+        head = b''
+        while b'\x00' not in head:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise Exception(f"Malformed object {path}: bad header")
+            head += chunk
+
+        x = head.find(b' ')
+        y = head.find(b'\x00', x)
+        size = int(head[x:y].decode("ascii"))
+        yield head[0:x], size
+
+        total = len(head) - y - 1
+        if total:
+            yield head[y+1:]
+        for chunk in chunks:
+            total += len(chunk)
+            yield chunk
+
+        if total != size:
+            raise Exception(f"Malformed object {path}: bad length")
 
-    if repo:
-        # Compute path
-        path=GitRepository.repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+def object_read_stream(repo, sha):
+    """Read object sha from repo as a stream.  Return a (fmt, size,
+    chunks) tuple, where chunks yields the data in pieces of bounded
+    size, or None if the object doesn't exist."""
 
-        if not os.path.exists(path):
-            with open(path, 'wb') as f:
-                # Compress and write
-                f.write(zlib.compress(result))
+    path = GitRepository.repo_file(repo, "objects", sha[0:2], sha[2:])
+    if not (path and os.path.isfile(path)):
+        return GitPack.pack_read_stream(repo, sha)
+
+    chunks = object_loose_stream(path)
+    fmt, size = next(chunks)
+    return fmt, size, chunks
+
+def object_write(obj, repo=None):
+    objects = GitRepository.repo_dir(repo, "objects", mkdir=True) if repo else None
+    sha, tmp = object_deflate(obj.fmt, obj.serialize(), objects)
+    if GitTrace.enabled:
+        GitTrace.count("object_write")
+    if tmp:
+        object_store(repo, sha, tmp)
     return sha
 
+# The fan-out directories we know exist, so that writing many objects
+# doesn't cost a stat and a mkdir each.  Whoever removes one must
+# forget it here.
+OBJECT_FANOUT_DIRS = set()
+
+def object_fanout_dir(objects, sha):
+    """Return the fan-out directory of sha under objects, the path of
+    an objects directory, creating it if needed."""
+    path = os.path.join(objects, sha[0:2])
+    if path not in OBJECT_FANOUT_DIRS:
+        os.makedirs(path, exist_ok=True)
+        OBJECT_FANOUT_DIRS.add(path)
+    return path
+
+def object_loose_path(repo, sha):
+    return GitRepository.repo_path(repo, "objects", sha[0:2], sha[2:])
+
+def object_store(repo, sha, tmp):
+    """Move tmp, the compressed object sha, into its place in the
+    object store, unless it's already there.  Objects are always
+    written to a temporary file first, so that they are either
+    complete or not there at all."""
+    object_fanout_dir(GitRepository.repo_path(repo, "objects"), sha)
+    path = object_loose_path(repo, sha)
+    if os.path.exists(path):
+        os.remove(tmp)
+        return
+    os.replace(tmp, path)
+    if GitTrace.enabled:
+        GitTrace.count("loose objects created")
+        GitTrace.count("bytes written", os.path.getsize(path))
+
+    # Keep the listing object_loose_prefix() may have made up to date.
+    names = repo.loose.get(sha[0:2]) if repo.loose is not None else None
+    if names is not None:
+        i = bisect.bisect_left(names, sha[2:])
+        if i == len(names) or names[i] != sha[2:]:
+            names.insert(i, sha[2:])
+
+def object_loose_prefix(repo, prefix):
+    """Return the loose objects whose SHA starts with prefix, a lower
+    case hex string of at least two characters.  Each fan-out
+    directory is listed once, then kept sorted on the repository, so
+    a lookup only costs a binary search."""
+
+    if repo.loose is None:
+        repo.loose = dict()
+    fanout = prefix[0:2]
+    if fanout not in repo.loose:
+        path = GitRepository.repo_path(repo, "objects", fanout)
+        names = sorted(os.listdir(path)) if os.path.isdir(path) else []
+        repo.loose[fanout] = names
+
+    names = repo.loose[fanout]
+    rest = prefix[2:]
+    ret = list()
+    i = bisect.bisect_left(names, rest)
+    while i < len(names) and names[i].startswith(rest):
+        ret.append(fanout + names[i])
+        i += 1
+    return ret
+
+# What an abbreviated or full SHA looks like.
+OBJECT_HEX = re.compile(r"^[0-9A-Fa-f]{4,40}$")
+
+def object_resolve(repo, name):
+    """Resolve name to an object hash in repo.
+
+    This function is aware of:
+
+     - the HEAD literal
+     - full refs, and short tag, branch and remote branch names
+     - full and short hashes
+
+    Like git, a full hash wins, then refs in that order, then short
+    hashes.  Return the list of candidates: it may be empty, or have
+    several SHAs if name is an ambiguous short hash."""
+
+    name = name.strip()
+
+    # Empty string?  Abort.
+    if not name:
+        return []
+
+    if len(name) == 40 and OBJECT_HEX.match(name):
+        return [ name.lower() ]
+
+    # Nothing outside refs/ but the pseudo-refs, and nothing outside
+    # .git at all.
+    if name.startswith("/") or ".." in name:
+        return []
+
+    # The same rules git uses, in the same order, except that the name
+    # as is only counts for pseudo-refs like HEAD, and refs/ names.
+    for ref in (name if GitRefs.ref_name_valid(name) else None,
+                "refs/" + name,
+                "refs/tags/" + name,
+                "refs/heads/" + name,
+                "refs/remotes/" + name,
+                "refs/remotes/" + name + "/HEAD"):
+        if ref is None:
+            continue
+        sha = GitRefs.ref_resolve(repo, ref)
+        if sha:
+            return [ sha ]
+
+    if not OBJECT_HEX.match(name):
+        return []
+
+    # A short hash: look it up in the loose objects and in every pack.
+    prefix = name.lower()
+    candidates = set(object_loose_prefix(repo, prefix))
+    for pack in GitPack.pack_list(repo):
+        candidates.update(pack.find_prefix(prefix))
+    return sorted(candidates)
+
 def object_find(repo, name, fmt=None, follow=True):
-    return name
+    """Find the object called name.  If fmt is given, follow tags (and
+    commits, to their tree) until we reach an object of that type,
+    unless follow is False.  Return None if we can't."""
+    sha = object_resolve(repo, name)
+
+    if not sha:
+        raise Exception(f"No such reference {name}.")
+
+    if len(sha) > 1:
+        candidates = "\n - ".join(sha)
+        raise Exception(f"Ambiguous reference {name}: Candidates are:\n - {candidates}.")
+
+    sha = sha[0]
+
+    if not fmt:
+        return sha
+
+    while True:
+        obj = object_read(repo, sha)
+        if obj is None:
+            raise Exception(f"No such object {sha}.")
+
+        if obj.fmt == fmt:
+            return sha
+
+        if not follow:
+            return None
+
+        # Follow tags
+        if obj.fmt == b'tag':
+            sha = obj.values(b'object')[0].decode("ascii")
+        elif obj.fmt == b'commit' and fmt == b'tree':
+            sha = obj.values(b'tree')[0].decode("ascii")
+        else:
+            return None
 
 def object_hash(fd, fmt, repo=None):
     """ Hash object, writing it to repo if provided."""
+
+    # Blobs from regular files are streamed, so that hashing a file
+    # doesn't need to hold it in memory.
+    st = os.fstat(fd.fileno())
+    if fmt == b'blob' and stat.S_ISREG(st.st_mode):
+        return object_hash_stream(fd, fmt, st.st_size, repo)
+
     data = fd.read()
 
     # Choose constructor according to fmt argument
@@ -94,6 +607,215 @@ def object_hash(fd, fmt, repo=None):
 
     return object_write(obj, repo)
 
+def object_hash_stream(fd, fmt, size, repo=None):
+    """Hash size bytes read from fd as an object of type fmt, writing
+    it to repo if provided.  The data goes through in fixed-size
+    chunks, so memory use doesn't depend on the size of the object."""
+    objects = GitRepository.repo_dir(repo, "objects", mkdir=True) if repo else None
+    sha, tmp = object_deflate_stream(fd, fmt, size, objects)
+    if GitTrace.enabled:
+        GitTrace.count("object_write")
+    if tmp:
+        object_store(repo, sha, tmp)
+    return sha
+
+def object_deflate_stream(fd, fmt, size, objects=None, sync=False):
+    """Hash size bytes read from fd as an object of type fmt and, if
+    objects is the path of an objects directory, compress it to a
+    temporary file in there, which is fsynced if sync is set.  Return
+    (sha, temporary file or None).  Only files are touched, not the
+    repository, so that this can run in another process."""
+
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    sha1 = hashlib.sha1(header)
+
+    out = None
+    tmp = None
+    if objects:
+        # We can't know where the object goes before we've hashed
+        # all of it, so we compress to a temporary file first.
+        # Only writes need tempfile, which pulls in shutil and random.
+        import tempfile
+        tmpfd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=objects)
+        out = os.fdopen(tmpfd, "wb")
+        z = zlib.compressobj()
+        out.write(z.compress(header))
+
+    try:
+        left = size
+        while left:
+            chunk = fd.read(min(left, OBJECT_CHUNK_SIZE))
+            if not chunk:
+                raise Exception(f"File shrank while hashing it: expected {size} bytes")
+            left -= len(chunk)
+            sha1.update(chunk)
+            if out:
+                out.write(z.compress(chunk))
+        if fd.read(1):
+            raise Exception(f"File grew while hashing it: expected {size} bytes")
+
+        if out:
+            out.write(z.flush())
+            if sync:
+                out.flush()
+                os.fsync(out.fileno())
+            out.close()
+    except:
+        if out:
+            out.close()
+            os.remove(tmp)
+        raise
+
+    return sha1.hexdigest(), tmp
+
+def object_deflate(fmt, data, objects=None, sync=False):
+    """Same as object_deflate_stream, for data already in memory.  We
+    know the SHA before compressing, so objects that are already
+    there aren't compressed again, and the temporary file goes right
+    next to its final place: tmp is None in both cases."""
+    result = fmt + b' ' + str(len(data)).encode() + b'\x00' + data
+    sha = hashlib.sha1(result).hexdigest()
+    if not objects or os.path.exists(os.path.join(objects, sha[0:2], sha[2:])):
+        return sha, None
+
+    # Deferred, as in object_deflate_stream.
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=object_fanout_dir(objects, sha))
+    with os.fdopen(fd, "wb") as f:
+        f.write(zlib.compress(result))
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    return sha, tmp
+
+def object_deflate_paths(paths, fmt, objects=None):
+    """Run object_deflate on the file at each of paths, or
+    object_deflate_stream if it is too big to be read at once.  This
+    is what the workers of object_write_paths() run, a few files at a
+    time to keep the cost of talking to them low.  Temporary files are
+    fsynced here, so that the workers sync them in parallel."""
+    ret = list()
+    for path in paths:
+        with open(path, "rb") as fd:
+            st = os.fstat(fd.fileno())
+            if stat.S_ISREG(st.st_mode) and st.st_size > OBJECT_CHUNK_SIZE:
+                ret.append(object_deflate_stream(fd, fmt, st.st_size, objects, sync=True))
+            else:
+                ret.append(object_deflate(fmt, fd.read(), objects, sync=True))
+    return ret
+
+def object_deflate_many(objs, objects=None):
+    """Run object_deflate on each (fmt, data) of objs, fsyncing their
+    temporary files."""
+    return [ object_deflate(fmt, data, objects, sync=True) for fmt, data in objs ]
+
+# How many objects a worker hashes in one go, and how many objects
+# are moved into place between two syncs of their directories.
+OBJECT_BULK_CHUNK = 32
+OBJECT_BULK_BATCH = 4096
+
+def object_write_paths(repo, paths, fmt=b'blob', jobs=None):
+    """Hash the file at each of paths as an object of type fmt, and
+    write it to repo if provided.  Yield their SHAs, in order."""
+    return object_write_bulk(repo, object_deflate_paths, paths, fmt, jobs=jobs)
+
+def object_write_many(repo, objs, jobs=None):
+    """Write each (fmt, data) of objs to repo, and yield their SHAs, in
+    order.  Objects are sent to the workers, so this is only worth it
+    over object_write() if there are many, and they're not tiny."""
+    return object_write_bulk(repo, object_deflate_many, objs, jobs=jobs)
+
+def object_write_bulk(repo, worker, items, *args, jobs=None):
+    """Run worker on chunks of items, in a pool of jobs processes, and
+    write the objects they return to repo.
+
+    zlib holds the GIL while it compresses, so threads wouldn't help:
+    compression runs in processes, which leave compressed and fsynced
+    temporary files in the objects directory.  Those are moved into
+    place by batches, and then each directory a batch touched is
+    fsynced once, which makes the renames durable.  Objects never
+    appear torn, and directories are synced once per batch instead
+    of once per object."""
+
+    if jobs is None:
+        jobs = os.cpu_count()
+    objects = GitRepository.repo_dir(repo, "objects", mkdir=True) if repo else None
+
+    def chunks():
+        chunk = list()
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == OBJECT_BULK_CHUNK:
+                yield chunk
+                chunk = list()
+        if chunk:
+            yield chunk
+
+    def results():
+        if jobs <= 1:
+            for chunk in chunks():
+                yield worker(chunk, *args, objects)
+            return
+
+        # Keep a bounded number of chunks in flight, so that results
+        # come back in order without reading all of items first.
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            pending = collections.deque()
+            for chunk in chunks():
+                pending.append(pool.submit(worker, chunk, *args, objects))
+                if len(pending) >= 4 * jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    batch = list()
+    try:
+        for done in results():
+            batch.extend(done)
+            if len(batch) >= OBJECT_BULK_BATCH:
+                yield from object_write_batch(repo, batch)
+                batch = list()
+        yield from object_write_batch(repo, batch)
+    finally:
+        # Something went wrong: don't leave temporary files behind.
+        for _, tmp in batch:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+
+def object_write_batch(repo, batch):
+    """Move every (sha, temporary file) of batch into place, the files
+    being fsynced already, and make the renames durable by fsyncing
+    each fan-out directory they went to once.  The objects directory
+    is fsynced too, in case the batch created fan-out directories.
+    Yield the SHAs."""
+    if GitTrace.enabled:
+        GitTrace.count("object_write", len(batch))
+    if repo and batch:
+        dirs = set()
+        for sha, tmp in batch:
+            if tmp:
+                object_store(repo, sha, tmp)
+                dirs.add(sha[0:2])
+        if dirs:
+            objects = GitRepository.repo_path(repo, "objects")
+            for d in sorted(dirs):
+                object_sync_dir(os.path.join(objects, d))
+            object_sync_dir(objects)
+    for sha, _ in batch:
+        yield sha
+
+def object_sync_dir(path):
+    """fsync directory path, which makes the entries created in it
+    durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if GitTrace.enabled:
+        GitTrace.count("directories synced")
+
 class GitBlob(GitObject):
     fmt=b'blob'
 
@@ -103,65 +825,92 @@ class GitBlob(GitObject):
     def deserialize(self, data):
         self.blobdata = data
         
-def kvlm_parse(raw, start=0, dct=None):
-    if not dct:
-        dictionary = dict()
-        # You CANNOT declare the argument as dct=dict() or all call to
-        # the functions will endlessly grow the same dict.
-        
-    # This function is recursive: it reads a key/value pair, then call
-    # itself back with the new position.  So we first need to know
-    # where we are: at a keyword, or already in the messageQ
-    
-    # We search for the next space and the next newline.
-    space = raw.find(b' ', start)
-    newline = raw.find(b'\n', start)
-    
-    # If space appears before newline, we have a keyword.  Otherwise,
-    # it's the final message, which we just read to the end of the file.
-
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all, in which
-    # case find returns -1), we assume a blank line.  A blank line
-    # means the remainder of the data is the message.  We store it in
-    # the dictionary, with None as the key, and return.
-    
-    if (space < 0) or (newline < space):
-        assert newline == start
-        dict[None] = raw[start+1:]
-        return dict
-    
-    # Recursive case
-    # ==============
-    # we read a key-value pair and recurse for the next.
-    
-    key = raw[start:space]
-    
-    # Find the end of the value.  Continuation lines begin with a
-    # space, so we loop until we find a "\n" not followed by a space.
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end + 1] != ord(' '): break
-        
-    # Grab the value
-    # Also, drop the leading space on continuation lines
-    value = raw[space + 1:end].replace(b'\n ', b'\n')
-
-    # Don't overwrite existing data contents
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
+# The end of a header value: a newline that isn't followed by the
+# space of a continuation line.
+KVLM_VALUE_END = re.compile(rb'\n(?! )')
+
+def kvlm_iter(raw):
+    """Walk the headers of a commit or tag.  For each field, yield its
+    key and the (start, end) bounds of its value in raw; nothing but
+    the key is copied.  The last item is (None, start, end) for the
+    message.  This is a generator, so callers may stop early."""
+
+    view = memoryview(raw)
+    start = 0
+    end = len(raw)
+    while start < end:
+        # A blank line means the remainder of the data is the message.
+        if raw[start] == 0x0A: # "\n"
+            yield None, start + 1, end
+            return
+
+        space = raw.find(b' ', start)
+        newline = raw.find(b'\n', start)
+        if space < 0 or (0 <= newline < space):
+            raise Exception(f"Malformed header line at offset {start}")
+
+        # Continuation lines begin with a space, so the value ends at
+        # the first newline not followed by one.
+        m = KVLM_VALUE_END.search(view, space + 1)
+        value_end = m.start() if m else end
+
+        yield bytes(view[start:space]), space + 1, value_end
+        start = value_end + 1
+
+    # No blank line at all: an empty message.
+    yield None, end, end
+
+def kvlm_value(raw, start, end):
+    """Extract a value found by kvlm_iter, dropping the leading space
+    of continuation lines."""
+    value = raw[start:end]
+    if b'\n ' in value:
+        value = value.replace(b'\n ', b'\n')
+    return value
+
+def kvlm_parse(raw):
+    """Parse all of a commit or tag into a dictionary.  Repeated keys
+    map to a list of values, and the message is under None."""
+    dct = dict()
+    for key, start, end in kvlm_iter(raw):
+        value = kvlm_value(raw, start, end)
+
+        # Don't overwrite existing data contents
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [ dct[key], value ]
         else:
-            dct[key] = [ dct[key], value ]
-    else:
-        dct[key]=value
+            dct[key] = value
 
-    return kvlm_parse(raw, start=end + 1, dct=dct)
+    return dct
+
+def kvlm_get(raw, key):
+    """Return the list of values of header key, without decoding any
+    other field.  Git writes repeated fields (like parent) next to
+    each other, so we stop at the first other field after a match."""
+    ret = list()
+    for k, start, end in kvlm_iter(raw):
+        if k == key:
+            ret.append(kvlm_value(raw, start, end))
+        elif ret or k is None:
+            break
+    return ret
+
+def kvlm_message(raw):
+    """Return the message of a commit or tag, without parsing the
+    headers.  A header value can't hold an empty line (continuation
+    lines start with a space), so the first one ends the headers."""
+    if raw.startswith(b'\n'):
+        return raw[1:]
+    x = raw.find(b'\n\n')
+    if x < 0:
+        return b''
+    return raw[x + 2:]
 
 def kvlm_serialize(kvlm):
-    ret = b''
+    ret = list()
 
     # Output fields
     for k in kvlm.keys():
@@ -173,31 +922,77 @@ def kvlm_serialize(kvlm):
             val = [ val ]
 
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            ret += (k, b' ', v.replace(b'\n', b'\n '), b'\n')
 
     # Append message
-    ret += b'\n' + kvlm[None]
+    ret += (b'\n', kvlm[None])
 
-    return ret
+    return b''.join(ret)
 
 class GitCommit(GitObject):
     fmt=b'commit'
 
+    # The raw data we were read from.  We only parse it into the kvlm
+    # dictionary the first time it's needed: many callers only want a
+    # field or two, which values() and message() get from raw
+    # directly.
+    raw = None
+    _kvlm = None
+
     def deserialize(self, data):
-        self.kvlm = kvlm_parse(data)
+        self.raw = data
+        self._kvlm = None
 
     def serialize(self):
+        # An object nobody parsed can't have been modified.
+        if self._kvlm is None and self.raw is not None:
+            return self.raw
         return kvlm_serialize(self.kvlm)
 
     def init(self):
-        self.kvlm = dict()
+        self._kvlm = dict()
+
+    @property
+    def kvlm(self):
+        if self._kvlm is None:
+            self._kvlm = kvlm_parse(self.raw)
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, value):
+        self._kvlm = value
+
+    def values(self, key):
+        """Return the list of values of header key."""
+        if self._kvlm is None:
+            return kvlm_get(self.raw, key)
+        val = self._kvlm.get(key, [])
+        return val if type(val) == list else [ val ]
+
+    def message(self):
+        if self._kvlm is None:
+            return kvlm_message(self.raw)
+        return self._kvlm[None]
 
 class GitTreeLeaf (object):
+    # Trees can have tens of thousands of leaves, so we keep them
+    # small: the name stays bytes and the SHA stays binary, and the
+    # path and sha properties only decode them when asked.
+    __slots__ = ("mode", "name", "binsha")
+
     def __init__(self, mode, path, sha):
         self.mode = mode
-        self.path = path
-        self.sha = sha
-        
+        self.name = path.encode("utf8") if type(path) == str else path
+        self.binsha = bytes.fromhex(sha) if type(sha) == str else sha
+
+    @property
+    def path(self):
+        return self.name.decode("utf8")
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
 def tree_parse_one(raw, start=0):
     # Find the space terminator of the mode
     x = raw.find(b' ', start)
@@ -211,25 +1006,20 @@ def tree_parse_one(raw, start=0):
 
     # Find the NULL terminator of the path
     y = raw.find(b'\x00', x)
-    # and read the path
-    path = raw[x+1:y]
 
-    # Read the SHA…
-    raw_sha = int.from_bytes(raw[y+1:y+21], "big")
-    # and convert it into an hex string, padded to 40 chars
-    # with zeros if needed.
-    sha = format(raw_sha, "040x")
-    return y+21, GitTreeLeaf(mode, path.decode("utf8"), sha)
+    # Read the path and the binary SHA.
+    return y+21, GitTreeLeaf(mode, raw[x+1:y], raw[y+1:y+21])
 
-def tree_parse(raw):
+def tree_parse_iter(raw):
+    """Yield the leaves of raw one at a time."""
     pos = 0
     max = len(raw)
-    ret = list()
     while pos < max:
         pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
+        yield data
 
-    return ret
+def tree_parse(raw):
+    return list(tree_parse_iter(raw))
 
 # Notice this isn't a comparison function, but a conversion function.
 # Python's default sort doesn't accept a custom comparison function,
@@ -237,34 +1027,113 @@ def tree_parse(raw):
 # value, which is compared using the default rules.  So we just return
 # the leaf name, with an extra / if it's a directory.
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b"10"):
-        return leaf.path
+    if leaf.mode.startswith(b"04"):
+        return leaf.name + b"/"
     else:
-        return leaf.path + "/"
-    
+        return leaf.name
+
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b''
+    ret = list()
     for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path.encode("utf8")
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
-    return ret
+        # Git writes modes without the leading zero we normalize to.
+        ret += (i.mode.lstrip(b"0"), b' ', i.name, b'\x00', i.binsha)
+    return b''.join(ret)
 
 class GitTree(GitObject):
     fmt=b'tree'
 
+    # A tree we read keeps its raw data, and leaves are only decoded
+    # when they are visited.  The items list is only built if someone
+    # asks for it, eg to modify the tree.
+    raw = None
+    _offsets = None
+    _items = None
+
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        self.raw = data
+        self._offsets = None
+        self._items = None
 
     def serialize(self):
+        # If nobody touched the items, the raw data is still right,
+        # and already sorted.
+        if self._items is None and self.raw is not None:
+            return self.raw
         return tree_serialize(self)
 
     def init(self):
-        self.items = list()
+        self._items = list()
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = list(self)
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+
+    def offsets(self):
+        """Return the offset of every leaf in raw, finding them the
+        first time."""
+        if self._offsets is None:
+            raw = self.raw
+            end = len(raw)
+            offsets = list()
+            pos = 0
+            while pos < end:
+                offsets.append(pos)
+                # Skip the mode and name, then the 20 bytes SHA.
+                pos = raw.find(b'\x00', pos) + 21
+            self._offsets = offsets
+        return self._offsets
+
+    def leaf(self, pos):
+        """Decode the leaf at offset pos in raw."""
+        return tree_parse_one(self.raw, pos)[1]
+
+    def __len__(self):
+        if self._items is not None:
+            return len(self._items)
+        return len(self.offsets())
+
+    def __iter__(self):
+        if self._items is not None:
+            return iter(self._items)
+        if self._offsets is not None:
+            return (self.leaf(pos) for pos in self._offsets)
+        # A plain walk doesn't need the offsets: decode as we go.
+        return iter(tree_parse_iter(self.raw))
+
+    def find(self, name):
+        """Return the leaf called name, or None.  Leaves are sorted, so
+        this is a binary search that only decodes a few names."""
+        if type(name) == str:
+            name = name.encode("utf8")
+
+        if self._items is not None:
+            for leaf in self._items:
+                if leaf.name == name:
+                    return leaf
+            return None
+
+        raw = self.raw
+        def key(pos):
+            # Same as tree_leaf_sort_key, straight from raw.
+            x = raw.find(b' ', pos)
+            y = raw.find(b'\x00', x)
+            return raw[x+1:y] + b'/' if raw[pos] == 0x34 else raw[x+1:y] # "4"
+
+        # We don't know whether name is a tree, which sorts as if it
+        # ended with a slash, so we look for both.
+        offsets = self.offsets()
+        for target in (name, name + b'/'):
+            i = bisect.bisect_left(offsets, target, key=key)
+            if i < len(offsets) and key(offsets[i]) == target:
+                return self.leaf(offsets[i])
+        return None
 
 class GitTag(GitCommit):
     fmt = b'tag'
\ No newline at end of file
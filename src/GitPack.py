@@ -0,0 +1,747 @@
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+import GitRepository
+import GitObject
+import GitTrace
+
+# Object types, as stored in the 3-bit type field of a pack entry header.
+PACK_TYPES = {
+    1: b'commit',
+    2: b'tree',
+    3: b'blob',
+    4: b'tag',
+}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+
+IDX_MAGIC = b'\xfftOc'
+
+class GitPack(object):
+    """A packfile and its version 2 index, both memory-mapped."""
+
+    path = None
+    count = 0
+    pack_order = None
+
+    def __init__(self, path):
+        # path is the pack path without its extension, eg
+        # .git/objects/pack/pack-1234abcd
+        self.path = path
+
+        with open(path + ".idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + ".pack", "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:4] != IDX_MAGIC or struct.unpack(">I", self.idx[4:8])[0] != 2:
+            raise Exception(f"Unsupported pack index {path}.idx")
+        if self.pack[0:4] != b'PACK':
+            raise Exception(f"Not a packfile {path}.pack")
+
+        # The fanout table is 256 big-endian counts: entry N is the
+        # number of objects whose first SHA byte is <= N.
+        self.fanout = struct.unpack(">256I", self.idx[8:8 + 256*4])
+        self.count = self.fanout[255]
+
+        # The other tables follow each other, each with count entries.
+        self.sha_table = 8 + 256*4
+        self.crc_table = self.sha_table + 20*self.count
+        self.offset_table = self.crc_table + 4*self.count
+        self.large_offset_table = self.offset_table + 4*self.count
+
+    def index(self, binsha):
+        """Binary-search the index for a 20 bytes SHA, return its
+        position or None."""
+        lo = self.fanout[binsha[0] - 1] if binsha[0] else 0
+        hi = self.fanout[binsha[0]]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.sha_table + 20*mid
+            cur = self.idx[pos:pos + 20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def find_prefix(self, prefix):
+        """Return the SHAs in this pack that start with the hex string
+        prefix, which must be at least two characters long."""
+        lo_sha = bytes.fromhex(prefix.ljust(40, "0"))
+        hi_sha = bytes.fromhex(prefix.ljust(40, "f"))
+
+        # Same as index(), but for the first SHA not below lo_sha.
+        lo = self.fanout[lo_sha[0] - 1] if lo_sha[0] else 0
+        hi = self.fanout[lo_sha[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha(mid) < lo_sha:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        ret = list()
+        while lo < self.count and self.sha(lo) <= hi_sha:
+            ret.append(self.sha(lo).hex())
+            lo += 1
+        return ret
+
+    def sha(self, n):
+        """Return the SHA of the nth object, as a 20 bytes string."""
+        pos = self.sha_table + 20*n
+        return self.idx[pos:pos + 20]
+
+    def offset(self, n):
+        """Return the offset in the packfile of the nth object."""
+        pos = self.offset_table + 4*n
+        off = struct.unpack(">I", self.idx[pos:pos + 4])[0]
+
+        # If the MSB is set, the rest is an index into the table of
+        # 8 bytes offsets, used for packs larger than 2GB.
+        if off & 0x80000000:
+            pos = self.large_offset_table + 8*(off & 0x7fffffff)
+            off = struct.unpack(">Q", self.idx[pos:pos + 8])[0]
+        return off
+
+    def checksum(self):
+        """Return the SHA-1 of the pack, at its end, which names it."""
+        return self.pack[-20:]
+
+    def order(self):
+        """Return the positions in the index of every object, in the
+        order they come in the pack, which is how bitmaps number them.
+        The .rev file next to the pack has it, if git wrote one."""
+        if self.pack_order is not None:
+            return self.pack_order
+
+        rev = self.path + ".rev"
+        if os.path.isfile(rev):
+            with open(rev, "rb") as f:
+                data = f.read()
+            end = 12 + 4*self.count
+            if data[0:12] != b'RIDX' + struct.pack(">II", 1, 1) or data[end:end + 20] != self.checksum():
+                raise Exception(f"Unsupported reverse index {rev}")
+            self.pack_order = list(struct.unpack(f">{self.count}I", data[12:end]))
+        else:
+            offsets = list(struct.unpack(f">{self.count}I", self.idx[self.offset_table:self.large_offset_table]))
+            if offsets and max(offsets) & 0x80000000:
+                offsets = [ self.offset(n) for n in range(self.count) ]
+            self.pack_order = sorted(range(self.count), key=offsets.__getitem__)
+        return self.pack_order
+
+    def types(self, repo):
+        """Return the type of every object, in pack order."""
+        ret = list()
+        # Deltas are of the type of their base, which an OFS_DELTA
+        # always has before it in the pack.
+        kinds = dict()
+        for n in self.order():
+            pos = self.offset(n)
+            kind, _, data_pos = self.entry_header(pos)
+            if kind in PACK_TYPES:
+                fmt = PACK_TYPES[kind]
+            elif kind == PACK_OFS_DELTA:
+                fmt = kinds.get(self.ofs_delta_base(pos, data_pos)[0])
+            else:
+                fmt = None
+            if fmt is None:
+                fmt = self.read_header(repo, self.sha(n).hex())[0]
+            kinds[pos] = fmt
+            ret.append(fmt)
+        return ret
+
+    def entry_header(self, pos):
+        """Read the header of the entry at pos.  Return the type, the
+        inflated size, and the position right after the header."""
+        c = self.pack[pos]
+        pos += 1
+        kind = (c >> 4) & 7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            c = self.pack[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return kind, size, pos
+
+    def ofs_delta_base(self, pos, data_pos):
+        """Read the base of the OFS_DELTA entry at pos, whose header
+        ends at data_pos.  Return the offset of the base, and the
+        position of the delta data."""
+        # The base is at a negative offset from this entry, in a
+        # big-endian varint where each continuation adds one (so that
+        # there's only one encoding per number).
+        c = self.pack[data_pos]
+        data_pos += 1
+        base = c & 0x7f
+        while c & 0x80:
+            c = self.pack[data_pos]
+            data_pos += 1
+            base = ((base + 1) << 7) | (c & 0x7f)
+        return pos - base, data_pos
+
+    def inflate(self, pos, size):
+        """Inflate the zlib stream starting at pos, which is known to
+        decompress to size bytes."""
+        d = zlib.decompressobj()
+        view = memoryview(self.pack)
+        start = pos
+        chunks = []
+        # We don't know how long the compressed data is, so we feed
+        # it in small pieces until the stream is over.
+        while not d.eof:
+            chunk = view[pos:pos + 8192]
+            if not chunk:
+                raise Exception(f"Truncated object in {self.path}.pack")
+            chunks.append(d.decompress(chunk))
+            pos += len(chunk)
+        view.release()
+
+        data = b''.join(chunks)
+        if len(data) != size:
+            raise Exception(f"Malformed pack entry in {self.path}.pack: bad length")
+        if GitTrace.enabled:
+            GitTrace.count("bytes read", pos - start - len(d.unused_data))
+            GitTrace.count("bytes inflated", size)
+        return data
+
+    def read_at(self, repo, pos, cache=None):
+        """Read the object at offset pos, resolving deltas.  Return a
+        (fmt, data) pair.
+
+        Reading many objects, most of them deltas, rebuilds the same
+        bases over and over: cache, a GitObjectCache keyed by offset,
+        keeps every object rebuilt, and walks down delta chains stop
+        at the first object it has."""
+
+        # Walk down the delta chain until we reach a full object,
+        # remembering the deltas on the way.  Chains can be very long,
+        # so this is a loop and not a recursion.
+        deltas = []
+        while True:
+            if cache is not None:
+                hit = cache.get(pos)
+                if hit is not None:
+                    fmt, data = hit
+                    break
+
+            kind, size, data_pos = self.entry_header(pos)
+
+            if kind in PACK_TYPES:
+                fmt = PACK_TYPES[kind]
+                data = self.inflate(data_pos, size)
+                if cache is not None:
+                    cache.put(pos, (fmt, data), len(data))
+                break
+            elif kind == PACK_OFS_DELTA:
+                base, data_pos = self.ofs_delta_base(pos, data_pos)
+                deltas.append((pos, self.inflate(data_pos, size)))
+                pos = base
+            elif kind == PACK_REF_DELTA:
+                # The base is named by its SHA.  It's usually in this
+                # same pack, but may live anywhere in the repository.
+                base = self.pack[data_pos:data_pos + 20]
+                deltas.append((pos, self.inflate(data_pos + 20, size)))
+                n = self.index(base)
+                if n is not None:
+                    pos = self.offset(n)
+                    continue
+                ret = GitObject.object_read_raw(repo, base.hex())
+                if ret is None:
+                    raise Exception(f"Missing delta base {base.hex()} in {self.path}.pack")
+                fmt, data = ret
+                break
+            else:
+                raise Exception(f"Unknown pack entry type {kind} in {self.path}.pack")
+
+        if GitTrace.enabled and deltas:
+            GitTrace.count("deltas applied", len(deltas))
+        while deltas:
+            pos, delta = deltas.pop()
+            data = delta_apply(data, delta)
+            if cache is not None:
+                cache.put(pos, (fmt, data), len(data))
+
+        return fmt, data
+
+    def read_header(self, repo, sha):
+        """Return the (fmt, size) of object sha in this pack, or None,
+        without rebuilding it if it's a delta."""
+        n = self.index(bytes.fromhex(sha))
+        if n is None:
+            return None
+
+        pos = self.offset(n)
+        kind, size, data_pos = self.entry_header(pos)
+        if kind in PACK_TYPES:
+            return PACK_TYPES[kind], size
+
+        # A delta starts with the size of its base, then the size of
+        # the result, so we only inflate its first few bytes.
+        delta_pos = data_pos
+        if kind == PACK_OFS_DELTA:
+            while self.pack[delta_pos] & 0x80:
+                delta_pos += 1
+            delta_pos += 1
+        else:
+            delta_pos += 20
+        # Two varints fit in 20 bytes, but a compressed block may start
+        # with a large Huffman table, so feed input until we have them.
+        d = zlib.decompressobj()
+        head = b''
+        while len(head) < 20 and not d.eof:
+            head += d.decompress(self.pack[delta_pos:delta_pos + 256], 20 - len(head))
+            delta_pos += 256 - len(d.unconsumed_tail)
+        _, x = delta_varint(head, 0)
+        size, _ = delta_varint(head, x)
+
+        # The type is that of the object at the bottom of the chain.
+        while kind not in PACK_TYPES:
+            if kind == PACK_OFS_DELTA:
+                pos, _ = self.ofs_delta_base(pos, data_pos)
+            else:
+                base = self.pack[data_pos:data_pos + 20]
+                n = self.index(base)
+                if n is None:
+                    ret = GitObject.object_read_header(repo, base.hex())
+                    if ret is None:
+                        raise Exception(f"Missing delta base {base.hex()} in {self.path}.pack")
+                    return ret[0], size
+                pos = self.offset(n)
+            kind, _, data_pos = self.entry_header(pos)
+
+        return PACK_TYPES[kind], size
+
+    def read_stream(self, repo, sha):
+        """Read object sha from this pack as a (fmt, size, chunks)
+        tuple, or return None.  Only full objects are actually
+        streamed: deltas need all of their base, so they are rebuilt
+        in memory and then cut in chunks."""
+        n = self.index(bytes.fromhex(sha))
+        if n is None:
+            return None
+
+        pos = self.offset(n)
+        kind, size, data_pos = self.entry_header(pos)
+
+        if kind not in PACK_TYPES:
+            fmt, data = self.read_at(repo, pos)
+            chunk = GitObject.OBJECT_CHUNK_SIZE
+            return fmt, len(data), (data[i:i + chunk] for i in range(0, len(data), chunk))
+
+        # Compressed data is at worst a little bigger than the data, so
+        # we don't copy more than that out of the pack, however big the
+        # chunks asked for are.
+        end = data_pos + size + size // 1024 + 64
+
+        def read(n):
+            nonlocal data_pos
+            ret = self.pack[data_pos:min(data_pos + n, end)]
+            data_pos += len(ret)
+            return ret
+
+        def chunks():
+            total = 0
+            for chunk in GitObject.object_inflate_stream(read):
+                total += len(chunk)
+                yield chunk
+            if total != size:
+                raise Exception(f"Malformed pack entry in {self.path}.pack: bad length")
+
+        return PACK_TYPES[kind], size, chunks()
+
+    def read(self, repo, sha):
+        """Read object sha from this pack, or return None."""
+        n = self.index(bytes.fromhex(sha))
+        if n is None:
+            return None
+        return self.read_at(repo, self.offset(n))
+
+def delta_varint(delta, pos):
+    """Read a little-endian varint, as used in delta headers."""
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return ret, pos
+
+def delta_apply(base, delta):
+    """Rebuild an object from its base and a delta."""
+    src_size, pos = delta_varint(delta, 0)
+    dst_size, pos = delta_varint(delta, pos)
+    if src_size != len(base):
+        raise Exception("Delta base has the wrong size")
+
+    base = memoryview(base)
+    ret = bytearray()
+    end = len(delta)
+    while pos < end:
+        c = delta[pos]
+        pos += 1
+        if c & 0x80:
+            # Copy from base.  The low 4 bits say which offset bytes
+            # are present, the next 3 which size bytes are.
+            off = 0
+            for i in range(4):
+                if c & (1 << i):
+                    off |= delta[pos] << (8*i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if c & (0x10 << i):
+                    size |= delta[pos] << (8*i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            ret += base[off:off + size]
+        elif c:
+            # Insert the next c bytes from the delta itself.
+            ret += delta[pos:pos + c]
+            pos += c
+        else:
+            raise Exception("Malformed delta: opcode 0")
+
+    if len(ret) != dst_size:
+        raise Exception("Delta result has the wrong size")
+    return bytes(ret)
+
+def pack_list(repo):
+    """Return the packs of repo, opening them the first time."""
+    if repo.packs is None:
+        repo.packs = list()
+        path = GitRepository.repo_dir(repo, "objects", "pack")
+        if path:
+            for f in sorted(os.listdir(path)):
+                if f.endswith(".idx") and os.path.isfile(os.path.join(path, f[:-4] + ".pack")):
+                    repo.packs.append(GitPack(os.path.join(path, f[:-4])))
+                    if GitTrace.enabled:
+                        GitTrace.count("files opened", 2)
+    return repo.packs
+
+def pack_read(repo, sha):
+    """Look for object sha in every pack of repo.  Return a (fmt,
+    data) pair, or None if no pack has it."""
+    for pack in pack_list(repo):
+        ret = pack.read(repo, sha)
+        if ret is not None:
+            if GitTrace.enabled:
+                GitTrace.count("object reads, packed")
+            return ret
+    return None
+
+def pack_read_header(repo, sha):
+    """Same as pack_read, but only return the (fmt, size) header."""
+    for pack in pack_list(repo):
+        ret = pack.read_header(repo, sha)
+        if ret is not None:
+            return ret
+    return None
+
+def pack_read_stream(repo, sha):
+    """Same as pack_read, but return a (fmt, size, chunks) tuple as
+    GitObject.object_read_stream does."""
+    for pack in pack_list(repo):
+        ret = pack.read_stream(repo, sha)
+        if ret is not None:
+            return ret
+    return None
+
+# Blocks of the delta base we index.  Smaller blocks find more matches
+# but make the index bigger and slower to build.
+DELTA_BLOCK = 16
+
+def delta_encode_varint(n):
+    """Encode n as a little-endian varint, as used in delta headers."""
+    ret = bytearray()
+    while True:
+        c = n & 0x7f
+        n >>= 7
+        if n:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return bytes(ret)
+
+def delta_index(base):
+    """Map every aligned block of base to its first offset."""
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[i:i + DELTA_BLOCK], i)
+    return index
+
+def delta_create(base, target, index=None, limit=None):
+    """Compute a delta that rebuilds target from base.  Return None if
+    the delta would grow larger than limit bytes."""
+
+    if index is None:
+        index = delta_index(base)
+
+    ret = bytearray(delta_encode_varint(len(base)))
+    ret += delta_encode_varint(len(target))
+
+    def insert(start, end):
+        # Literal data goes out in runs of at most 127 bytes.
+        for i in range(start, end, 127):
+            n = min(127, end - i)
+            ret.append(n)
+            ret.extend(target[i:i + n])
+
+    def copy(off, size):
+        # Copies are limited to 64KiB each, the largest size older
+        # readers accept.
+        while size:
+            n = min(size, 0x10000)
+            op = 0x80
+            args = bytearray()
+            for i in range(4):
+                c = (off >> (8*i)) & 0xff
+                if c:
+                    op |= 1 << i
+                    args.append(c)
+            if n != 0x10000:
+                for i in range(3):
+                    c = (n >> (8*i)) & 0xff
+                    if c:
+                        op |= 0x10 << i
+                        args.append(c)
+            ret.append(op)
+            ret.extend(args)
+            off += n
+            size -= n
+
+    start = 0 # Beginning of the pending literal data
+    i = 0
+    end = len(target)
+    while i + DELTA_BLOCK <= end:
+        off = index.get(target[i:i + DELTA_BLOCK])
+        if off is None:
+            i += 1
+            continue
+
+        # Grow the match backwards into the pending literal...
+        while i > start and off > 0 and target[i - 1] == base[off - 1]:
+            i -= 1
+            off -= 1
+
+        # ...and forward, a block at a time then byte by byte.
+        n = DELTA_BLOCK
+        most = min(len(base) - off, end - i)
+        while n + DELTA_BLOCK <= most and \
+              target[i + n:i + n + DELTA_BLOCK] == base[off + n:off + n + DELTA_BLOCK]:
+            n += DELTA_BLOCK
+        while n < most and target[i + n] == base[off + n]:
+            n += 1
+
+        insert(start, i)
+        copy(off, n)
+        i += n
+        start = i
+
+        if limit is not None and len(ret) > limit:
+            return None
+
+    insert(start, end)
+
+    if limit is not None and len(ret) > limit:
+        return None
+    return bytes(ret)
+
+def pack_entry_header(kind, size):
+    """Encode a pack entry header for an object of type kind and
+    inflated size."""
+    c = (kind << 4) | (size & 0x0f)
+    size >>= 4
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return bytes(ret)
+
+def pack_encode_offset(off):
+    """Encode the negative offset of an OFS_DELTA base.  This is the
+    reverse of the decoding in GitPack.read_at."""
+    ret = bytearray([off & 0x7f])
+    off >>= 7
+    while off:
+        off -= 1
+        ret.append(0x80 | (off & 0x7f))
+        off >>= 7
+    return bytes(reversed(ret))
+
+def pack_write(repo, count, entries):
+    """Write a pack and its index from count entries.  Each entry is a
+    (sha, fmt, data, base) tuple where base is either None or a
+    (base_sha, delta) pair; bases must come first.  Return the path of
+    the new pack, without extension.  Both files are durable when it
+    returns, so that the loose copies of what it packed can go."""
+
+    # Only writes need tempfile, which pulls in shutil and random.
+    import tempfile
+
+    path = GitRepository.repo_dir(repo, "objects", "pack", mkdir=True)
+    fmt_kinds = { v: k for k, v in PACK_TYPES.items() }
+
+    # We write to a temporary file, since the final name is the
+    # checksum of the whole pack.
+    fd, tmp = tempfile.mkstemp(prefix="tmp_pack_", dir=path)
+    index = list()
+    offsets = dict()
+    sha1 = hashlib.sha1()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            def write(data):
+                sha1.update(data)
+                f.write(data)
+
+            write(b'PACK' + struct.pack(">II", 2, count))
+            pos = 12
+            written = 0
+            for sha, fmt, data, base in entries:
+                if base is not None and base[0] in offsets:
+                    head = pack_entry_header(PACK_OFS_DELTA, len(base[1]))
+                    head += pack_encode_offset(pos - offsets[base[0]])
+                    body = zlib.compress(base[1])
+                else:
+                    head = pack_entry_header(fmt_kinds[fmt], len(data))
+                    body = zlib.compress(data)
+
+                write(head)
+                write(body)
+                crc = zlib.crc32(body, zlib.crc32(head))
+                binsha = bytes.fromhex(sha)
+                index.append((binsha, crc, pos))
+                offsets[sha] = pos
+                pos += len(head) + len(body)
+                written += 1
+
+            if written != count:
+                raise Exception(f"Expected {count} objects, got {written}")
+
+            checksum = sha1.digest()
+            f.write(checksum)
+            f.flush()
+            os.fsync(f.fileno())
+    except:
+        os.remove(tmp)
+        raise
+
+    name = os.path.join(path, "pack-" + checksum.hex())
+    os.replace(tmp, name + ".pack")
+
+    # The index goes in last, so that readers never see an index
+    # without its pack.
+    index.sort()
+    idx = bytearray(IDX_MAGIC + struct.pack(">I", 2))
+    fanout = [0] * 256
+    for binsha, _, _ in index:
+        fanout[binsha[0]] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        idx += struct.pack(">I", total)
+    for binsha, _, _ in index:
+        idx += binsha
+    for _, crc, _ in index:
+        idx += struct.pack(">I", crc)
+    large = bytearray()
+    for _, _, off in index:
+        if off < 0x80000000:
+            idx += struct.pack(">I", off)
+        else:
+            idx += struct.pack(">I", 0x80000000 | (len(large) // 8))
+            large += struct.pack(">Q", off)
+    idx += large
+    idx += checksum
+    idx += hashlib.sha1(idx).digest()
+
+    fd, tmp = tempfile.mkstemp(prefix="tmp_idx_", dir=path)
+    with os.fdopen(fd, "wb") as f:
+        f.write(idx)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, name + ".idx")
+    # Make both renames durable.
+    GitObject.object_sync_dir(path)
+
+    # Let the next reader find the new pack.
+    repo.packs = None
+    return name
+
+def pack_loose(repo, window=10, depth=50):
+    """Write every loose object of repo into a single new pack, with
+    delta compression.  Return the path of the pack and the list of
+    packed SHAs, or (None, []) if there was nothing to pack."""
+
+    # First pass: learn the type and size of everything, and read the
+    # trees to get a name for each object they point to.  Objects
+    # with the same name are usually versions of the same file, which
+    # are the best delta candidates.
+    objects = list()
+    names = dict()
+    for sha in GitObject.object_loose_list(repo):
+        path = GitRepository.repo_path(repo, "objects", sha[0:2], sha[2:])
+        fmt, size = GitObject.object_loose_header(path)
+        objects.append((sha, fmt, size))
+        if fmt == b'tree':
+            _, data = GitObject.object_read_raw(repo, sha)
+            for leaf in GitObject.tree_parse(data):
+                names.setdefault(leaf.sha, leaf.name)
+
+    if not objects:
+        return None, []
+
+    # Group by type, then by name, biggest first: git's heuristic is
+    # that the newest version of a file is usually the biggest, and
+    # that deltas which remove data are smaller than those adding it.
+    objects.sort(key=lambda o: (o[1], names.get(o[0], b""), -o[2]))
+
+    def entries():
+        # The window holds the last candidates, as [sha, fmt, data,
+        # index, depth] lists.  The block index is computed the first
+        # time a candidate is used as a base.
+        candidates = collections.deque(maxlen=window)
+        chains = dict()
+        for sha, fmt, size in objects:
+            _, data = GitObject.object_read_raw(repo, sha)
+
+            best = None
+            if fmt in (b'blob', b'tree') and size > DELTA_BLOCK:
+                # A delta is only worth it if it's much smaller than
+                # the object itself.
+                limit = size // 2
+                for c in candidates:
+                    # Only try bases of the same type and of a
+                    # comparable size, and keep chains short enough
+                    # for reads to stay fast.
+                    if c[1] != fmt or chains.get(c[0], 0) >= depth:
+                        continue
+                    if not (size // 2 <= len(c[2]) <= size * 2):
+                        continue
+                    if c[3] is None:
+                        c[3] = delta_index(c[2])
+                    delta = delta_create(c[2], data, c[3], limit)
+                    if delta is not None:
+                        best = (c[0], delta)
+                        limit = len(delta) - 1
+
+            if best is not None:
+                chains[sha] = chains.get(best[0], 0) + 1
+            yield sha, fmt, data, best
+            candidates.append([sha, fmt, data, None])
+
+    return pack_write(repo, len(objects), entries()), [o[0] for o in objects]
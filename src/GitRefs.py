@@ -0,0 +1,175 @@
+import bisect
+import os
+import re
+
+import GitRepository
+import GitTrace
+
+# What the value of a ref that isn't symbolic looks like.
+REF_SHA = re.compile(r"^[0-9A-Fa-f]{40}$")
+
+# Names of refs outside refs/, like HEAD or FETCH_HEAD.  Anything else
+# at the top of .git, like config, isn't a ref.
+REF_PSEUDO = re.compile(r"^[A-Z][A-Z0-9_]*$")
+
+def ref_name_valid(name):
+    """Return whether name can be a ref: a pseudo-ref, or a name under
+    refs/ that stays there."""
+    if name.startswith("/") or ".." in name:
+        return False
+    return name.startswith("refs/") or REF_PSEUDO.match(name) is not None
+
+class GitRefStore(object):
+    """The refs of a repository: the packed-refs file, loaded once and
+    kept sorted, overlaid with the loose refs under .git/refs.
+    Resolved refs are remembered for as long as the store lives, which
+    is one command."""
+
+    repo = None
+
+    def __init__(self, repo):
+        self.repo = repo
+        # Sorted names, and their SHAs, from packed-refs
+        self.packed_names = None
+        self.packed_shas = None
+        # Peeled values of annotated tags, from the "^" lines of
+        # packed-refs.
+        self.peeled = dict()
+        self.resolved = dict()
+
+    def load_packed(self):
+        if self.packed_names is not None:
+            return
+
+        refs = list()
+        path = GitRepository.repo_path(self.repo, "packed-refs")
+        if os.path.isfile(path):
+            if GitTrace.enabled:
+                GitTrace.count("files opened")
+            with open(path, "r") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    # Skip the header and empty lines.
+                    if not line or line.startswith("#"):
+                        continue
+                    # A "^" line is the peeled value of the tag before.
+                    if line.startswith("^"):
+                        if refs:
+                            self.peeled[refs[-1][0]] = line[1:]
+                        continue
+                    sha, name = line.split(" ", 1)
+                    refs.append((name, sha))
+
+        # Git writes packed-refs sorted, but doesn't have to.
+        refs.sort()
+        self.packed_names = [ name for name, _ in refs ]
+        self.packed_shas = [ sha for _, sha in refs ]
+
+    def packed(self, name):
+        """Look name up in packed-refs, by binary search."""
+        self.load_packed()
+        i = bisect.bisect_left(self.packed_names, name)
+        if i < len(self.packed_names) and self.packed_names[i] == name:
+            return self.packed_shas[i]
+        return None
+
+    def read(self, name):
+        """Return the raw value of ref name: either a SHA, or "ref: "
+        followed by another ref name.  Loose refs win over packed ones.
+        Return None if name can't be a ref."""
+        if not ref_name_valid(name):
+            return None
+        path = GitRepository.repo_path(self.repo, name)
+        if os.path.isfile(path):
+            if GitTrace.enabled:
+                GitTrace.count("files opened")
+            with open(path, "r") as f:
+                return f.read().strip()
+        return self.packed(name)
+
+    def resolve(self, name):
+        """Follow ref name down to a SHA, or None if it's broken."""
+        if GitTrace.enabled:
+            GitTrace.count("refs resolved")
+        if name in self.resolved:
+            return self.resolved[name]
+
+        # Follow symbolic refs iteratively, remembering the chain so
+        # that every step of it gets cached.
+        chain = list()
+        cur = name
+        sha = None
+        while cur not in self.resolved:
+            if cur in chain or len(chain) > 10:
+                raise Exception(f"Symbolic ref loop at {name}")
+            chain.append(cur)
+            data = self.read(cur)
+            if data is None or not data.startswith("ref: "):
+                # Anything but a SHA is a broken ref.
+                sha = data.lower() if data and REF_SHA.match(data) else None
+                break
+            cur = data[5:]
+        else:
+            sha = self.resolved[cur]
+
+        for ref in chain:
+            self.resolved[ref] = sha
+        return sha
+
+    def list(self, prefix="refs/"):
+        """Return a sorted list of (name, sha) for every ref whose name
+        starts with prefix.  Only the packed refs and loose directories
+        matching the prefix are looked at, and only under refs/: the
+        rest of the gitdir holds no refs we'd list."""
+        if "refs/".startswith(prefix):
+            prefix = "refs/"
+        elif not prefix.startswith("refs/"):
+            return []
+        refs = dict()
+
+        # Packed refs with this prefix are a contiguous, sorted range.
+        self.load_packed()
+        i = bisect.bisect_left(self.packed_names, prefix)
+        while i < len(self.packed_names) and self.packed_names[i].startswith(prefix):
+            refs[self.packed_names[i]] = None
+            i += 1
+
+        # Loose refs: walk the deepest directory that contains the
+        # whole prefix.
+        top = prefix[:prefix.rfind("/") + 1]
+        todo = [ top ]
+        while todo:
+            d = todo.pop()
+            path = GitRepository.repo_path(self.repo, d)
+            try:
+                entries = list(os.scandir(path))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for e in entries:
+                name = d + e.name
+                if e.is_dir():
+                    # Only descend where the prefix may match.
+                    if name.startswith(prefix) or prefix.startswith(name + "/"):
+                        todo.append(name + "/")
+                elif name.startswith(prefix) and not name.endswith(".lock"):
+                    refs[name] = None
+
+        ret = list()
+        for name in sorted(refs):
+            sha = self.resolve(name)
+            # Broken symbolic refs are skipped, like git does.
+            if sha:
+                ret.append((name, sha))
+        return ret
+
+def ref_store(repo):
+    """Return the ref store of repo, creating it the first time."""
+    if repo.refs is None:
+        repo.refs = GitRefStore(repo)
+    return repo.refs
+
+def ref_resolve(repo, ref):
+    return ref_store(repo).resolve(ref)
+
+def ref_list(repo, prefix="refs/"):
+    return ref_store(repo).list(prefix)
@@ -7,6 +7,12 @@ class GitRepository(object):
     worktree = None
     gitdir = None
     conf = None
+    packs = None
+    cache = None
+    commit_graph = None
+    bitmap = None
+    refs = None
+    loose = None
     
     def __init__(self, path, force=False):
         self.worktree = path
@@ -0,0 +1,116 @@
+import os
+import sys
+import threading
+import time
+
+# Tracing is off unless KGIT_TRACE is set, or --trace given.  Every
+# hook checks this first, so that a disabled hook costs one attribute
+# lookup:
+#
+#     if GitTrace.enabled: GitTrace.count("object_read")
+enabled = False
+
+# Where the trace goes: None for a summary on stderr, or the path of a
+# Chrome trace-event file (load it in chrome://tracing or Perfetto).
+output = None
+
+counters = dict()
+# Chrome trace events, for the phases that are over.
+events = list()
+# Total time and number of calls of each phase, for the summary.
+phases = dict()
+
+# Hooks may run in the checkout thread pool.
+lock = threading.Lock()
+# Times are relative to this, which is about when kgit started.
+start = time.perf_counter()
+
+def trace_start(where):
+    """Turn tracing on.  where is "1" (or "true", "stderr") for a
+    summary on stderr, or the path of a trace file to write."""
+    global enabled, output
+    enabled = True
+    output = None if where.lower() in ("1", "true", "yes", "stderr") else where
+
+def trace_start_from_env():
+    where = os.environ.get("KGIT_TRACE")
+    if where and where.lower() not in ("0", "false", "no"):
+        trace_start(where)
+
+def count(name, n=1):
+    """Add n to counter name."""
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+class TracePhase(object):
+    """A context manager timing a named phase of a command."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        with lock:
+            total, calls = phases.get(self.name, (0.0, 0))
+            phases[self.name] = (total + end - self.begin, calls + 1)
+            events.append({ "name": self.name,
+                            "ph": "X",
+                            "ts": (self.begin - start) * 1e6,
+                            "dur": (end - self.begin) * 1e6,
+                            "pid": os.getpid(),
+                            "tid": threading.get_ident() })
+        return False
+
+class TraceNothing(object):
+    """What phase() returns when tracing is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NOTHING = TraceNothing()
+
+def phase(name):
+    """Return a context manager timing the phase name:
+
+        with GitTrace.phase("read index"):
+            ..."""
+    return TracePhase(name) if enabled else NOTHING
+
+def trace_finish(command):
+    """Write the trace of command out."""
+    if not enabled:
+        return
+    end = time.perf_counter()
+
+    if output is None:
+        trace_summary(command, end - start, sys.stderr)
+        return
+
+    import json
+    ts = (end - start) * 1e6
+    trace = list(events)
+    trace.append({ "name": "total", "ph": "X", "ts": 0, "dur": ts,
+                   "pid": os.getpid(), "tid": threading.get_ident() })
+    # Counters are only known as totals, so they're a single sample.
+    trace.append({ "name": "counters", "ph": "C", "ts": ts, "pid": os.getpid(),
+                   "args": dict(sorted(counters.items())) })
+    with open(output, "w") as f:
+        json.dump({ "traceEvents": trace, "displayTimeUnit": "ms" }, f)
+
+def trace_summary(command, total, f):
+    print(f"kgit trace: {command} took {total:.3f}s", file=f)
+    if phases:
+        print("  phases:", file=f)
+        for name, (t, calls) in sorted(phases.items(), key=lambda p: -p[1][0]):
+            print(f"    {name:28} {t:9.3f}s  {calls:8} call{'s' if calls > 1 else ''}", file=f)
+    if counters:
+        print("  counters:", file=f)
+        for name, n in sorted(counters.items()):
+            print(f"    {name:28} {n:10}", file=f)
@@ -1,118 +1,495 @@
 import argparse
-from datetime import datetime
-import grp, pwd
-from fnmatch import fnmatch
-from math import ceil
+import hashlib
 import os
-import re
+import stat
 import sys
 
 import GitRepository
 import GitObject
+import GitRefs
+import GitTrace
+# The other Git* modules are imported by the functions using them, so
+# that running a command only loads what that command needs.
 
-# Creates the argument parser so we can accept the commands (init, commit, etc.) through the command line.
-argparser = argparse.ArgumentParser(description="kgit — My own Git version control system!")
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
-argsubparsers.required = True # Require an argument from the user.
+# Each command's arguments are added by a function, called by
+# argparser_build only for the command being run: kgit runs a single
+# command, and building the parsers of all the others would only slow
+# its startup down.
 
 # kgit init
-argsp = argsubparsers.add_parser("init", help="Initialize an empty, new repository.")
-argsp.add_argument("path",
-                   metavar="directory",
-                   nargs="?",
-                   default=".",
-                   help="Where to create the repository.")
+def argparser_init(argsp):
+    argsp.add_argument("path",
+                       metavar="directory",
+                       nargs="?",
+                       default=".",
+                       help="Where to create the repository.")
 
 # kgit cat-file
-argsp = argsubparsers.add_parser("cat-file",
-                                 help="Provide content of repository objects")
-argsp.add_argument("type",
-                   metavar="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   help="Specify the type")
-argsp.add_argument("object",
-                   metavar="object",
-                   help="The object to display")
+def argparser_cat_file(argsp):
+    argsp.add_argument("--batch",
+                       dest="batch",
+                       action="store_const",
+                       const="batch",
+                       help="Print the type, size and contents of each object named on stdin")
+    argsp.add_argument("--batch-check",
+                       dest="batch",
+                       action="store_const",
+                       const="batch-check",
+                       help="Print the type and size of each object named on stdin")
+    argsp.add_argument("--buffer",
+                       action="store_true",
+                       help="In batch mode, don't flush the output after each object")
+    argsp.add_argument("type",
+                       metavar="type",
+                       nargs="?",
+                       choices=["blob", "commit", "tag", "tree"],
+                       help="Specify the type")
+    argsp.add_argument("object",
+                       metavar="object",
+                       nargs="?",
+                       help="The object to display")
 
 # kgit hash-object
-argsp = argsubparsers.add_parser(
-    "hash-object",
-    help="Compute object ID and optionally creates a blob from a file")
+def argparser_hash_object(argsp):
+    argsp.add_argument("-t",
+                       metavar="type",
+                       dest="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       default="blob",
+                       help="Specify the type")
 
-argsp.add_argument("-t",
-                   metavar="type",
-                   dest="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   default="blob",
-                   help="Specify the type")
+    argsp.add_argument("-w",
+                       dest="write",
+                       action="store_true",
+                       help="Actually write the object into the database")
 
-argsp.add_argument("-w",
-                   dest="write",
-                   action="store_true",
-                   help="Actually write the object into the database")
+    argsp.add_argument("--stdin-paths",
+                       dest="stdin_paths",
+                       action="store_true",
+                       help="Read file names from stdin, one per line, instead of the command line")
 
-argsp.add_argument("path",
-                   help="Read object from <file>")
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=os.cpu_count(),
+                       help="With --stdin-paths, number of processes compressing objects (default: number of CPUs)")
+
+    argsp.add_argument("path",
+                       nargs="?",
+                       help="Read object from <file>")
 
 # kgit log
-argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
-argsp.add_argument("commit",
-                   default="HEAD",
-                   nargs="?",
-                   help="Commit to start at.")
+def argparser_log(argsp):
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=None,
+                       help="Number of threads reading commits ahead (default: kgit.prefetchjobs, or 0)")
+    argsp.add_argument("commit",
+                       default="HEAD",
+                       nargs="?",
+                       help="Commit to start at.")
+    argsp.epilog = "Paths after -- limit the history to the commits changing them."
 
 # kgit ls-tree
-argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
-argsp.add_argument("-r",
-                   dest="recursive",
-                   action="store_true",
-                   help="Recurse into sub-trees")
+def argparser_ls_tree(argsp):
+    argsp.add_argument("-r",
+                       dest="recursive",
+                       action="store_true",
+                       help="Recurse into sub-trees")
+
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=None,
+                       help="Number of threads reading sub-trees ahead with -r (default: kgit.prefetchjobs, or 0)")
 
-argsp.add_argument("tree",
-                   help="A tree-ish object.")
+    argsp.add_argument("tree",
+                       help="A tree-ish object.")
+
+# kgit rev-parse
+def argparser_rev_parse(argsp):
+    argsp.add_argument("--kgit-type",
+                       metavar="type",
+                       dest="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       default=None,
+                       help="Specify the expected type")
+    argsp.add_argument("name",
+                       help="The name to parse")
 
 # kgit checkout
-argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
+def argparser_checkout(argsp):
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=os.cpu_count(),
+                       help="Number of files to write in parallel (default: number of CPUs)")
+
+    argsp.add_argument("-f", "--force",
+                       action="store_true",
+                       help="Overwrite local changes to the files the checkout touches")
+
+    argsp.add_argument("--from",
+                       dest="old",
+                       metavar="commit",
+                       default=None,
+                       help="The commit or tree path was checked out from, if kgit doesn't know it")
+
+    argsp.add_argument("commit",
+                       help="The commit or tree to checkout.")
+
+    argsp.add_argument("path",
+                       help="An empty directory, or one checked out from another commit.")
+
+# kgit archive
+def argparser_archive(argsp):
+    argsp.add_argument("--format",
+                       choices=["tar", "tar.gz", "tgz", "zip"],
+                       default=None,
+                       help="Format of the archive (default: guessed from -o, or tar)")
 
-argsp.add_argument("commit",
-                   help="The commit or tree to checkout.")
+    argsp.add_argument("--prefix",
+                       default="",
+                       help="Put prefix before every path (end it with / for a directory)")
 
-argsp.add_argument("path",
-                   help="The EMPTY directory to checkout on.")
+    argsp.add_argument("-o", "--output",
+                       metavar="file",
+                       default=None,
+                       help="Write the archive to file rather than to stdout")
+
+    argsp.add_argument("commit",
+                       help="The commit or tree to archive.")
 
 # kgit show-ref
-argsp = argsubparsers.add_parser("show-ref", help="List references.")
+def argparser_show_ref(argsp):
+    argsp.add_argument("--heads",
+                       action="store_true",
+                       help="Only show branches")
+    argsp.add_argument("--tags",
+                       action="store_true",
+                       help="Only show tags")
+    argsp.add_argument("pattern",
+                       nargs="*",
+                       help="Only show refs matching one of these: refs/ names by prefix, others by their last components, as in master for refs/heads/master")
+
+# kgit repack
+def argparser_repack(argsp):
+    argsp.add_argument("-d",
+                       dest="prune",
+                       action="store_true",
+                       help="Remove the loose objects once they are packed")
+
+    argsp.add_argument("--window",
+                       type=int,
+                       default=10,
+                       help="Number of objects to consider as delta bases")
+
+    argsp.add_argument("--depth",
+                       type=int,
+                       default=50,
+                       help="Maximum length of a delta chain")
+
+    argsp.add_argument("-b", "--write-bitmap-index",
+                       dest="bitmap",
+                       action="store_true",
+                       help="Write reachability bitmaps, if the repository has a single pack")
+
+# kgit rev-list
+def argparser_rev_list(argsp):
+    argsp.add_argument("--objects",
+                       action="store_true",
+                       help="List the trees, blobs and tags reachable too, not only commits")
+    argsp.add_argument("--all",
+                       action="store_true",
+                       help="Start from every ref, and HEAD")
+    argsp.add_argument("--count",
+                       action="store_true",
+                       help="Only print how many objects there are")
+    argsp.add_argument("--no-use-bitmap-index",
+                       dest="bitmap",
+                       action="store_false",
+                       help="Walk the objects even if there are reachability bitmaps")
+    argsp.add_argument("rev",
+                       nargs="*",
+                       help="Objects to start from; ^rev leaves out what rev reaches")
+
+# kgit count-objects
+def argparser_count_objects(argsp):
+    argsp.add_argument("-v", "--verbose",
+                       action="store_true",
+                       help="Also count packed objects and garbage")
+
+# kgit commit-graph
+def argparser_commit_graph(argsp):
+    argsp.add_argument("action",
+                       choices=["write"],
+                       help="What to do with the commit-graph")
+
+# kgit merge-base
+def argparser_merge_base(argsp):
+    argsp.add_argument("--is-ancestor",
+                       dest="is_ancestor",
+                       action="store_true",
+                       required=True,
+                       help="Exit with 0 if the first commit is an ancestor of the second, 1 otherwise")
+    argsp.add_argument("commit", nargs=2, help="The two commits")
+
+# kgit fsck
+def argparser_fsck(argsp):
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=os.cpu_count(),
+                       help="Number of processes checking objects (default: number of CPUs)")
+    argsp.add_argument("--no-dangling",
+                       dest="dangling",
+                       action="store_false",
+                       help="Don't report objects nothing refers to")
+
+# kgit diff-tree
+def argparser_diff_tree(argsp):
+    argsp.add_argument("-r",
+                       dest="recursive",
+                       action="store_true",
+                       help="Recurse into sub-trees")
+    argsp.add_argument("-M",
+                       dest="renames",
+                       action="store_true",
+                       help="Detect exact renames")
+    argsp.add_argument("tree",
+                       nargs="+",
+                       help="Two trees to compare, or one commit to compare with its first parent")
+
+# kgit ls-files
+def argparser_ls_files(argsp):
+    argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+
+# kgit check-ignore
+def argparser_check_ignore(argsp):
+    argsp.add_argument("-v", "--verbose",
+                       action="store_true",
+                       help="Show the rule matching each path, and where it comes from")
+    argsp.add_argument("-n", "--non-matching",
+                       dest="non_matching",
+                       action="store_true",
+                       help="With -v, also show the paths no rule matches")
+    argsp.add_argument("--no-index",
+                       dest="index",
+                       action="store_false",
+                       help="Check tracked files too, which are never ignored otherwise")
+    argsp.add_argument("--stdin",
+                       action="store_true",
+                       help="Read paths from stdin, one per line, too")
+    argsp.add_argument("path", nargs="*", help="Paths to check")
+
+# kgit status
+def argparser_status(argsp):
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=os.cpu_count(),
+                       help="Number of threads reading directories (default: number of CPUs)")
+
+# kgit rm
+def argparser_rm(argsp):
+    argsp.add_argument("--cached",
+                       action="store_true",
+                       help="Only remove from the index, keep the files.")
+    argsp.add_argument("path", nargs="+", help="Files to remove")
+
+# kgit add
+def argparser_add(argsp):
+    argsp.add_argument("path", nargs="+", help="Files to add")
+
+# The help of every command, and the function adding its arguments.
+argcommands = {
+    "init"          : ("Initialize an empty, new repository.", argparser_init),
+    "cat-file"      : ("Provide content of repository objects", argparser_cat_file),
+    "hash-object"   : ("Compute object ID and optionally creates a blob from a file", argparser_hash_object),
+    "log"           : ("Display history of a given commit.", argparser_log),
+    "ls-tree"       : ("Pretty-print a tree object.", argparser_ls_tree),
+    "rev-parse"     : ("Parse revision (or other objects) identifiers", argparser_rev_parse),
+    "checkout"      : ("Checkout a commit inside of a directory.", argparser_checkout),
+    "archive"       : ("Write the files of a commit as a tar or zip archive.", argparser_archive),
+    "show-ref"      : ("List references.", argparser_show_ref),
+    "repack"        : ("Pack loose objects into a packfile.", argparser_repack),
+    "gc"            : ("Pack loose objects and remove them.", None),
+    "rev-list"      : ("List the objects reachable from commits.", argparser_rev_list),
+    "count-objects" : ("Count objects and the disk space they take.", argparser_count_objects),
+    "commit-graph"  : ("Write the commit-graph file.", argparser_commit_graph),
+    "merge-base"    : ("Check ancestry between commits.", argparser_merge_base),
+    "diff-tree"     : ("Compare the contents of two trees.", argparser_diff_tree),
+    "fsck"          : ("Verify the integrity of the objects.", argparser_fsck),
+    "check-ignore"  : ("Check whether paths are ignored.", argparser_check_ignore),
+    "ls-files"      : ("List all the stage files", argparser_ls_files),
+    "status"        : ("Show the working tree status.", argparser_status),
+    "rm"            : ("Remove files from the working tree and the index.", argparser_rm),
+    "add"           : ("Add files contents to the index.", argparser_add),
+}
+
+# Commands taking paths after a "--": argparse can't tell them from an
+# optional positional argument before.
+argpaths = { "log" }
+
+def argparser_build(command=None):
+    """Create the argument parser so we can accept the commands (init,
+    commit, etc.) through the command line.  If command is one of
+    them, it is the only one the parser knows: otherwise, all of them
+    are listed, with their help, but without their arguments."""
+    argparser = argparse.ArgumentParser(description="kgit — My own Git version control system!")
+    argparser.add_argument("--trace",
+                           action="store_const",
+                           const="1",
+                           help="Print timings and I/O counters on stderr (same as KGIT_TRACE=1)")
+    argparser.add_argument("--trace-file",
+                           dest="trace",
+                           metavar="file",
+                           help="Write timings and I/O counters to file, as a Chrome trace (same as KGIT_TRACE=file)")
+    argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+    argsubparsers.required = True # Require an argument from the user.
+
+    for name, (help, arguments) in argcommands.items():
+        if command in argcommands and name != command:
+            continue
+        argsp = argsubparsers.add_parser(name, help=help)
+        if arguments:
+            arguments(argsp)
+
+    return argparser
 
+def argparser_command(argv):
+    """Find the name of the command in argv, without parsing it."""
+    argv = iter(argv)
+    for arg in argv:
+        if arg == "--trace-file":
+            next(argv, None)
+        elif not arg.startswith("-"):
+            return arg
+    return None
 
 def cmd_init(args):
     GitRepository.repo_create(args.path)
     
 def cmd_cat_file(args):
     repo = GitRepository.repo_find()
+
+    if args.batch:
+        cat_file_batch(repo, sys.stdin.buffer, contents=args.batch == "batch", flush=not args.buffer)
+        return
+
+    if not (args.type and args.object):
+        raise Exception("cat-file needs a type and an object, or --batch!")
     cat_file(repo, args.object, fmt=args.type.encode())
 
 def cat_file(repo, obj, fmt=None):
-    obj = GitObject.object_read(repo, GitObject.object_find(repo, obj, fmt=fmt))
+    sha = GitObject.object_find(repo, obj, fmt=fmt)
+
+    # Blobs are piped to stdout as they are inflated, so that big
+    # files never sit whole in memory.
+    stream = GitObject.object_read_stream(repo, sha)
+    if stream and stream[0] == b'blob':
+        for chunk in stream[2]:
+            sys.stdout.buffer.write(chunk)
+        return
+
+    obj = GitObject.object_read(repo, sha)
     sys.stdout.buffer.write(obj.serialize())
     
+def cat_file_batch(repo, names, contents=True, flush=True):
+    """Answer a stream of object names, one per line, as git cat-file
+    --batch does.  The repository, its packs and caches stay open for
+    the whole stream, which is the point: one process can serve any
+    number of objects."""
+    out = sys.stdout.buffer
+
+    for line in names:
+        name = line.strip().decode("utf8", "surrogateescape")
+        if not name:
+            continue
+
+        # Like git, a name we can't make sense of, or an object we
+        # can't read, is missing: the rest of the batch goes on.
+        try:
+            candidates = GitObject.object_resolve(repo, name)
+            sha = candidates[0] if len(candidates) == 1 else None
+            if not sha:
+                obj = None
+            elif contents:
+                obj = GitObject.object_read_stream(repo, sha)
+            else:
+                # The header is enough, no need to inflate the object.
+                obj = GitObject.object_read_header(repo, sha)
+        except Exception:
+            candidates = []
+            obj = None
+
+        if len(candidates) > 1:
+            out.write(f"{name} ambiguous\n".encode("utf8", "surrogateescape"))
+        elif obj is None:
+            out.write(f"{name} missing\n".encode("utf8", "surrogateescape"))
+        else:
+            out.write(f"{sha} {obj[0].decode('ascii')} {obj[1]}\n".encode("ascii"))
+            if contents:
+                for chunk in obj[2]:
+                    out.write(chunk)
+                out.write(b'\n')
+
+        if flush:
+            out.flush()
+    out.flush()
+
 def cmd_hash_object(args):
     if args.write:
         repo = GitRepository.repo_find()
     else:
         repo = None
 
+    if args.stdin_paths:
+        if args.path:
+            raise Exception("Can't hash both a file and --stdin-paths")
+        paths = ( line.rstrip("\n") for line in sys.stdin )
+        for sha in GitObject.object_write_paths(repo, paths, args.type.encode(), args.jobs):
+            print(sha)
+        return
+
+    if not args.path:
+        raise Exception("No file to hash")
+
     with open(args.path, "rb") as fd:
         sha = GitObject.object_hash(fd, args.type.encode(), repo)
         print(sha)
         
-def log_graphviz(repo, sha, seen):
+def log_graphviz(repo, sha, seen, prefetcher=None, parents=None):
 
     if sha in seen:
         return
     seen.add(sha)
 
-    commit = GitObject.object_read(repo, sha)
-    message = commit.kvlm[None].decode("utf8").strip()
+    # Depth first, like git, but with our own stack: long histories
+    # would overflow Python's.
+    stack = [ (sha, log_graphviz_commit(repo, sha, prefetcher, parents)) ]
+    while stack:
+        sha, left = stack[-1]
+        p = next(left, None)
+        if p is None:
+            stack.pop()
+            continue
+
+        print (f"  c_{sha} -> c_{p};")
+        if p not in seen:
+            seen.add(p)
+            stack.append((p, log_graphviz_commit(repo, p, prefetcher, parents)))
+
+def log_graphviz_commit(repo, sha, prefetcher=None, parents=None):
+    """Print the node of commit sha, and return an iterator over its
+    parents, or over parents(sha) if given."""
+    import GitCommitGraph
+    if prefetcher:
+        commit = prefetcher.read(sha)
+    else:
+        commit = GitObject.object_read(repo, sha)
+    message = commit.message().decode("utf8").strip()
     message = message.replace("\\", "\\\\")
     message = message.replace("\"", "\\\"")
 
@@ -122,36 +499,73 @@ def log_graphviz(repo, sha, seen):
     print(f"  c_{sha} [label=\"{sha[0:7]}: {message}\"]")
     assert commit.fmt==b'commit'
 
-    if not b'parent' in commit.kvlm.keys():
-        # Base case: the initial commit.
-        return
-
-    parents = commit.kvlm[b'parent']
+    if parents:
+        return iter(parents(sha))
+    # The commit-graph, if there's one, already knows the parents.
+    return iter(GitCommitGraph.commit_parents(repo, sha))
 
-    if type(parents) != list:
-        parents = [ parents ]
-
-    for p in parents:
-        p = p.decode("ascii")
-        print (f"  c_{sha} -> c_{p};")
-        log_graphviz(repo, p, seen)
+def log_parents(obj):
+    """The children of commits, for a GitObjectPrefetcher walking
+    history."""
+    return [ p.decode("ascii") for p in obj.values(b'parent') ] if obj.fmt == b'commit' else []
 
 def cmd_log(args):
+    import GitCommitGraph
     repo = GitRepository.repo_find()
+    sha = GitObject.object_find(repo, args.commit, fmt=b'commit')
+
+    jobs = args.jobs if args.jobs is not None else GitObject.object_prefetch_jobs(repo)
+
+    # With paths, only show the commits changing them, and link each to
+    # the nearest ones below it that do.
+    parents = None
+    if args.paths:
+        history = GitCommitGraph.GitPathHistory(repo, [ log_path(repo, p) for p in args.paths ])
+        with GitTrace.phase("simplify history"):
+            sha = history.rewrite(sha)
+        parents = history.parents
 
     print("digraph wyaglog{")
     print("  node[shape=rect]")
-    log_graphviz(repo, GitObject.object_find(repo, args.commit), set())
+    if sha:
+        with GitObject.GitObjectPrefetcher(repo, log_parents, jobs) as prefetcher:
+            log_graphviz(repo, sha, set(), prefetcher, parents)
     print("}")
 
+def log_path(repo, path):
+    """Return path, relative to the current directory, relative to the
+    worktree instead, with / separators, "" being the worktree itself."""
+    path = os.path.relpath(os.path.abspath(path), repo.worktree)
+    if path == os.curdir:
+        return ""
+    if path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise Exception(f"{path}: outside repository")
+    return path.replace(os.sep, "/")
+
 def cmd_ls_tree(args):
     repo = GitRepository.repo_find()
-    ls_tree(repo, args.tree, args.recursive)
+    jobs = args.jobs if args.jobs is not None else GitObject.object_prefetch_jobs(repo)
+    ls_tree(repo, args.tree, args.recursive, jobs=jobs)
 
-def ls_tree(repo, ref, recursive=None, prefix=""):
+def ls_tree(repo, ref, recursive=None, prefix="", jobs=0):
     sha = GitObject.object_find(repo, ref, fmt=b"tree")
-    obj = GitObject.object_read(repo, sha)
-    for item in obj.items:
+    if not recursive:
+        jobs = 0
+    with GitObject.GitObjectPrefetcher(repo, ls_tree_subtrees, jobs) as prefetcher:
+        ls_tree_walk(prefetcher, sha, recursive, prefix)
+
+def ls_tree_subtrees(obj):
+    """The children of trees, for a GitObjectPrefetcher walking them."""
+    import GitDiff
+    if obj.fmt != b'tree':
+        return []
+    return [ item.sha for item in obj if GitDiff.diff_mode_is_tree(item.mode) ]
+
+def ls_tree_walk(prefetcher, sha, recursive, prefix):
+    obj = prefetcher.read(sha)
+    if obj is None or obj.fmt != b'tree':
+        raise Exception(f"No such tree {sha}.")
+    for item in obj:
         if len(item.mode) == 5:
             type = item.mode[0:1]
         else:
@@ -167,118 +581,957 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
         if not (recursive and type=='tree'): # This is a leaf
             print(f"{'0' * (6 - len(item.mode)) + item.mode.decode('ascii')} {type} {item.sha}\t{os.path.join(prefix, item.path)}")
         else: # This is a branch, recurse
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+            ls_tree_walk(prefetcher, item.sha, recursive, os.path.join(prefix, item.path))
+
+def cmd_rev_parse(args):
+    if args.type:
+        fmt = args.type.encode()
+    else:
+        fmt = None
 
-def cmd_checkout(args):
     repo = GitRepository.repo_find()
 
-    obj = GitObject.object_read(repo, GitObject.object_find(repo, args.commit))
+    print (GitObject.object_find(repo, args.name, fmt, follow=True))
+
+def cmd_checkout(args):
+    repo = GitRepository.repo_find()
 
     # If the object is a commit, we grab its tree
-    if obj.fmt == b'commit':
-        obj = GitObject.object_read(repo, obj.kvlm[b'tree'].decode("ascii"))
+    sha = GitObject.object_find(repo, args.commit, fmt=b'tree')
+    path = os.path.realpath(args.path)
 
-    # Verify that path is an empty directory
-    if os.path.exists(args.path):
-        if not os.path.isdir(args.path):
+    if os.path.exists(path):
+        if not os.path.isdir(path):
             raise Exception(f"Not a directory {args.path}!")
-        if os.listdir(args.path):
-            raise Exception(f"Not empty {args.path}!")
+        if os.listdir(path):
+            # Not empty: we only write what changed since the tree
+            # that is checked out there, if we know which it is.
+            if args.old:
+                old = GitObject.object_find(repo, args.old, fmt=b'tree')
+            else:
+                old = checkout_recorded(repo, path)
+            if not old:
+                raise Exception(f"Not empty {args.path}, and not checked out by kgit!  Use --from to say what it holds.")
+            tree_checkout_update(repo, old, sha, path, force=args.force, jobs=args.jobs)
+            checkout_record(repo, path, sha)
+            return
     else:
-        os.makedirs(args.path)
+        os.makedirs(path)
+
+    tree_checkout(repo, GitObject.object_read(repo, sha), path, jobs=args.jobs)
+    checkout_record(repo, path, sha)
+
+def checkout_record_file(repo, path):
+    """Return the file where we remember which tree is checked out at
+    path, an absolute path."""
+    key = hashlib.sha1(os.fsencode(path)).hexdigest()
+    return GitRepository.repo_file(repo, "checkouts", key, mkdir=True)
+
+def checkout_recorded(repo, path):
+    """Return the SHA of the tree last checked out at path, or None."""
+    try:
+        with open(checkout_record_file(repo, path), "r") as f:
+            sha, where = f.read().rstrip("\n").split(" ", 1)
+    except FileNotFoundError:
+        return None
+    return sha if where == path else None
+
+def checkout_record(repo, path, sha):
+    dest = checkout_record_file(repo, path)
+    with open(dest + ".tmp", "w") as f:
+        f.write(f"{sha} {path}\n")
+    os.replace(dest + ".tmp", dest)
+
+def tree_checkout(repo, tree, path, jobs=1):
+    # Creating directories needs the trees, which are small, so we do
+    # it first and on a single thread.  We get the list of every
+    # file to write on the way.
+    files = list()
+    with GitTrace.phase("create directories"):
+        tree_checkout_dirs(repo, tree, path, files)
+    with GitTrace.phase("write files"):
+        checkout_blobs(repo, files, jobs)
+
+def checkout_blobs(repo, files, jobs=1):
+    """Write every (mode, sha, dest) of files, jobs at a time."""
+    import GitPack
+    if jobs <= 1 or len(files) < 2:
+        for mode, sha, dest in files:
+            blob_checkout(repo, sha, dest, mode)
+        return
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
+    # The blobs go to a thread pool: both zlib and file I/O
+    # release the GIL, so inflating and writing files overlap nicely.
+    # Packs are opened first so that threads don't race to do it.
+    GitPack.pack_list(repo)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        # Consume the results so that errors get raised here.
+        for _ in pool.map(lambda f: blob_checkout(repo, f[1], f[2], f[0]), files):
+            pass
 
-def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = GitObject.object_read(repo, item.sha)
+def tree_checkout_dirs(repo, tree, path, files):
+    """Create the directories of tree under path, and append a (mode,
+    sha, dest) tuple to files for every file to write."""
+    for item in tree:
         dest = os.path.join(path, item.path)
 
-        if obj.fmt == b'tree':
+        if item.mode.startswith(b'04'):
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+            tree_checkout_dirs(repo, GitObject.object_read(repo, item.sha), dest, files)
+        elif item.mode.startswith(b'16'):
+            # A submodule: like git, we only leave an empty directory.
+            os.mkdir(dest)
+        else:
+            files.append((item.mode, item.sha, dest))
 
-def ref_resolve(repo, ref):
-    path = GitRepository.repo_file(repo, ref)
+def tree_checkout_update(repo, old, new, path, force=False, jobs=1):
+    """Turn path, a checkout of tree old, into a checkout of tree new.
+    Only the paths that differ between the two trees are touched, so
+    the work is proportional to the change.  Unless force is set, we
+    refuse to start if that would lose local changes, or files that
+    weren't in old at all."""
+    import GitDiff
+    with GitTrace.phase("diff trees"):
+        changes = list(GitDiff.diff_tree(repo, bytes.fromhex(old), bytes.fromhex(new)))
+
+    if not force:
+        with GitTrace.phase("check for local changes"):
+            dirty = [ c.path.decode("utf8") for c in changes if not checkout_is_clean(repo, path, c) ]
+        if dirty:
+            raise Exception("Local changes to the following files would be overwritten by checkout:\n  "
+                            + "\n  ".join(dirty)
+                            + "\nCommit or remove them, or use --force.")
+
+    files = list()
+    emptied = set()
+    for c in changes:
+        dest = os.path.join(path, os.fsdecode(c.path))
+        old_submodule = c.old_mode.startswith(b'16')
+        new_submodule = c.new_mode.startswith(b'16')
+
+        if c.status == "M" and c.old_sha == c.new_sha and checkout_chmod(dest, c.new_mode):
+            # Only the permissions changed, not the contents.
+            continue
+        if c.status == "M" and new_submodule:
+            # A submodule moved to another commit: we only ever leave
+            # an empty directory for those.
+            continue
+
+        # The old file goes away, even if it is going to be replaced:
+        # open() would write through a symlink, or to a hard link.
+        if c.status != "A":
+            checkout_remove(dest, old_submodule)
+        elif os.path.islink(dest) or os.path.lexists(dest) and not os.path.isdir(dest):
+            # Something that wasn't in old, and we were forced.
+            os.remove(dest)
+
+        if c.status == "D":
+            emptied.add(os.path.dirname(dest))
+        elif new_submodule:
+            os.makedirs(dest, exist_ok=True)
+        else:
+            files.append((c.new_mode, c.new_sha.hex(), dest))
+
+    # Remove the directories that deletions left empty, deepest first.
+    # One that still holds something stays, as do its parents.
+    for d in sorted(emptied, key=len, reverse=True):
+        while d != path:
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+            d = os.path.dirname(d)
+
+    # Files may have become directories, and directories files.
+    for _, _, dest in files:
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            os.rmdir(dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    with GitTrace.phase("write files"):
+        checkout_blobs(repo, files, jobs)
+
+def checkout_is_clean(repo, path, change):
+    """Check whether applying change to the checkout at path would only
+    lose data that old, the tree it was checked out from, has."""
+    import GitIndex
+    dest = os.path.join(path, os.fsdecode(change.path))
+    try:
+        st = os.lstat(dest)
+    except (FileNotFoundError, NotADirectoryError):
+        # Nothing to lose.
+        return True
+
+    if change.status == "A":
+        # A directory where a new file goes may be on its way out; if
+        # it doesn't end up empty, removing it will fail.
+        if stat.S_ISDIR(st.st_mode):
+            return True
+        # Otherwise, it's only safe if it's already what we'd write.
+        mode, sha = change.new_mode, change.new_sha
+    else:
+        mode, sha = change.old_mode, change.old_sha
+
+    # Submodules aren't ours to look into.
+    if mode.startswith(b'16'):
+        return True
+    if stat.S_ISDIR(st.st_mode):
+        return False
+
+    filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+    mode_type, mode_perms = GitIndex.index_entry_mode(st)
+    if mode_type != int(mode, 8) >> 12 \
+       or (filemode and mode_perms != int(mode, 8) & 0o777):
+        return False
+    return worktree_hash(dest, st) == sha.hex()
+
+def checkout_remove(dest, submodule=False):
+    """Remove the checked out file at dest, if it's still there."""
+    try:
+        if submodule:
+            os.rmdir(dest)
+        else:
+            os.remove(dest)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # Like git, leave submodules that aren't empty alone.
+        if not submodule:
+            raise
+
+def checkout_chmod(dest, mode):
+    """Give the file dest the permissions of mode, 100644 or 100755.
+    Return False if it isn't there to be changed."""
+    try:
+        st = os.lstat(dest)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(st.st_mode):
+        return False
+    if mode == b'100755':
+        os.chmod(dest, st.st_mode | ((st.st_mode & 0o444) >> 2))
+    else:
+        os.chmod(dest, st.st_mode & ~0o111)
+    return True
+
+def blob_checkout(repo, sha, dest, mode=b'100644'):
+    """Write blob sha to the file dest, one chunk at a time."""
+    fmt, _, chunks = GitObject.object_read_stream(repo, sha)
+    assert fmt == b'blob'
 
+    # A symlink: the blob contents is the link target.
+    if mode.startswith(b'12'):
+        os.symlink(os.fsdecode(b''.join(chunks)), dest)
+        return
+
+    with open(dest, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+    if mode == b'100755':
+        # Like git, make the file executable by whoever can read it,
+        # which keeps the umask into account.
+        st = os.stat(dest)
+        os.chmod(dest, st.st_mode | ((st.st_mode & 0o444) >> 2))
+
+def ref_resolve(repo, ref):
     # Sometimes, an indirect reference may be broken.  This is normal
     # in one specific case: we're looking for HEAD on a new repository
     # with no commits.  In that case, .git/HEAD points to "ref:
     # refs/heads/main", but .git/refs/heads/main doesn't exist yet
-    # (since there's no commit for it to refer to).
-    if not os.path.isfile(path):
-        return None
+    # (since there's no commit for it to refer to).  We return None
+    # then.
+    return GitRefs.ref_resolve(repo, ref)
+
+def ref_list(repo, prefix="refs/"):
+    # Both the loose refs and those in packed-refs, sorted by name
+    # like git shows them, as (name, sha) pairs.
+    return GitRefs.ref_list(repo, prefix)
+
+def cmd_archive(args):
+    import GitArchive
+    repo = GitRepository.repo_find()
+    tree = GitObject.object_find(repo, args.commit, fmt=b'tree')
+
+    # Like git, date the files of a commit from when it was committed,
+    # and record which commit it was.
+    commit = GitObject.object_find(repo, args.commit, fmt=b'commit')
+    mtime = None
+    if commit:
+        committer = GitObject.object_read(repo, commit).values(b'committer')[0]
+        mtime = int(committer.split()[-2])
+
+    fmt = args.format or (args.output and GitArchive.archive_format(args.output)) or "tar"
+    with GitTrace.phase("write archive"):
+        if args.output:
+            with open(args.output, "wb") as out:
+                GitArchive.archive(repo, tree, out, fmt, args.prefix, mtime, commit)
+        else:
+            GitArchive.archive(repo, tree, sys.stdout.buffer, fmt, args.prefix, mtime, commit)
+            sys.stdout.buffer.flush()
+
+def cmd_show_ref(args):
+    repo = GitRepository.repo_find()
+
+    prefixes = list()
+    if args.heads:
+        prefixes.append("refs/heads/")
+    if args.tags:
+        prefixes.append("refs/tags/")
+    if not prefixes:
+        # Patterns under refs/ are prefixes: only the refs that can
+        # match them are looked at.  Others can match anywhere.
+        if args.pattern and all(p.startswith("refs/") for p in args.pattern):
+            prefixes = args.pattern
+        else:
+            prefixes = [ "refs/" ]
+
+    refs = dict()
+    for prefix in prefixes:
+        refs.update(ref_list(repo, prefix))
+    if args.pattern:
+        refs = { name: sha for name, sha in refs.items()
+                 if any(show_ref_match(name, p) for p in args.pattern) }
+    show_ref(repo, sorted(refs.items()))
+
+def show_ref_match(name, pattern):
+    """Return whether ref name matches pattern.  A pattern under refs/
+    is a prefix of the names it matches.  Any other must be whole
+    components at the end of them, like git show-ref does: master
+    matches refs/heads/master and refs/remotes/origin/master, but not
+    refs/heads/remaster."""
+    if pattern.startswith("refs/"):
+        return name.startswith(pattern)
+    return name == pattern or name.endswith("/" + pattern)
+
+def show_ref(repo, refs, with_hash=True):
+    for name, sha in refs:
+        if with_hash:
+            print (f"{sha} {name}")
+        else:
+            print (f"{name}")
 
-    # Reads the path and stores it as 'fp'.
-    with open(path, 'r') as fp:
-        data = fp.read()[:-1]
-        # Drop final \n ^^^^^
-    # If the path is an indirect reference, recurse through it again starting from index 5
-    # to drop the 'ref: '.
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    # If it's just a SHA-1 hash or we reach a SHA-1 hash, return it.
+def cmd_repack(args):
+    repo = GitRepository.repo_find()
+    repack(repo, prune=args.prune, window=args.window, depth=args.depth, bitmap=args.bitmap)
+
+def cmd_gc(args):
+    repo = GitRepository.repo_find()
+    repack(repo, prune=True)
+
+def repack(repo, prune=False, window=10, depth=50, bitmap=False):
+    import GitPack
+    with GitTrace.phase("pack objects"):
+        path, shas = GitPack.pack_loose(repo, window=window, depth=depth)
+    if not path:
+        print("Nothing new to pack.")
     else:
-        return data
+        print(f"Packed {len(shas)} objects into {os.path.basename(path)}.pack")
 
-def ref_list(repo, path=None):
+    if bitmap:
+        repack_bitmap(repo)
     if not path:
-        # If there is no clear refs dir path, find the 'refs' dir path in the current 'repo'.
-        path = GitRepository.repo_dir(repo, "refs")
+        return
+
+    if prune:
+        # The pack and its index are in place and synced to disk, so
+        # the loose copies can go.
+        for sha in shas:
+            os.remove(GitRepository.repo_path(repo, "objects", sha[0:2], sha[2:]))
+        for sha in set(sha[0:2] for sha in shas):
+            d = GitRepository.repo_path(repo, "objects", sha)
+            if not os.listdir(d):
+                os.rmdir(d)
+                GitObject.OBJECT_FANOUT_DIRS.discard(d)
+
+def repack_bitmap(repo):
+    # A pack's bitmaps can only tell about objects in it, so they're
+    # only worth it when it has everything.
+    import GitBitmap
+    import GitPack
+    packs = GitPack.pack_list(repo)
+    if len(packs) != 1:
+        print("Not writing bitmaps: they need every object in a single pack.")
+        return
+    with GitTrace.phase("write bitmaps"):
+        count = GitBitmap.bitmap_write(repo, packs[0], set(bytes.fromhex(sha) for sha in ref_commits(repo)))
+    print(f"Wrote {count} bitmaps for {os.path.basename(packs[0].path)}.pack")
+
+def ref_heads(repo):
+    """Return the SHAs every ref, and HEAD which may be detached,
+    point to."""
+    heads = set(sha for _, sha in ref_list(repo))
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        heads.add(head)
+    return heads
+
+def ref_commits(repo):
+    """Return the commits the refs and HEAD point to."""
+    # Tags may point to other things than commits; follow them.
+    commits = set()
+    for sha in ref_heads(repo):
+        obj = GitObject.object_read(repo, sha)
+        while obj and obj.fmt == b'tag':
+            sha = obj.values(b'object')[0].decode("ascii")
+            obj = GitObject.object_read(repo, sha)
+        if obj and obj.fmt == b'commit':
+            commits.add(sha)
+    return commits
+
+def cmd_commit_graph(args):
+    import GitCommitGraph
+    repo = GitRepository.repo_find()
+    count = GitCommitGraph.commit_graph_write(repo, ref_commits(repo))
+    print(f"Wrote {count} commits to the commit-graph.")
+
+def cmd_rev_list(args):
+    import GitBitmap
+    repo = GitRepository.repo_find()
+
+    wants = list()
+    haves = list()
+    for rev in args.rev:
+        if rev.startswith("^"):
+            haves.append(bytes.fromhex(GitObject.object_find(repo, rev[1:])))
+        else:
+            wants.append(bytes.fromhex(GitObject.object_find(repo, rev)))
+    if args.all:
+        wants.extend(bytes.fromhex(sha) for sha in ref_heads(repo))
+    if not wants:
+        raise Exception("rev-list needs something to start from, or --all")
+
+    # The objects come by type, then in SHA order: not in the order of
+    # history, but the same with bitmaps or without.
+    found = GitBitmap.reachable(repo, wants, haves, objects=args.objects, use_bitmap=args.bitmap)
+    if args.count:
+        print(sum(len(shas) for shas in found.values()))
+        return
+    out = sys.stdout
+    for shas in found.values():
+        for sha in shas:
+            out.write(sha.hex() + "\n")
+
+def cmd_count_objects(args):
+    repo = GitRepository.repo_find()
+    counts = count_objects(repo)
+    if args.verbose:
+        for name, value in counts.items():
+            print(f"{name}: {value}")
+    else:
+        print(f"{counts['count']} objects, {counts['size']} kilobytes")
+
+def count_objects(repo):
+    """Count the objects of repo, and the disk space they take in KiB,
+    as git count-objects -v does.  Files which have nothing to do in
+    the object store are garbage, and reported on stderr."""
+    import GitPack
+    objects = GitRepository.repo_path(repo, "objects")
+    packs = GitPack.pack_list(repo)
+
+    def disk_size(st):
+        # Like git, what the file takes on disk, not its length.
+        return st.st_blocks * 512 if hasattr(st, "st_blocks") else st.st_size
+
+    counts = dict.fromkeys(("count", "size", "in-pack", "packs", "size-pack",
+                            "prune-packable", "garbage", "size-garbage"), 0)
+
+    def garbage(path):
+        print(f"warning: garbage found: {path}", file=sys.stderr)
+        counts["garbage"] += 1
+        counts["size-garbage"] += disk_size(os.lstat(path))
+
+    for d in sorted(os.listdir(objects)) if os.path.isdir(objects) else []:
+        path = os.path.join(objects, d)
+        if len(d) != 2 or not os.path.isdir(path):
+            continue
+        for f in sorted(os.listdir(path)):
+            if len(f) != 38 or not all(c in "0123456789abcdef" for c in f):
+                garbage(os.path.join(path, f))
+                continue
+            counts["count"] += 1
+            counts["size"] += disk_size(os.lstat(os.path.join(path, f)))
+            binsha = bytes.fromhex(d + f)
+            if any(pack.index(binsha) is not None for pack in packs):
+                counts["prune-packable"] += 1
+
+    for pack in packs:
+        counts["in-pack"] += pack.count
+        counts["packs"] += 1
+        counts["size-pack"] += len(pack.pack) + len(pack.idx)
+
+    # Besides packs and their indexes, git leaves other files next to
+    # them; anything else is garbage.
+    path = GitRepository.repo_path(repo, "objects", "pack")
+    known = (".pack", ".idx", ".keep", ".bitmap", ".promisor", ".mtimes", ".rev")
+    for f in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+        base, ext = os.path.splitext(f)
+        if f.startswith("multi-pack-index"):
+            continue
+        if ext not in known or not (os.path.isfile(os.path.join(path, base + ".pack")) and
+                                    os.path.isfile(os.path.join(path, base + ".idx"))):
+            garbage(os.path.join(path, f))
+
+    for name in ("size", "size-pack", "size-garbage"):
+        counts[name] //= 1024
+    return counts
+
+def cmd_merge_base(args):
+    import GitCommitGraph
+    repo = GitRepository.repo_find()
+    a, b = [ GitObject.object_find(repo, c, fmt=b'commit') for c in args.commit ]
+    sys.exit(0 if GitCommitGraph.commit_is_ancestor(repo, a, b) else 1)
+
+def cmd_diff_tree(args):
+    repo = GitRepository.repo_find()
+
+    if len(args.tree) > 2:
+        raise Exception("diff-tree takes one commit or two trees")
+
+    if len(args.tree) == 2:
+        old = GitObject.object_find(repo, args.tree[0], fmt=b'tree')
+        new = GitObject.object_find(repo, args.tree[1], fmt=b'tree')
+    else:
+        # A single commit is compared with its first parent.  Root
+        # commits have nothing to be compared with.
+        sha = GitObject.object_find(repo, args.tree[0], fmt=b'commit')
+        commit = GitObject.object_read(repo, sha)
+        parents = commit.values(b'parent')
+        if not parents:
+            return
+        print(sha)
+        parent = GitObject.object_read(repo, parents[0].decode("ascii"))
+        old = parent.values(b'tree')[0].decode("ascii")
+        new = commit.values(b'tree')[0].decode("ascii")
+
+    diff_tree(repo, old, new, args.recursive, args.renames)
+
+def diff_tree(repo, old, new, recursive=False, renames=False):
+    """Print the differences between trees old and new in git's raw
+    format."""
+    import GitDiff
+    changes = GitDiff.diff_tree(repo, bytes.fromhex(old), bytes.fromhex(new), recursive)
+    if renames:
+        changes = GitDiff.diff_renames(list(changes))
+
+    for c in changes:
+        status = "R100" if c.status == "R" else c.status
+        path = c.path.decode("utf8")
+        if c.status == "R":
+            path = c.old_path.decode("utf8") + "\t" + path
+        print(f":{c.old_mode.decode('ascii')} {c.new_mode.decode('ascii')} {c.old_sha.hex()} {c.new_sha.hex()} {status}\t{path}")
+
+def cmd_fsck(args):
+    import GitFsck
+    repo = GitRepository.repo_find()
+
+    # Like git, problems go to stderr and what's missing or dangling
+    # to stdout.  Only dangling objects aren't a failure.
+    failed = False
+    for kind, message in GitFsck.fsck(repo, args.jobs, args.dangling):
+        if kind == "error":
+            print(f"error: {message}", file=sys.stderr)
+        else:
+            print(message)
+        if kind != "dangling":
+            failed = True
+    sys.exit(1 if failed else 0)
+
+def cmd_check_ignore(args):
+    import GitIgnore
+    import GitIndex
+    repo = GitRepository.repo_find()
+
+    paths = list(args.path)
+    if args.stdin:
+        paths.extend(line.rstrip("\n") for line in sys.stdin)
+    if not paths:
+        raise Exception("check-ignore needs paths to check")
+    if args.non_matching and not args.verbose:
+        raise Exception("--non-matching needs --verbose")
+
+    # Rules don't apply to files already tracked.
+    tracked = set(e.name for e in GitIndex.index_read(repo).entries) if args.index else set()
+
+    # Like git, -v shows the rules that re-include a path too, and
+    # they count as a match for the exit status.
+    matched = False
+    for path in paths:
+        abspath = os.path.abspath(path)
+        if abspath == repo.worktree or not abspath.startswith(repo.worktree + os.sep):
+            raise Exception(f"{path} is outside the worktree")
+        name = os.path.relpath(abspath, repo.worktree)
+        is_dir = path.endswith("/") or (os.path.isdir(abspath) and not os.path.islink(abspath))
+
+        rule = None if name in tracked else GitIgnore.ignore_path(repo, name, is_dir)
+        if rule is not None and rule.negated and not args.verbose:
+            rule = None
+        if rule is not None:
+            matched = True
+
+        if args.verbose and rule is not None:
+            print(f"{rule.source}:{rule.line}:{rule.pattern}\t{path}")
+        elif args.verbose and args.non_matching:
+            print(f"::\t{path}")
+        elif rule is not None:
+            print(path)
+    sys.exit(0 if matched else 1)
+
+def cmd_ls_files(args):
+    # Only needed by --verbose, and slow to import.
+    from datetime import datetime
+    import grp, pwd
+    import GitIndex
+
+    repo = GitRepository.repo_find()
+    index = GitIndex.index_read(repo)
+    if args.verbose:
+        print(f"Index file format v{index.version}, containing {len(index.entries)} entries.")
+
+    for e in index.entries:
+        print(e.name)
+        if args.verbose:
+            entry_type = { 0b1000: "regular file",
+                           0b1010: "symlink",
+                           0b1110: "git link" }[e.mode_type]
+            print(f"  {entry_type} with perms: {e.mode_perms:o}")
+            print(f"  on blob: {e.sha}")
+            print(f"  created: {datetime.fromtimestamp(e.ctime[0])}.{e.ctime[1]}, modified: {datetime.fromtimestamp(e.mtime[0])}.{e.mtime[1]}")
+            print(f"  device: {e.dev}, inode: {e.ino}")
+            print(f"  user: {pwd.getpwuid(e.uid).pw_name} ({e.uid})  group: {grp.getgrgid(e.gid).gr_name} ({e.gid})")
+            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid}")
+
+def worktree_hash(path, st):
+    """Compute the blob SHA of the worktree file at path, given its
+    stat data."""
+    # A symlink is stored as a blob of its target.
+    if stat.S_ISLNK(st.st_mode):
+        blob = GitObject.GitBlob(os.fsencode(os.readlink(path)))
+        return GitObject.object_write(blob)
+    with open(path, "rb") as fd:
+        return GitObject.object_hash(fd, b"blob")
+
+def worktree_files(repo, jobs=1):
+    """Return the paths of every file in the worktree that isn't
+    ignored, relative to it, in no particular order.  Directories are
+    read by a pool of jobs threads, and ignored ones are never read at
+    all."""
+    import GitIgnore
+    todo = [ ("", GitIgnore.ignore_root(repo)) ]
+    ret = list()
+    if jobs <= 1:
+        while todo:
+            files, dirs = worktree_scan_dir(repo, *todo.pop())
+            ret.extend(files)
+            todo.extend(dirs)
+        return ret
+
+    # Reading a directory releases the GIL, so threads keep the disk
+    # busy while others match names against the rules.
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = { pool.submit(worktree_scan_dir, repo, *todo.pop()) }
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                ret.extend(files)
+                for d in dirs:
+                    pending.add(pool.submit(worktree_scan_dir, repo, *d))
+    return ret
+
+def worktree_scan_dir(repo, base, ignore):
+    """Read directory base of the worktree, "" or "dir/", where the
+    rules ignore apply.  Return the files in it that aren't ignored,
+    and the (base, rules) of its subdirectories that aren't."""
+    import GitIgnore
+    with os.scandir(os.path.join(repo.worktree, base)) as it:
+        entries = list(it)
+    if any(e.name == ".gitignore" for e in entries):
+        ignore = ignore.child(GitIgnore.ignore_read(repo, base))
+
+    files = list()
+    dirs = list()
+    for e in entries:
+        # Neither our .git nor those of nested repositories are files
+        # of the worktree.
+        if e.name == ".git":
+            continue
+        path = base + e.name
+        # Symlinks to directories are files as far as we are
+        # concerned.
+        is_dir = e.is_dir(follow_symlinks=False)
+        if ignore.ignored(path, is_dir):
+            continue
+        if is_dir:
+            dirs.append((path + "/", ignore))
+        else:
+            files.append(path)
+    return files, dirs
+
+def branch_get_active(repo):
+    with open(GitRepository.repo_file(repo, "HEAD"), "r") as f:
+        head = f.read()
+
+    if head.startswith("ref: refs/heads/"):
+        return head[16:-1]
+    else:
+        return False
+
+def tree_to_dict(repo, sha, prefix=""):
+    """Flatten tree sha into a {path: blob sha} dictionary."""
     ret = dict()
-    # Git shows refs sorted.  To do the same, we sort the output of
-    # listdir
-    for f in sorted(os.listdir(path)):
-        # Join every item in the directory to the path so we have a full path.
-        can = os.path.join(path, f)
-        
-        # If the joined path is a directory, recurse through it so we find all the refs.
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can) # This is technically a dictionary that has another dictionary (directory) at ref 'f'.
-        # Recurse through each ref until we find the SHA-1 hash.
+    tree = GitObject.object_read(repo, sha)
+
+    for leaf in tree:
+        full_path = os.path.join(prefix, leaf.path)
+
+        if leaf.mode.startswith(b'04'):
+            ret.update(tree_to_dict(repo, leaf.sha, full_path))
         else:
-            ret[f] = ref_resolve(repo, can)
+            ret[full_path] = leaf.sha
 
     return ret
 
-def cmd_show_ref(args):
+def cmd_status(args):
+    import GitIndex
     repo = GitRepository.repo_find()
-    refs = ref_list(repo)
-    show_ref(repo, refs, prefix="refs")
-
-def show_ref(repo, refs, with_hash=True, prefix=""):
-    if prefix:
-        prefix = prefix + '/'
-    for k, v in refs.items():
-        if type(v) == str and with_hash:
-            print (f"{v} {prefix}{k}")
-        elif type(v) == str:
-            print (f"{prefix}{k}")
+    with GitTrace.phase("read index"):
+        index = GitIndex.index_read(repo)
+
+    cmd_status_branch(repo)
+    with GitTrace.phase("compare HEAD and index"):
+        cmd_status_head_index(repo, index)
+    print()
+    with GitTrace.phase("compare index and worktree"):
+        cmd_status_index_worktree(repo, index, args.jobs)
+
+def cmd_status_branch(repo):
+    branch = branch_get_active(repo)
+    if branch:
+        print(f"On branch {branch}.")
+    else:
+        print(f"HEAD detached at {ref_resolve(repo, 'HEAD')}")
+
+def cmd_status_head_index(repo, index):
+    print("Changes to be committed:")
+
+    # A new repository has no HEAD commit yet, so everything is new.
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        commit = GitObject.object_read(repo, head)
+        head = tree_to_dict(repo, commit.values(b'tree')[0].decode("ascii"))
+    else:
+        head = dict()
+
+    for entry in index.entries:
+        if entry.name in head:
+            if head[entry.name] != entry.sha:
+                print("  modified:", entry.name)
+            del head[entry.name] # Delete the key
         else:
-            show_ref(repo, v, with_hash=with_hash, prefix=f"{prefix}{k}")
+            print("  added:   ", entry.name)
+
+    # Keys still in HEAD are files that we haven't met in the index,
+    # and thus have been deleted.
+    for entry in head.keys():
+        print("  deleted: ", entry)
+
+def cmd_status_index_worktree(repo, index, jobs=1):
+    import GitIndex
+    print("Changes not staged for commit:")
+
+    filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+    all_files = set(worktree_files(repo, jobs))
+    refreshed = False
+
+    # We now traverse the index, and compare real files with the cached
+    # versions.
+    for entry in index.entries:
+        full_path = os.path.join(repo.worktree, entry.name)
+
+        # That file *name* is in the index
+        try:
+            st = os.lstat(full_path)
+        except FileNotFoundError:
+            print("  deleted: ", entry.name)
+            continue
+        all_files.discard(entry.name)
+
+        # Submodules aren't ours to look into.
+        if entry.mode_type == 0b1110:
+            continue
+
+        # If the stat data didn't change, the file didn't either, and
+        # we don't even have to read it.
+        if GitIndex.index_entry_stat_matches(index, entry, st, filemode):
+            continue
+
+        # Otherwise, we have to compare contents.
+        if worktree_hash(full_path, st) != entry.sha:
+            print("  modified:", entry.name)
+            continue
+
+        mode_type, mode_perms = GitIndex.index_entry_mode(st)
+        if mode_type != entry.mode_type or (filemode and mode_perms != entry.mode_perms):
+            print("  modified:", entry.name)
+            continue
+
+        # Same contents, only the stat data moved (a touch, a copy...):
+        # remember the new stat data, so that next time is fast.
+        GitIndex.index_entry_refresh(entry, st)
+        refreshed = True
+
+    if refreshed:
+        GitIndex.index_write(repo, index)
+
+    print()
+    print("Untracked files:")
+
+    for f in sorted(all_files):
+        print(" ", f)
+
+def rm(repo, paths, delete=True, skip_missing=False):
+    # Find and read the index
+    import GitIndex
+    index = GitIndex.index_read(repo)
+
+    worktree = repo.worktree + os.sep
+
+    # Make paths absolute
+    abspaths = set()
+    for path in paths:
+        abspath = os.path.abspath(path)
+        if abspath.startswith(worktree):
+            abspaths.add(abspath)
+        else:
+            raise Exception(f"Cannot remove paths outside of worktree: {paths}")
+
+    # The list of entries to *keep*, which we will write back to the
+    # index.
+    kept_entries = list()
+    # The list of removed paths, which we'll use after index update
+    # to physically remove the actual paths from the filesystem.
+    remove = list()
+
+    # Now we iterate over the list of entries, and remove those whose
+    # paths we find in abspaths.  We preserve the others in
+    # kept_entries.
+    for e in index.entries:
+        full_path = os.path.join(repo.worktree, e.name)
+
+        if full_path in abspaths:
+            remove.append(full_path)
+            abspaths.remove(full_path)
+        else:
+            kept_entries.append(e) # Preserve entry
+
+    # If abspaths is empty, it means some paths weren't in the index.
+    if len(abspaths) > 0 and not skip_missing:
+        raise Exception(f"Cannot remove paths not in the index: {abspaths}")
+
+    # Physically delete paths from filesystem.
+    if delete:
+        for path in remove:
+            os.unlink(path)
+
+    # Update the list of entries in the index, and write it back.
+    index.entries = kept_entries
+    GitIndex.index_write(repo, index)
+
+def cmd_rm(args):
+    repo = GitRepository.repo_find()
+    rm(repo, args.path, delete=not args.cached)
+
+def add(repo, paths):
+    import GitIndex
+    worktree = repo.worktree + os.sep
+
+    # Convert the paths to pairs: (absolute, relative_to_worktree).
+    # Directories are expanded to every file they hold.
+    clean_paths = list()
+    for path in paths:
+        abspath = os.path.abspath(path)
+        if not (abspath.startswith(worktree) and os.path.lexists(abspath)):
+            raise Exception(f"Not a file, or outside the worktree: {path}")
+        if os.path.isdir(abspath) and not os.path.islink(abspath):
+            for (root, dirs, files) in os.walk(abspath):
+                if ".git" in dirs:
+                    dirs.remove(".git")
+                for f in files:
+                    full = os.path.join(root, f)
+                    clean_paths.append((full, os.path.relpath(full, repo.worktree)))
+        else:
+            clean_paths.append((abspath, os.path.relpath(abspath, repo.worktree)))
+
+    # Find and read the index, then drop the existing entries for
+    # these paths: they'll be replaced.
+    index = GitIndex.index_read(repo)
+    names = set(relpath for _, relpath in clean_paths)
+    index.entries = [ e for e in index.entries if e.name not in names ]
+
+    # Now add the paths: hash and store them, and remember their
+    # stat data so that status doesn't have to hash them again.
+    for (abspath, relpath) in clean_paths:
+        st = os.lstat(abspath)
+        if stat.S_ISLNK(st.st_mode):
+            blob = GitObject.GitBlob(os.fsencode(os.readlink(abspath)))
+            sha = GitObject.object_write(blob, repo)
+        else:
+            with open(abspath, "rb") as fd:
+                sha = GitObject.object_hash(fd, b"blob", repo)
+
+        index.entries.append(GitIndex.index_entry_from_stat(relpath, sha, st))
+
+    # Write the index back
+    GitIndex.index_write(repo, index)
+
+def cmd_add(args):
+    repo = GitRepository.repo_find()
+    add(repo, args.path)
 
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
-    
-    match args.command:
-        # case "add"          : cmd_add(args)
-        case "cat-file"     : cmd_cat_file(args)
-        # case "check-ignore" : cmd_check_ignore(args)
-        case "checkout"     : cmd_checkout(args)
-        # case "commit"       : cmd_commit(args)
-        case "hash-object"  : cmd_hash_object(args)
-        case "init"         : cmd_init(args)
-        case "log"          : cmd_log(args)
-        # case "ls-files"     : cmd_ls_files(args)
-        case "ls-tree"      : cmd_ls_tree(args)
-        # case "rev-parse"    : cmd_rev_parse(args)
-        # case "rm"           : cmd_rm(args)
-        case "show-ref"     : cmd_show_ref(args)
-        # case "status"       : cmd_status(args)
-        # case "tag"          : cmd_tag(args)
-        case _              : print("Bad command.")
+    GitTrace.trace_start_from_env()
+    with GitTrace.phase("parse arguments"):
+        command = argparser_command(argv)
+        paths = None
+        if command in argpaths and "--" in argv:
+            i = argv.index("--")
+            argv, paths = argv[:i], argv[i + 1:]
+        args = argparser_build(command).parse_args(argv)
+        if command in argpaths:
+            args.paths = paths
+    if args.trace:
+        GitTrace.trace_start(args.trace)
 
+    try:
+        with GitTrace.phase(f"kgit {args.command}"):
+            match args.command:
+                case "add"          : cmd_add(args)
+                case "archive"      : cmd_archive(args)
+                case "cat-file"     : cmd_cat_file(args)
+                case "check-ignore" : cmd_check_ignore(args)
+                case "checkout"     : cmd_checkout(args)
+                # case "commit"       : cmd_commit(args)
+                case "commit-graph" : cmd_commit_graph(args)
+                case "count-objects": cmd_count_objects(args)
+                case "diff-tree"    : cmd_diff_tree(args)
+                case "fsck"         : cmd_fsck(args)
+                case "gc"           : cmd_gc(args)
+                case "hash-object"  : cmd_hash_object(args)
+                case "init"         : cmd_init(args)
+                case "log"          : cmd_log(args)
+                case "ls-files"     : cmd_ls_files(args)
+                case "ls-tree"      : cmd_ls_tree(args)
+                case "merge-base"   : cmd_merge_base(args)
+                case "repack"       : cmd_repack(args)
+                case "rev-list"     : cmd_rev_list(args)
+                case "rev-parse"    : cmd_rev_parse(args)
+                case "rm"           : cmd_rm(args)
+                case "show-ref"     : cmd_show_ref(args)
+                case "status"       : cmd_status(args)
+                # case "tag"          : cmd_tag(args)
+                case _              : print("Bad command.")
+    finally:
+        GitTrace.trace_finish(args.command)